@@ -0,0 +1,497 @@
+import os
+import json
+import uuid
+import asyncio
+import functools
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Any, Tuple, Union
+import numpy as np
+import pandas as pd
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+from endpoints.endpoints import PandasCode
+from functions import prompts, df_profile, df_code_analys, schema_summary, tracing
+from functions.memory import MemoryManager
+from functions.retention import Retention
+from functions.executor import SandboxExecutor, SandboxError, SandboxTimeout
+from functions.session_scripts import AsyncSessionScripts
+from functions.write_behind import StateLostError
+from functions.llm_router import LLMRouter, is_model_failure
+
+# Запуск: uvicorn endpoints.service:app
+load_dotenv()
+MODEL = os.getenv("LLM_MODEL", "qwen/qwen3-30b-a3b:free")
+LLM_ROUTES = os.getenv("LLM_ROUTES", f"openrouter:{MODEL}").split(",")
+# ключ кэша ответов включает все маршруты: при сбое первого отвечает другая модель
+PROMPT_TEMPLATE = f"{','.join(LLM_ROUTES)}||{prompts.CODE_GENERATION_SYSTEM_PROMPT}"
+# результаты запросов хранятся в redis сутки
+QUERY_TTL = 60 * 60 * 24
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 2000))
+PREVIEW_ROWS = 5
+# большие состояния: сначала ответ на стратифицированной выборке, полный расчет в фоне с возможностью отмены
+PREVIEW_MIN_ROWS = int(os.getenv("PREVIEW_MIN_ROWS", 1_000_000))
+PREVIEW_SAMPLE_ROWS = int(os.getenv("PREVIEW_SAMPLE_ROWS", 10_000))
+PREVIEW_TIMEOUT = float(os.getenv("PREVIEW_TIMEOUT", 5))
+# папка, из которой можно создать сессию по пути к csv на сервере, без неё принимаются только загрузки
+IMPORT_DIR = os.getenv("IMPORT_DIR")
+
+
+class QueryRequest(BaseModel):
+    query: str
+
+
+class TieringRequest(BaseModel):
+    hot_format: Optional[str] = None
+    hot_states: Optional[int] = None
+
+
+class RetentionRequest(BaseModel):
+    ttl_seconds: Optional[float] = None
+    max_steps: Optional[int] = None
+    max_bytes: Optional[int] = None
+
+
+class Service():
+    def __init__(self):
+        """Shared resources of the service. Waiting for redis and the model happens in the event loop,
+        parquet reading and writing go to a thread pool, generated code goes to sandbox processes."""
+        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        # TRACING=1 - время этапов запроса в /metrics, TRACE_FILE - спаны в json lines
+        tracing.configure_from_env()
+        self.mgr = MemoryManager(redis_url=redis_url, storage_dir=os.getenv("STORAGE_DIR", "./df_states"),
+                                 storage_mode=os.getenv("STORAGE_MODE", "parquet"),
+                                 cache_bytes=int(os.getenv("DF_CACHE_BYTES", 1024 ** 3)),
+                                 result_cache_bytes=int(os.getenv("RESULT_CACHE_BYTES", 256 * 1024 ** 2)),
+                                 write_behind=os.getenv("WRITE_BEHIND", "1") == "1",
+                                 hot_format=os.getenv("HOT_STATE_FORMAT", "arrow"),
+                                 hot_states=int(os.getenv("HOT_STATES", 3)),
+                                 compact=os.getenv("COMPACT_DTYPES", "0") == "1",
+                                 compact_strings=os.getenv("COMPACT_STRINGS", "category"))
+        self.r = aioredis.from_url(redis_url, decode_responses=True)
+        tracing.instrument_redis(self.r)
+        self.scripts = AsyncSessionScripts(self.r)
+        self.router = LLMRouter(LLM_ROUTES, config_path=os.getenv("LLM_CONFIG", "api.json"))
+        self.io_pool = ThreadPoolExecutor(max_workers=int(os.getenv("IO_WORKERS", 8)), thread_name_prefix="state-io")
+        self.sandbox = SandboxExecutor(workers=int(os.getenv("SANDBOX_WORKERS", 0)) or None,
+                                       timeout=float(os.getenv("SANDBOX_TIMEOUT", 60)),
+                                       memory_limit=int(os.getenv("SANDBOX_MEMORY_LIMIT", 0)) or None)
+        self.upload_dir = os.path.join(self.mgr.storage_dir, "uploads")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        # сессии без запросов дольше RETENTION_TTL удаляются, длинные истории сжимаются до лимитов
+        self.retention = Retention(self.mgr, ttl_seconds=float(os.getenv("RETENTION_TTL", 0)),
+                                   max_steps=int(os.getenv("RETENTION_MAX_STEPS", 0)),
+                                   max_bytes=int(os.getenv("RETENTION_MAX_BYTES", 0)),
+                                   chunk_grace_seconds=float(os.getenv("CHUNK_GRACE_SECONDS", 600)),
+                                   on_expire=self._expired)
+        # запросы одной сессии выполняются по очереди, разные сессии - параллельно
+        self._locks = {}
+        self._tasks = set()
+        # полные расчеты, которые можно отменить, по id запроса
+        self._jobs = {}
+    def _expired(self, session_id: str) -> None:
+        """Uploaded csv left by a deleted session (normally removed right after ingest)"""
+        upload = os.path.join(self.upload_dir, f"{session_id}.csv")
+        if os.path.exists(upload):
+            os.remove(upload)
+        self._locks.pop(session_id, None)
+    async def io(self, func, *args, **kwargs) -> Any:
+        """Running blocking MemoryManager call in the thread pool, spans opened in it belong to the current query"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_pool, functools.partial(contextvars.copy_context().run,
+                                                                          func, *args, **kwargs))
+    def lock(self, session_id: str) -> asyncio.Lock:
+        if session_id not in self._locks:
+            self._locks[session_id] = asyncio.Lock()
+        return self._locks[session_id]
+    def spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.to_thread(self.retention.stop)
+        await asyncio.to_thread(self.sandbox.shutdown)
+        self.io_pool.shutdown(wait=True)
+        await asyncio.to_thread(self.mgr.close)
+        await asyncio.to_thread(self.router.close)
+        await self.r.aclose()
+    async def state_info(self, session_id: str, target: Union[str, int] = "head") -> Optional[dict]:
+        """Current state, "parent" - undo, "child" - redo, step number - checkout"""
+        return await self.scripts.checkout(self.mgr.session_keys(session_id), self.mgr.node_prefix(session_id), target)
+    async def get_cache(self, signature: str, user_query: str) -> Optional[dict]:
+        raw = await self.r.get(f"llmcache:{MemoryManager.cache_key(PROMPT_TEMPLATE, signature, user_query)}")
+        if raw is None:
+            self.mgr.llm_cache_stats["misses"] += 1
+            tracing.cache_event("llm", "miss")
+            return None
+        payload = json.loads(raw)
+        event = "negative_hits" if payload.get("error") else "hits"
+        self.mgr.llm_cache_stats[event] += 1
+        tracing.cache_event("llm", event[:-1])
+        return payload
+    async def set_cache(self, signature: str, user_query: str, payload: dict, ttl_seconds: int) -> None:
+        payload = dict(payload)
+        payload.setdefault("created_at", datetime.now(self.mgr.tz).isoformat())
+        await self.r.set(f"llmcache:{MemoryManager.cache_key(PROMPT_TEMPLATE, signature, user_query)}",
+                         json.dumps(payload, ensure_ascii=False), ex=ttl_seconds)
+        self.mgr.llm_cache_stats["writes"] += 1
+    @staticmethod
+    def _query_key(session_id: str, query_id: str) -> str:
+        return MemoryManager.session_key(session_id, f"query:{query_id}")
+    async def save_query(self, session_id: str, query_id: str, record: dict) -> None:
+        await self.r.set(self._query_key(session_id, query_id), json.dumps(record, ensure_ascii=False), ex=QUERY_TTL)
+    async def load_query(self, session_id: str, query_id: str) -> Optional[dict]:
+        raw = await self.r.get(self._query_key(session_id, query_id))
+        return json.loads(raw) if raw else None
+    async def run_code(self, code: str, frame: pd.DataFrame, timeout: Optional[float] = None,
+                       query_id: Optional[str] = None) -> Any:
+        """Running code in the sandbox, job of query_id can be cancelled by cancel_query meanwhile"""
+        with tracing.span("sandbox", rows=len(frame), preview=timeout is not None):
+            return await self._run_job(code, frame, timeout, query_id)
+    async def _run_job(self, code: str, frame: pd.DataFrame, timeout: Optional[float], query_id: Optional[str]) -> Any:
+        # запись кадра в общую память тоже блокирующая, поэтому submit в пуле потоков
+        job = await self.io(self.sandbox.submit, code, frame, timeout=timeout)
+        if query_id is not None:
+            self._jobs[query_id] = job
+        try:
+            return await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            if job.cancelled() and not asyncio.current_task().cancelling():
+                # job was cancelled before it started
+                raise SandboxError("job cancelled")
+            job.cancel()
+            raise
+        finally:
+            self._jobs.pop(query_id, None)
+    def cancel_query(self, query_id: str) -> bool:
+        job = self._jobs.get(query_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+    async def preview(self, session_id: str, code: str, frame: pd.DataFrame, signature: str, record: dict) -> None:
+        """Result on a stratified sample, saved as the query record before the full run starts"""
+        sample = await self.io(self.mgr.get_sample, session_id, PREVIEW_SAMPLE_ROWS, signature=signature)
+        if list(sample.columns) != list(frame.columns):
+            sample = sample[list(frame.columns)]
+        sample = await self.io(self.mgr.expand, session_id, sample)
+        started = asyncio.get_running_loop().time()
+        try:
+            result = await self.run_code(code, sample, timeout=PREVIEW_TIMEOUT)
+        except (SandboxError, SandboxTimeout) as e:
+            record["preview_error"] = str(e)
+        else:
+            record.update({"status": "preview", "preview_rows": len(sample),
+                           "preview_seconds": round(asyncio.get_running_loop().time() - started, 3),
+                           "preview_kind": "state" if isinstance(result, pd.DataFrame) else "value",
+                           "preview": _to_json(result.head(PREVIEW_ROWS) if isinstance(result, pd.DataFrame) else result)})
+        await self.save_query(session_id, query_id=record["query_id"], record=record)
+    async def generate(self, info: str, user_query: str) -> Tuple[PandasCode, str]:
+        response = await self.router.aparse(
+            messages=prompts.prompt_code_generation(info=info, querry=user_query),
+            response_format=PandasCode,
+            temperature=0,
+            top_p=0.95
+        )
+        return response.choices[0].message.parsed, response.model
+    async def answer(self, session_id: str, query_id: str, user_query: str) -> None:
+        """Whole analysis step of main loop: cache, model, sandbox, new state. Result is saved by query id"""
+        with tracing.bind(session_id=session_id, query_id=query_id), tracing.span("query") as span:
+            record = await self._answer(session_id, query_id, user_query)
+            span.set(status=record["status"], cached=record.get("cached"), result_cached=record.get("result_cached"),
+                     step=(record.get("meta") or {}).get("step"))
+    async def _answer(self, session_id: str, query_id: str, user_query: str) -> dict:
+        record = {"query_id": query_id, "query": user_query, "status": "running"}
+        try:
+            async with self.lock(session_id):
+                await self.save_query(session_id, query_id, record)
+                signature = await self.io(self.mgr.state_signature, session_id)
+                cached = await self.get_cache(signature, user_query)
+                if cached and cached.get("error"):
+                    raise ValueError(f"Этот запрос недавно завершился ошибкой: {cached['error']}")
+                if cached:
+                    parsed = PandasCode(code=cached["code"], comment=cached["comment"])
+                    record["cached"] = True
+                else:
+                    profile = await self.io(self.mgr.get_profile, session_id)
+                    try:
+                        info = schema_summary.build_schema_summary(profile, user_query, budget=PROMPT_TOKEN_BUDGET)
+                        parsed, model = await self.generate(info, user_query)
+                    except Exception as e:
+                        # запоминается только отказ модели или неверный ответ, сетевые ошибки и лимиты повторяются
+                        if is_model_failure(e):
+                            await self.set_cache(signature, user_query, {"error": str(e)}, ttl_seconds=60 * 5)
+                        raise
+                    await self.set_cache(signature, user_query,
+                                         {"code": parsed.code, "comment": parsed.comment, "model": model},
+                                         ttl_seconds=60 * 60 * 24)
+                    record["cached"] = False
+                record.update({"code": parsed.code, "comment": parsed.comment})
+
+                # df.sample(), np.random, текущее время дают новый результат при каждом запуске
+                result_key = (self.mgr.result_cache.key(signature, parsed.code)
+                              if df_code_analys.is_read_only(parsed.code) and df_code_analys.is_deterministic(parsed.code)
+                              else None)
+                found, result = await self.io(self.mgr.result_cache.get, result_key)
+                record["result_cached"] = found
+                if not found:
+                    # код, который только читает df, выполняется на тех колонках, к которым обращается,
+                    # результат тот же, что и на полном df, поэтому код выполняется один раз.
+                    # С диска читаются только эти колонки
+                    columns = df_code_analys.projected_columns(parsed.code)
+                    frame = await self.io(self.mgr.load_current_df, session_id, columns)
+                    # сжатие типов только для хранения, код видит столбцы в исходных типах
+                    frame = await self.io(self.mgr.expand, session_id, frame)
+                    if len(frame) >= PREVIEW_MIN_ROWS:
+                        await self.preview(session_id, parsed.code, frame, signature, record)
+                    result = await self.run_code(parsed.code, frame, query_id=query_id)
+                    await self.io(self.mgr.result_cache.put, result_key, result)
+                if isinstance(result, pd.DataFrame):
+                    meta = await self.io(self.mgr.push_result, session_id, result, code=parsed.code)
+                    record.update({"status": "done", "kind": "state", "meta": meta,
+                                   "preview": _to_json(result.head(PREVIEW_ROWS))})
+                else:
+                    record.update({"status": "done", "kind": "value", "result": _to_json(result)})
+        except asyncio.CancelledError:
+            record.update({"status": "error", "error": "service stopped"})
+            await asyncio.shield(self.save_query(session_id, query_id, record))
+            raise
+        except (SandboxError, SandboxTimeout) as e:
+            if str(e) == "job cancelled":
+                # пользователь отклонил предпросмотр, состояние не меняется
+                record["status"] = "cancelled"
+            else:
+                record.update({"status": "error", "error": f"Ошибка при выполнении кода: {e}"})
+        except Exception as e:
+            record.update({"status": "error", "error": str(e)})
+        await self.save_query(session_id, query_id, record)
+        return record
+
+
+def _to_json(value: Any) -> Any:
+    """Result of generated code in json form, tables are split into columns, index and rows, unknown objects - their text"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return json.loads(value.to_json(orient="split", date_format="iso", default_handler=str))
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.service = Service()
+    await app.state.service.io(app.state.service.mgr.recover)
+    app.state.service.retention.start(float(os.getenv("RETENTION_INTERVAL", 300)))
+    try:
+        yield
+    finally:
+        await app.state.service.close()
+
+
+app = FastAPI(title="anal_app", lifespan=lifespan)
+
+
+async def _state(service: Service, session_id: str, target: Union[str, int] = "head") -> dict:
+    meta = await service.state_info(session_id, target)
+    if meta is None:
+        raise HTTPException(status_code=404, detail=f"Сессия {session_id} не найдена")
+    return meta
+
+
+async def _leave(service: Service, session_id: str) -> None:
+    """Current state is written before undo or checkout, an unwritten one is dropped and its parent becomes current"""
+    try:
+        await service.io(service.mgr.before_move, session_id)
+    except StateLostError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.post("/sessions", status_code=201)
+async def create_session(file: Optional[UploadFile] = File(None), csv_path: Optional[str] = Form(None)) -> dict:
+    """New session from uploaded csv or from csv in IMPORT_DIR on the server"""
+    service = app.state.service
+    session_id = uuid.uuid4().hex
+    upload = None
+    if file is not None:
+        csv_path = upload = os.path.join(service.upload_dir, f"{session_id}.csv")
+        with open(csv_path, "wb") as target:
+            while chunk := await file.read(1 << 20):
+                await service.io(target.write, chunk)
+    elif csv_path:
+        csv_path = _import_path(csv_path)
+    else:
+        raise HTTPException(status_code=400, detail="Нужен файл csv или путь к нему")
+    try:
+        meta = await service.io(service.mgr.init_session_from_csv, session_id, csv_path)
+    except (ValueError, pd.errors.ParserError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # состояние уже записано в хранилище, загруженный csv больше не нужен
+        if upload is not None and os.path.exists(upload):
+            os.remove(upload)
+    return {"session_id": session_id, "meta": meta}
+
+
+def _import_path(csv_path: str) -> str:
+    """Path of a server csv resolved inside IMPORT_DIR, other paths (also through symlinks and ..) are rejected"""
+    if not IMPORT_DIR:
+        raise HTTPException(status_code=400, detail="Импорт файлов с сервера отключен, загрузите csv")
+    root = os.path.realpath(IMPORT_DIR)
+    path = os.path.realpath(os.path.join(root, csv_path))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        raise HTTPException(status_code=400, detail=f"Файл {csv_path} не найден в папке импорта")
+    return path
+
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str, rows: int = PREVIEW_ROWS) -> dict:
+    """Current state: meta, profile text and first rows"""
+    service = app.state.service
+    meta = await _state(service, session_id)
+    profile = await service.io(service.mgr.get_profile, session_id)
+    df = await service.io(service.mgr.load_current_df, session_id)
+    return {"meta": meta, "info": df_profile.render_profile(profile), "preview": _to_json(df.head(rows))}
+
+
+@app.post("/sessions/{session_id}/queries", status_code=202)
+async def submit_query(session_id: str, request: QueryRequest) -> dict:
+    """Query is answered in background, its result is taken from GET .../queries/{query_id}"""
+    service = app.state.service
+    await _state(service, session_id)
+    query_id = uuid.uuid4().hex
+    await service.save_query(session_id, query_id, {"query_id": query_id, "query": request.query, "status": "pending"})
+    service.spawn(service.answer(session_id, query_id, request.query))
+    return {"query_id": query_id, "status": "pending"}
+
+
+@app.get("/sessions/{session_id}/queries/{query_id}")
+async def get_query(session_id: str, query_id: str) -> dict:
+    record = await app.state.service.load_query(session_id, query_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Запрос {query_id} не найден")
+    return record
+
+
+@app.post("/sessions/{session_id}/queries/{query_id}/cancel")
+async def cancel_query(session_id: str, query_id: str) -> dict:
+    """Cancelling full run of a query after its preview was rejected"""
+    service = app.state.service
+    record = await service.load_query(session_id, query_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Запрос {query_id} не найден")
+    if not service.cancel_query(query_id):
+        raise HTTPException(status_code=409, detail=f"Запрос {query_id} не выполняется")
+    return {"query_id": query_id, "status": "cancelling"}
+
+
+@app.post("/sessions/{session_id}/undo")
+async def undo(session_id: str) -> dict:
+    service = app.state.service
+    async with service.lock(session_id):
+        await _leave(service, session_id)
+        meta = await _state(service, session_id, "parent")
+        return await service.io(service.mgr.after_move, session_id, meta)
+
+
+@app.post("/sessions/{session_id}/redo")
+async def redo(session_id: str) -> dict:
+    service = app.state.service
+    async with service.lock(session_id):
+        meta = await _state(service, session_id, "child")
+        return await service.io(service.mgr.after_move, session_id, meta)
+
+
+@app.post("/sessions/{session_id}/checkout/{step}")
+async def checkout(session_id: str, step: int) -> dict:
+    """Any state of the session becomes current, the next query result starts a new branch from it"""
+    service = app.state.service
+    async with service.lock(session_id):
+        await _state(service, session_id)
+        await _leave(service, session_id)
+        meta = await service.state_info(session_id, step)
+        if meta is None:
+            raise HTTPException(status_code=404, detail=f"Шаг {step} не найден")
+        return await service.io(service.mgr.after_move, session_id, meta)
+
+
+@app.get("/sessions/{session_id}/history")
+async def history(session_id: str, step: Optional[int] = None) -> dict:
+    """Branch of the current state (or of step) from the first state, metadata only"""
+    service = app.state.service
+    await _state(service, session_id)
+    branch = await service.scripts.branch(service.mgr.session_keys(session_id), service.mgr.node_prefix(session_id), step)
+    if not branch:
+        raise HTTPException(status_code=404, detail=f"Шаг {step} не найден")
+    return {"branch": branch}
+
+
+@app.get("/sessions/{session_id}/tree")
+async def tree(session_id: str) -> dict:
+    """All states of the session with their parents"""
+    service = app.state.service
+    meta = await _state(service, session_id)
+    return {"head": meta["step"], "nodes": await service.io(service.mgr.tree, session_id)}
+
+
+@app.get("/sessions/{session_id}/lineage")
+async def lineage(session_id: str, column: str, step: Optional[int] = None) -> dict:
+    """Steps of the current branch which added, removed or changed the column"""
+    service = app.state.service
+    await _state(service, session_id)
+    return {"column": column, "steps": await service.io(service.mgr.lineage, session_id, column, step)}
+
+
+@app.put("/sessions/{session_id}/tiering")
+async def set_tiering(session_id: str, request: TieringRequest) -> dict:
+    """Format of hot states of the session ("arrow", "arrow_lz4" or "none") and their amount"""
+    service = app.state.service
+    await _state(service, session_id)
+    try:
+        await service.io(service.mgr.set_tiering, session_id, request.hot_format, request.hot_states)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    hot_format, hot_states = await service.io(service.mgr.tiering, session_id)
+    return {"hot_format": hot_format, "hot_states": hot_states}
+
+
+@app.put("/sessions/{session_id}/retention")
+async def set_retention(session_id: str, request: RetentionRequest) -> dict:
+    """Lifetime of the session without queries and limits of its states, 0 removes a limit"""
+    service = app.state.service
+    await _state(service, session_id)
+    try:
+        await service.io(service.retention.set_policy, session_id, request.ttl_seconds, request.max_steps, request.max_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await service.io(service.retention.policy, session_id)
+
+
+@app.get("/stats")
+async def stats() -> dict:
+    service = app.state.service
+    return {"frame_cache": service.mgr.frame_cache.stats(), "llm_cache": service.mgr.llm_cache_stats,
+            "result_cache": service.mgr.result_cache.stats(),
+            "state_writer": service.mgr.writer.stats() if service.mgr.writer is not None else None,
+            "retention": service.retention.stats(),
+            "tracing": tracing.stats(),
+            "llm_routes": service.router.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> str:
+    """Stage latency and bytes histograms, redis timings and cache counters in Prometheus text format"""
+    return PlainTextResponse(tracing.prometheus_text(), media_type="text/plain; version=0.0.4")
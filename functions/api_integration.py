@@ -1,8 +1,38 @@
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import json
 
+
+def _provider_settings(provider_name: str, config_path: str) -> dict:
+    """
+        Reads base_url and api_key of a provider from the JSON configuration file.
+
+        Raises:
+            ValueError: If the configuration file is not found, the provider is not
+                        in the config, or a required API key is not set.
+    """
+    try:
+        with open(config_path, "r") as file:
+            config_data = json.load(file)
+    except FileNotFoundError:
+        raise ValueError(f"Json файл не найден: {config_path}")
+    if provider_name not in config_data:
+        raise ValueError(f"{provider_name} не найден в списке провайдеров")
+    provider_info = config_data[provider_name]
+    base_url = provider_info.get("base_url")
+    # ключ обязателен для клиента, но провайдер его не проверяет; пробел дает недопустимый заголовок в async клиенте
+    api_key = "unused"
+    if provider_info.get("requires_api_key"):
+        api_key_var = provider_info.get("api_key_env_var")
+        if not api_key_var:
+            raise ValueError(f"{provider_name} не найден в списке API ключей")
+        api_key = os.getenv(api_key_var)
+        if not api_key:
+            raise ValueError(f"{api_key_var} не задан или задан некорректно '{provider_name}'.")
+    return {"base_url": base_url, "api_key": api_key}
+
+
 class LLMClient(OpenAI):
     """
         An OpenAI-compatible client that can be configured to work with different
@@ -13,33 +43,38 @@ class LLMClient(OpenAI):
         for the specified provider.
     """
 
-    def __init__(self, provider_name: str, config_path: str = r"D:\pycharm\pythonProject5\api.json"):
+    def __init__(self, provider_name: str, config_path: str = r"D:\pycharm\pythonProject5\api.json", **kwargs):
         """
         Initializes the client for a specific provider.
         Args:
             provider_name (str): The name of the provider (e.g., "ollama", "openai").
                                  This must correspond to a key in the config file.
             config_path (str): The path to the JSON configuration file.
+            **kwargs: Other arguments of the openai client (timeout, max_retries, http_client).
+
+        Raises:
+            ValueError: If the configuration file is not found, the provider is not
+                        in the config, or a required API key is not set.
+        """
+        super().__init__(**_provider_settings(provider_name, config_path), **kwargs)
+
+
+class AsyncLLMClient(AsyncOpenAI):
+    """
+        Asyncio version of LLMClient, configured from the same JSON file.
+        Requests are awaited, so many sessions can wait for the model in one event loop.
+    """
+
+    def __init__(self, provider_name: str, config_path: str = r"D:\pycharm\pythonProject5\api.json", **kwargs):
+        """
+        Initializes the client for a specific provider.
+        Args:
+            provider_name (str): The name of the provider (e.g., "ollama", "openai").
+            config_path (str): The path to the JSON configuration file.
+            **kwargs: Other arguments of the openai client (timeout, max_retries, http_client).
 
         Raises:
             ValueError: If the configuration file is not found, the provider is not
                         in the config, or a required API key is not set.
         """
-        try:
-            with open(config_path, "r") as file:
-                config_data = json.load(file)
-        except FileNotFoundError:
-            raise ValueError(f"Json файл не найден: {config_path}")
-        if provider_name not in config_data:
-            raise ValueError(f"{provider_name} не найден в списке провайдеров")
-        provider_info = config_data[provider_name]
-        base_url = provider_info.get("base_url")
-        api_key = " "
-        if provider_info.get("requires_api_key"):
-            api_key_var = provider_info.get("api_key_env_var")
-            if not api_key_var:
-                raise ValueError(f"{provider_name} не найден в списке API ключей")
-            api_key = os.getenv(api_key_var)
-            if not api_key:
-                raise ValueError(f"{api_key_var} не задан или задан некорректно '{provider_name}'.")
-        super().__init__(base_url=base_url, api_key=api_key)
\ No newline at end of file
+        super().__init__(**_provider_settings(provider_name, config_path), **kwargs)
@@ -0,0 +1,325 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import tempfile
+from typing import Optional, List, Tuple
+import numpy as np
+import pandas as pd
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Dropping one reference of every chunk, chunks left without references wait in the free zset.
+# KEYS: refs hash, free zset
+# ARGV: time, then digests
+RELEASE_CHUNKS = """
+for i = 2, #ARGV do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -1) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        redis.call('ZADD', KEYS[2], ARGV[1], ARGV[i])
+    end
+end
+return 0
+"""
+
+# Chunks free for longer than the grace period and still without references, they are removed from the zset.
+# KEYS: refs hash, free zset
+# ARGV: oldest release time to collect
+COLLECT_CHUNKS = """
+local result = {}
+for _, digest in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[2], digest)
+    if redis.call('HEXISTS', KEYS[1], digest) == 0 then
+        table.insert(result, digest)
+    end
+end
+return result
+"""
+
+
+def _type_tag(value) -> str:
+    return "str" if isinstance(value, str) else type(value).__name__
+
+
+class ColumnHasher():
+    def __init__(self, dtype):
+        """Incremental column_digest: column can be hashed part by part, result is the same
+        as for the whole column if all parts have the same dtype.
+
+        Args:
+            dtype: pandas dtype of the column
+        """
+        self._h = hashlib.sha256()
+        self._h.update(str(dtype).encode("utf-8"))
+        # types of object cells, hashed apart from values so parts give the same result as the whole column
+        self._tags = hashlib.sha256() if dtype == object else None
+    def update(self, series: pd.Series) -> None:
+        values = series.to_numpy(copy=False) if isinstance(series.dtype, np.dtype) else None
+        if values is not None and values.dtype.kind in "biufcmM":
+            self._h.update(np.ascontiguousarray(values).view(np.uint8).data)
+            return
+        try:
+            hashed = pd.util.hash_pandas_object(series, index=False).to_numpy()
+        except TypeError:
+            # unhashable cells (lists, dicts) - fall back to their text form
+            hashed = pd.util.hash_pandas_object(series.astype(str), index=False).to_numpy()
+        self._h.update(hashed.tobytes())
+        if self._tags is not None:
+            # object cells are hashed by their text, type of every cell tells 1 from "1"
+            tags = np.array([_type_tag(value) for value in series.to_numpy()], dtype=object)
+            self._tags.update(pd.util.hash_array(tags).tobytes())
+    def hexdigest(self) -> str:
+        h = self._h.copy()
+        if self._tags is not None:
+            h.update(self._tags.digest())
+        return h.hexdigest()[:40]
+
+
+def column_digest(series: pd.Series) -> str:
+    """Content hash of a single column. Column name is not part of the hash,
+    so the same data stored under different names is kept only once.
+    Fixed-width numpy columns are hashed as raw memory, others through vectorized hash_pandas_object.
+    hash_pandas_object hashes object cells by their text, so types of object cells are hashed too.
+
+    Args:
+        series (pd.Series): column to hash
+
+    Returns:
+        str: hex digest of dtype and values
+    """
+    hasher = ColumnHasher(series.dtype)
+    hasher.update(series)
+    return hasher.hexdigest()
+
+
+class ChunkRefs():
+    def __init__(self, r, key: str):
+        """Reference counts of column chunks in redis, shared by all processes using the storage folder.
+        Every manifest entry holds one reference. A reference is taken before the chunk is checked
+        on disk, so a chunk being reused is never collected. Chunks without references are removed
+        only after a grace period.
+
+        Args:
+            r (redis.Redis): redis connection
+            key (str): hash of counts of one storage folder, free chunks are in {key}:free
+        """
+        self.r = r
+        self.key = key
+        self.free_key = f"{key}:free"
+        self._release = r.register_script(RELEASE_CHUNKS)
+        self._collect = r.register_script(COLLECT_CHUNKS)
+    def acquire(self, digest: str) -> None:
+        self.r.hincrby(self.key, digest, 1)
+    def release(self, digests: List[str]) -> None:
+        if digests:
+            self._release(keys=[self.key, self.free_key], args=[time.time()] + list(digests))
+    def collect(self, grace_seconds: float) -> List[str]:
+        """Chunks which can be deleted: released more than grace_seconds ago and not taken again"""
+        return list(self._collect(keys=[self.key, self.free_key], args=[time.time() - grace_seconds]))
+    def rebuild(self, manifests: List[str]) -> int:
+        """Counting references from scratch by the manifests on disk (stores from before reference counting)
+
+        Returns:
+            int: amount of referenced chunks
+        """
+        counts = {}
+        for path in manifests:
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    entries = json.load(file)["columns"]
+            except (OSError, ValueError):
+                continue
+            for entry in entries:
+                counts[entry["chunk"]] = counts.get(entry["chunk"], 0) + 1
+        pipe = self.r.pipeline()
+        pipe.delete(self.key)
+        if counts:
+            pipe.hset(self.key, mapping=counts)
+        pipe.set(f"{self.key}:ready", 1)
+        pipe.execute()
+        return len(counts)
+    def ready(self) -> bool:
+        return bool(self.r.exists(f"{self.key}:ready"))
+
+
+class ColumnStore():
+    def __init__(self, storage_dir: str, refs: Optional[ChunkRefs] = None):
+        """Content-addressed storage of dataframe columns. Every column is written once
+        under its hash to {storage_dir}/chunks, a state is a small json manifest with
+        references to these chunks.
+
+        Args:
+            storage_dir (str): folder of MemoryManager where states are saved
+            refs (Optional[ChunkRefs], optional): reference counts, without them chunks are never deleted.
+                Defaults to None.
+        """
+        self.chunk_dir = os.path.join(storage_dir, "chunks")
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self.refs = refs
+    def chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunk_dir, digest[:2], f"{digest}.parquet")
+    @staticmethod
+    def _atomic_write(path: str, writer) -> None:
+        """Writing through temporary file in the same folder, so readers never see half-written file"""
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        os.close(fd)
+        try:
+            writer(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    def write_chunk(self, series: pd.Series, digest: Optional[str] = None) -> str:
+        """Saving one column if chunk with the same content is not stored yet
+
+        Args:
+            series (pd.Series): column to save
+            digest (Optional[str], optional): already computed column_digest. Defaults to None.
+
+        Returns:
+            str: digest of the column
+        """
+        digest = digest or column_digest(series)
+        path = self.chunk_path(digest)
+        if self.refs is not None:
+            self.refs.acquire(digest)
+        if not os.path.exists(path):
+            frame = series.to_frame("v")
+            self._atomic_write(path, lambda tmp: frame.to_parquet(tmp, index=False))
+        return digest
+    def add_chunk_file(self, path: str, digest: str) -> str:
+        """Moving already written parquet file with column "v" to the store
+
+        Args:
+            path (str): written file, it is moved or removed if the same chunk exists
+            digest (str): column_digest of its content
+
+        Returns:
+            str: digest of the column
+        """
+        target = self.chunk_path(digest)
+        if self.refs is not None:
+            self.refs.acquire(digest)
+        if os.path.exists(target):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+        return digest
+    def write(self, df: pd.DataFrame, manifest_path: str, digests: Optional[dict] = None) -> dict:
+        """Saving dataframe as manifest of column chunks
+
+        Args:
+            df (pd.DataFrame): dataframe to save
+            manifest_path (str): path of manifest file
+            digests (Optional[dict], optional): already computed column_digest by column name. Defaults to None.
+
+        Raises:
+            ValueError: if column names are not unique strings (same restriction as in parquet)
+
+        Returns:
+            dict: written manifest
+        """
+        if not df.columns.is_unique:
+            raise ValueError("Column names must be unique to store state by columns")
+        columns = []
+        for name in df.columns:
+            if not isinstance(name, str):
+                raise ValueError(f"Column name must be a string, got {name!r}")
+            columns.append((name, self.write_chunk(df[name], (digests or {}).get(name))))
+        return self.write_manifest(manifest_path, int(df.shape[0]), columns)
+    def write_manifest(self, manifest_path: str, nrows: int, columns: List[tuple]) -> dict:
+        """Saving manifest of already stored chunks. References of the chunks must be taken already,
+        references of a manifest replaced at the same path are released.
+
+        Args:
+            manifest_path (str): path of manifest file
+            nrows (int): amount of rows
+            columns (List[tuple]): (column name, chunk digest) in column order
+
+        Returns:
+            dict: written manifest
+        """
+        manifest = {"nrows": nrows, "columns": [{"name": name, "chunk": digest} for name, digest in columns]}
+        payload = json.dumps(manifest, ensure_ascii=False)
+        def _dump(tmp):
+            with open(tmp, "w", encoding="utf-8") as file:
+                file.write(payload)
+        try:
+            replaced = self.read_manifest(manifest_path)["columns"] if self.refs is not None else []
+        except (OSError, ValueError):
+            replaced = []
+        self._atomic_write(manifest_path, _dump)
+        # new references are taken before the old ones are dropped, shared chunks never reach zero
+        if replaced:
+            self.refs.release([entry["chunk"] for entry in replaced])
+        return manifest
+    @staticmethod
+    def read_manifest(manifest_path: str) -> dict:
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    def read(self, manifest_path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Rebuilding dataframe from shared chunks
+
+        Args:
+            manifest_path (str): path of manifest file
+            columns (Optional[List[str]], optional): read only these columns. Defaults to None (all).
+
+        Raises:
+            FileNotFoundError: if one of the chunks is missing
+
+        Returns:
+            pd.DataFrame: restored dataframe
+        """
+        manifest = self.read_manifest(manifest_path)
+        entries = manifest["columns"]
+        if columns is not None:
+            wanted = set(columns)
+            entries = [entry for entry in entries if entry["name"] in wanted]
+        data = {}
+        for entry in entries:
+            path = self.chunk_path(entry["chunk"])
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Column chunk missing: {path}")
+            data[entry["name"]] = pd.read_parquet(path)["v"]
+        if not data:
+            return pd.DataFrame(index=pd.RangeIndex(manifest["nrows"]))
+        return pd.DataFrame(data)
+    def remove(self, manifest_path: str) -> int:
+        """Deleting manifest of a state and releasing its chunks, chunks are deleted later by collect()
+
+        Returns:
+            int: bytes of the manifest file
+        """
+        manifest = self.read_manifest(manifest_path)
+        size = os.path.getsize(manifest_path)
+        os.remove(manifest_path)
+        if self.refs is not None:
+            self.refs.release([entry["chunk"] for entry in manifest["columns"]])
+        return size
+    def manifests(self) -> List[str]:
+        """Manifests of all states in the storage folder"""
+        return glob.glob(os.path.join(os.path.dirname(self.chunk_dir), "*" + MANIFEST_SUFFIX))
+    def collect(self, grace_seconds: float = 600) -> Tuple[int, int]:
+        """Deleting chunks which lost their last reference more than grace_seconds ago
+
+        Returns:
+            Tuple[int, int]: amount and bytes of deleted chunks
+        """
+        if self.refs is None:
+            return 0, 0
+        removed, freed = 0, 0
+        for digest in self.refs.collect(grace_seconds):
+            path = self.chunk_path(digest)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+        return removed, freed
@@ -0,0 +1,183 @@
+import math
+from typing import Optional, Dict, Tuple
+import numpy as np
+import pandas as pd
+
+# Compaction is storage-only: states are stored and cached with smaller dtypes, code is executed
+# on expand(frame, report columns) with the types the columns had before compaction.
+
+# smallest integer type: keeps the stored plan stable for columns whose values grow a little
+INT_FLOOR = "int32"
+# strings with fewer distinct values than this share of rows (and not more than CATEGORY_MAX_UNIQUE) are compacted
+CATEGORY_MAX_RATIO = 0.5
+CATEGORY_MAX_UNIQUE = 10000
+ARROW_STRING = "string[pyarrow]"
+
+
+def logical_dtype(dtype) -> str:
+    """Type of a column as the user and the model see it: compacted storage types are shown
+    as the types pandas infers from csv (int64, float64, object)"""
+    if isinstance(dtype, pd.CategoricalDtype):
+        return logical_dtype(dtype.categories.dtype)
+    if isinstance(dtype, pd.StringDtype):
+        return "object"
+    if pd.api.types.is_bool_dtype(dtype):
+        return str(dtype)
+    if pd.api.types.is_signed_integer_dtype(dtype) or pd.api.types.is_unsigned_integer_dtype(dtype):
+        return "int64"
+    if pd.api.types.is_float_dtype(dtype):
+        return "float64"
+    return str(dtype)
+
+
+def _int_target(series: pd.Series, floor: str) -> Optional[str]:
+    if not pd.api.types.is_integer_dtype(series.dtype) or len(series) == 0:
+        return None
+    for name in ("int8", "int16", "int32"):
+        if np.dtype(name).itemsize >= np.dtype(floor).itemsize and _int_fits(series, name):
+            return name
+    return None
+
+
+def _int_fits(series: pd.Series, target: str) -> bool:
+    """Squares of the values fit the type, so sums and products of two columns in generated code
+    give the same values as in int64"""
+    if len(series) == 0:
+        return True
+    limit = math.isqrt(int(np.iinfo(target).max))
+    return -limit <= int(series.min()) and int(series.max()) <= limit
+
+
+def _string_target(series: pd.Series, strings: str, rows: int) -> Optional[str]:
+    if series.dtype != object or rows == 0:
+        return None
+    non_null = series.dropna()
+    # mixed columns (numbers among strings) stay object, converting them would change values
+    if len(non_null) == 0 or not all(isinstance(value, str) for value in non_null.head(1000)):
+        return None
+    unique = non_null.nunique()
+    if unique > CATEGORY_MAX_UNIQUE or unique > CATEGORY_MAX_RATIO * rows:
+        return None
+    if not non_null.map(type).eq(str).all():
+        return None
+    return "category" if strings == "category" else ARROW_STRING
+
+
+def _name(dtype) -> str:
+    """dtype name as used in plans: str() of every string dtype is just string, storage is lost"""
+    if isinstance(dtype, pd.StringDtype):
+        return f"string[{dtype.storage}]"
+    return str(dtype)
+
+
+def _fits(series: pd.Series, target: str) -> bool:
+    """Previous choice for the column still holds for its new values"""
+    if _name(series.dtype) == target:
+        return True
+    if target in ("int8", "int16", "int32"):
+        if not pd.api.types.is_integer_dtype(series.dtype):
+            return False
+        return _int_fits(series, target)
+    if target in ("category", ARROW_STRING):
+        non_null = series.dropna()
+        return isinstance(series.dtype, (pd.CategoricalDtype, pd.StringDtype)) or \
+            (series.dtype == object and non_null.map(type).eq(str).all())
+    return False
+
+
+def column_target(values: pd.Series, rows: int, previous: Optional[str] = None, strings: str = "category",
+                  int_floor: str = INT_FLOOR) -> Optional[str]:
+    """Storage type of a column, the choice of previous steps is kept while the values still fit it
+
+    Args:
+        values (pd.Series): the column or, for a column read in parts, a summary with its dtype:
+            minimum and maximum of integers, distinct values of strings
+        rows (int): length of the column
+        previous (Optional[str], optional): storage type of the column in the plan. Defaults to None.
+        strings (str, optional): "category" or "arrow". Defaults to "category".
+        int_floor (str, optional): smallest integer type. Defaults to INT_FLOOR.
+
+    Returns:
+        Optional[str]: storage type or None if the column is not compacted
+    """
+    if previous is not None and _fits(values, previous):
+        return previous
+    return _int_target(values, int_floor) or _string_target(values, strings, rows)
+
+
+def compact(df: pd.DataFrame, plan: Optional[Dict[str, str]] = None, strings: str = "category",
+            int_floor: str = INT_FLOOR) -> Tuple[pd.DataFrame, Dict[str, str], dict]:
+    """Smaller storage types for a state: small integers are downcast, low-cardinality strings become
+    categoricals (or Arrow strings). Floats stay float64, float32 arithmetic would change results of the code.
+    Choices of previous steps are kept while values still fit them, so the same column has the same type
+    across the session.
+
+    Args:
+        df (pd.DataFrame): state
+        plan (Optional[Dict[str, str]], optional): storage type by column from previous steps. Defaults to None.
+        strings (str, optional): "category" or "arrow" for low-cardinality strings. Defaults to "category".
+        int_floor (str, optional): smallest integer type. Defaults to INT_FLOOR.
+
+    Returns:
+        Tuple[pd.DataFrame, Dict[str, str], dict]: compacted frame, plan for the next steps,
+            report with bytes before/after and changed columns
+    """
+    plan = dict(plan or {})
+    before = int(df.memory_usage(index=True, deep=True).sum())
+    changes = {}
+    converted = {}
+    for name in df.columns:
+        series = df[name]
+        key = str(name)
+        target = column_target(series, len(series), plan.get(key), strings, int_floor)
+        if target is None:
+            plan.pop(key, None)
+            continue
+        plan[key] = target
+        if _name(series.dtype) != target:
+            converted[name] = series.astype(target)
+            changes[key] = [_name(series.dtype), target]
+    result = _replace(df, converted)
+    after = int(result.memory_usage(index=True, deep=True).sum())
+    return result, plan, {"bytes_before": before, "bytes_after": after, "bytes_saved": before - after,
+                          "columns": changes}
+
+
+def expand(df: pd.DataFrame, columns: Dict[str, list]) -> pd.DataFrame:
+    """Compacted columns back to the types they had before compaction, the frame generated code is executed on
+
+    Args:
+        df (pd.DataFrame): stored state or columns of it
+        columns (Dict[str, list]): "columns" of the compact() report, name -> [type before, storage type].
+            Only columns still in their storage type are converted, missing ones are skipped.
+
+    Returns:
+        pd.DataFrame: df itself if nothing is converted, otherwise a shallow copy with converted columns
+    """
+    converted = {}
+    for name in df.columns:
+        change = columns.get(str(name))
+        if change is None or not _stored_as(df[name].dtype, change[1]):
+            continue
+        before = change[0]
+        converted[name] = df[name].astype(before if before != "object" else object)
+    return _replace(df, converted)
+
+
+def _stored_as(dtype, target: str) -> bool:
+    """Column still has its storage type. Parquet keeps only "string" in pandas metadata,
+    Arrow strings are read back as python-backed ones"""
+    if target == ARROW_STRING:
+        return isinstance(dtype, pd.StringDtype)
+    return _name(dtype) == target
+
+
+def _replace(df: pd.DataFrame, converted: dict) -> pd.DataFrame:
+    """Shallow copy with converted columns, unchanged columns are shared"""
+    if not converted:
+        return df
+    result = df.copy(deep=False)
+    for name, series in converted.items():
+        result[name] = series
+    return result
+
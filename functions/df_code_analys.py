@@ -1,27 +1,269 @@
 import pandas as pd
+import numpy as np
 import io
 import ast
+import contextlib
+from functions import vectorize, tracing
 #df = pd.read_csv(r"C:\Users\tviva\Desktop\Titanic-Dataset.csv")
+@tracing.traced("pd_getinfo")
 def pd_getinfo(df: pd.DataFrame):
     """
     Function for briefly data analys
     :param df: current df user working with
     :return: info_string: df.info()
-             sample: df.sample(5)
+             sample: df.head(5), first rows keep the prompt the same for the same df
     """
     buffer = io.StringIO()
     df.info(buf=buffer)
     info_string = buffer.getvalue()
-    sample = df.sample(5).to_string()
+    sample = df.head(5).to_string()
     result = info_string + sample
     return result
 #print(pd_getinfo(df))
-def normalize_and_execute_code(code_string: str, dataframe: pd.DataFrame):
+def _str_keys(node):
+    """Column names from subscript key: 'A' or ['A', 'B']. None for anything else"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return [node.value]
+    if isinstance(node, (ast.List, ast.Tuple)) and node.elts and all(
+            isinstance(elt, ast.Constant) and isinstance(elt.value, str) for elt in node.elts):
+        return [elt.value for elt in node.elts]
+    return None
+def _is_mask(node) -> bool:
+    """Row filter expression like df['Age'] > 30 or (a) & (b)"""
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Invert, ast.Not)):
+        return True
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr, ast.BitXor)):
+        return True
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return node.func.attr in ("isin", "between", "isna", "notna", "isnull", "notnull")
+    return False
+def _selected_columns(node, parents):
+    """Columns selected right after node: node['A'], node[['A', 'B']] or node.A"""
+    parent = parents.get(node)
+    if isinstance(parent, ast.Subscript) and parent.value is node and isinstance(parent.ctx, ast.Load):
+        return _str_keys(parent.slice)
+    if isinstance(parent, ast.Attribute) and parent.value is node and isinstance(parent.ctx, ast.Load):
+        if not hasattr(pd.DataFrame, parent.attr):
+            return [parent.attr]
+    return None
+def referenced_columns(code_string: str):
+    """
+    Static analysis of generated code to find columns of df it reads.
+    Every use of df must select columns by constant names: df['A'], df[['A', 'B']], df.A,
+    df[<mask>]['A'] or df.groupby('A')['B']. Then the code gives the same result on a frame
+    with only these columns.
+    :param code_string: evaluted code by LLM
+    :return: list of column names or None if code needs the whole df
+             (dynamic access like df[var], df.columns, df.describe(), changes of df)
+    """
+    try:
+        tree = ast.parse(code_string.strip())
+    except SyntaxError:
+        return None
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+    columns = []
+    def add(names):
+        for name in names:
+            if name not in columns:
+                columns.append(name)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.keyword) and node.arg == "inplace":
+            return None
+        if not (isinstance(node, ast.Name) and node.id == "df"):
+            continue
+        if not isinstance(node.ctx, ast.Load):
+            return None
+        parent = parents.get(node)
+        selected = _selected_columns(node, parents)
+        if selected is not None:
+            add(selected)
+            continue
+        if isinstance(parent, ast.Subscript) and parent.value is node and _is_mask(parent.slice):
+            # df[mask] keeps all columns, allowed only if columns are selected after it
+            selected = _selected_columns(parent, parents)
+            if selected is not None:
+                add(selected)
+                continue
+        if isinstance(parent, ast.Attribute) and parent.attr == "groupby":
+            call = parents.get(parent)
+            if isinstance(call, ast.Call) and call.func is parent:
+                by = call.args[0] if call.args else next((kw.value for kw in call.keywords if kw.arg == "by"), None)
+                keys = _str_keys(by) if by is not None else None
+                selected = _selected_columns(call, parents)
+                if keys is not None and selected is not None:
+                    add(keys)
+                    add(selected)
+                    continue
+        return None
+    return columns or None
+# methods that change their object in place even without inplace=True
+_INPLACE_METHODS = {"insert", "pop", "update", "sort", "fill", "put", "resize", "itemset", "setflags",
+                    "__setitem__", "__delitem__", "__setattr__"}
+# names which give access to arbitrary methods or functions, their use is never read-only
+_UNSAFE_NAMES = {"setattr", "delattr", "getattr", "exec", "eval", "compile", "globals", "locals", "vars",
+                 "__import__", "operator", "functools", "object", "type"}
+# functions which may get df (or data taken from it) as argument without changing it
+_SAFE_FUNCTIONS = {"len", "list", "tuple", "set", "dict", "sorted", "reversed", "sum", "min", "max", "abs", "round",
+                   "str", "int", "float", "bool", "repr", "zip", "enumerate", "range", "any", "all", "isinstance",
+                   "map", "filter", "iter", "next"}
+_SAFE_MODULE_FUNCTIONS = {
+    "pd": {"concat", "merge", "merge_asof", "crosstab", "pivot_table", "cut", "qcut", "to_datetime", "to_numeric",
+           "to_timedelta", "isna", "isnull", "notna", "notnull", "DataFrame", "Series", "Index", "get_dummies",
+           "factorize", "unique", "melt", "wide_to_long"},
+    "np": {"where", "select", "log", "log1p", "log2", "log10", "exp", "sqrt", "abs", "absolute", "round", "floor",
+           "ceil", "sign", "mean", "median", "sum", "std", "var", "min", "max", "percentile", "quantile", "corrcoef",
+           "cov", "unique", "isnan", "isfinite", "isin", "clip", "array", "asarray", "arange", "diff", "cumsum",
+           "maximum", "minimum", "histogram", "argmax", "argmin", "sort", "argsort", "nan_to_num", "power"},
+}
+def _names(node) -> set:
+    return {sub.id for sub in ast.walk(node) if isinstance(sub, ast.Name)}
+def is_read_only(code_string: str) -> bool:
+    """
+    Static check that generated code never changes df in place, so it can run without df.copy().
+    Unknown cases are considered as changing: assignment to df[...], df.loc[...], attributes,
+    del, inplace=True, out=..., in-place methods (insert, pop, update, ...), augmented
+    assignment to variables taken from df (they can be views of its arrays), imports, getattr / operator,
+    and functions not known to be safe called with df or data taken from it.
+    :param code_string: evaluted code by LLM
+    :return: True if code is provably read-only
+    """
+    try:
+        tree = ast.parse(code_string.strip())
+    except SyntaxError:
+        return False
+    # variables which can point to df data: x = df['A'], for row in df.itertuples(), ...
+    tainted = {"df"}
+    # parameters of lambdas and functions get rows, columns or groups of df in apply / agg / pipe
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Lambda, ast.FunctionDef, ast.AsyncFunctionDef)):
+            tainted |= {arg.arg for arg in node.args.args + node.args.kwonlyargs + node.args.posonlyargs}
+    changed = True
+    while changed:
+        changed = False
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Assign, ast.AnnAssign, ast.NamedExpr)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                source = node.value
+            elif isinstance(node, (ast.For, ast.comprehension)):
+                targets, source = [node.target], node.iter
+            else:
+                continue
+            if source is None or not (_names(source) & tainted):
+                continue
+            for target in targets:
+                new_names = _names(target) - tainted
+                if new_names:
+                    tainted |= new_names
+                    changed = True
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Delete, ast.Import, ast.ImportFrom, ast.Global, ast.Nonlocal)):
+            return False
+        if isinstance(node, ast.Name) and node.id in _UNSAFE_NAMES:
+            return False
+        if isinstance(node, ast.Attribute) and node.attr.startswith("__"):
+            return False
+        if isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign, ast.For, ast.With)):
+            if isinstance(node, ast.Assign):
+                targets = node.targets
+            elif isinstance(node, ast.With):
+                targets = [item.optional_vars for item in node.items if item.optional_vars is not None]
+            else:
+                targets = [node.target]
+            for target in targets:
+                if any(isinstance(sub, (ast.Subscript, ast.Attribute)) for sub in ast.walk(target)):
+                    return False
+            if isinstance(node, ast.AugAssign) and node.target.id in tainted:
+                return False
+        if isinstance(node, ast.keyword) and node.arg in ("inplace", "out"):
+            if not (isinstance(node.value, ast.Constant) and node.value.value in (False, None)):
+                return False
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute) and node.func.attr in _INPLACE_METHODS:
+                return False
+            arguments = list(node.args) + [keyword.value for keyword in node.keywords]
+            if any(_names(argument) & tainted for argument in arguments) and not _safe_function(node.func):
+                return False
+    return True
+def _safe_function(func) -> bool:
+    """Function which does not change its arguments: known builtins and functions of pd / np,
+    methods of objects (in-place methods are checked separately)"""
+    if isinstance(func, ast.Name):
+        return func.id in _SAFE_FUNCTIONS
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in _SAFE_MODULE_FUNCTIONS:
+        return func.attr in _SAFE_MODULE_FUNCTIONS[func.value.id]
+    # np.random.shuffle(x), pd.api...: only one level of module functions is known
+    return isinstance(func, ast.Attribute) and not (isinstance(func.value, ast.Attribute)
+                                                    and isinstance(func.value.value, ast.Name)
+                                                    and func.value.value.id in _SAFE_MODULE_FUNCTIONS)
+# methods and attributes whose result changes from run to run: df.sample(), np.random.*, Timestamp.now(), ...
+_NONDETERMINISTIC_ATTRS = {"sample", "random", "now", "today", "utcnow", "shuffle", "permutation", "default_rng"}
+_NONDETERMINISTIC_NAMES = {"random", "datetime", "time", "uuid", "secrets", "os"}
+def is_deterministic(code_string: str) -> bool:
+    """
+    Static check that generated code gives the same result on the same df, so its result can be cached.
+    Random sampling, random numbers, current date and time (also pd.to_datetime('now')) are not.
+    :param code_string: evaluted code by LLM
+    :return: True if no source of randomness or time is found
+    """
+    try:
+        tree = ast.parse(code_string.strip())
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr in _NONDETERMINISTIC_ATTRS:
+            return False
+        if isinstance(node, ast.Name) and node.id in _NONDETERMINISTIC_NAMES:
+            return False
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and \
+                node.value.strip().lower() in ("now", "today"):
+            return False
+    return True
+def _copy_on_write():
+    """Context with pandas Copy-on-Write mode or None if pandas does not have it"""
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return contextlib.nullcontext()
+    try:
+        pd.get_option("mode.copy_on_write")
+    except (KeyError, pd.errors.OptionError):
+        return None
+    return pd.option_context("mode.copy_on_write", True)
+def projected_columns(code_string: str):
+    """
+    Columns of df read-only code can be executed on instead of the whole df. Such code gives
+    the same result on the projection, also when the result is a DataFrame, so it is executed once.
+    :param code_string: evaluted code by LLM
+    :return: list of column names or None if code needs the whole df: it changes df (its result
+             is the new state), reads df dynamically or does not set result (df itself would be returned)
+    """
+    if not is_read_only(code_string):
+        return None
+    tree = ast.parse(code_string.strip())
+    sets_result = (len(tree.body) == 1 and isinstance(tree.body[0], ast.Expr)) or any(
+        isinstance(node, ast.Name) and node.id == "result" and isinstance(node.ctx, ast.Store)
+        for statement in tree.body if isinstance(statement, (ast.Assign, ast.AnnAssign))
+        for node in ast.walk(statement))
+    return referenced_columns(code_string) if sets_result else None
+@tracing.traced("execute")
+def normalize_and_execute_code(code_string: str, dataframe: pd.DataFrame, report: dict = None,
+                               optimize: bool = True):
     """
     Code normalization by adding `result = ...` to one string
     and compile as exec.
+    Slow idioms (iterrows, apply(axis=1), loops over df.index, pd.concat in loop) are rewritten
+    into vector forms when the result on the first rows of df is the same.
+    Read-only code gets a shallow copy of df under Copy-on-Write when pandas supports it, other code
+    gets full df.copy(): Copy-on-Write would silently drop chained and inplace writes
+    (df['a'].fillna(0, inplace=True)) and make df['a'].values read-only.
     :param code_string: evaluted code by LLM
     :param dataframe: current df user working with
+    :param report: optional dict, filled with execution details ("path": readonly / copy,
+                   "vectorize": rewrites and speedup on the sample)
+    :param optimize: rewrite slow idioms
     :return: result or df depending on what code was generated
     """
     print(f"--- Исходный код от LLM ---\n{code_string}\n")
@@ -37,12 +279,41 @@ def normalize_and_execute_code(code_string: str, dataframe: pd.DataFrame):
     except SyntaxError:
         print(">>> Анализ: Не удалось разобрать код, будет выполнен как есть.")
 
+    if optimize:
+        vectorize_report = {}
+        corrected_code = vectorize.optimize(corrected_code, dataframe, vectorize_report)
+        if vectorize_report:
+            rewrites = ", ".join(vectorize_report["rewrites"])
+            if vectorize_report["applied"]:
+                print(f">>> Векторизация: {rewrites}, ускорение на {vectorize_report['sample_rows']} строках "
+                      f"x{vectorize_report['speedup']:.1f}")
+            elif vectorize_report["equivalent"]:
+                print(f">>> Векторизация ({rewrites}) не ускорила код, выполняется исходный код.")
+            else:
+                print(f">>> Векторизация ({rewrites}) дала другой результат, выполняется исходный код.")
+            if report is not None:
+                report["vectorize"] = vectorize_report
+
     print(f"\n--- Код для выполнения ---\n{corrected_code}\n")
 
+    read_only = is_read_only(corrected_code)
+    path = "readonly" if read_only else "copy"
+    cow = _copy_on_write() if read_only else None
+    print(f">>> Режим выполнения: {path}")
+    tracing.current().set(path=path, rows=len(dataframe))
+    if report is not None:
+        report["path"] = path
+
     try:
-        df_copy = dataframe.copy()
-        local_scope = {'df': df_copy, 'pd': pd}
-        exec(corrected_code, {}, local_scope)
+        with cow if cow is not None else contextlib.nullcontext():
+            if read_only:
+                # shallow copy even for read-only code: a missed mutation (new column, setattr)
+                # must not reach the cached frame of the state, with Copy-on-Write values are protected too
+                df_copy = dataframe.copy(deep=False)
+            else:
+                df_copy = dataframe.copy()
+            local_scope = {'df': df_copy, 'pd': pd, 'np': np}
+            exec(corrected_code, {}, local_scope)
 
         if 'result' in local_scope:
             result = local_scope['result']
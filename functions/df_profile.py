@@ -0,0 +1,200 @@
+from typing import Optional, Dict, Callable
+import pandas as pd
+import pyarrow.parquet as pq
+from functions.compaction import logical_dtype
+
+SAMPLE_ROWS = 5
+
+
+def _jsonable(value):
+    """Statistics values from numpy / parquet to plain json values"""
+    if value is None:
+        return None
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _has_range(dtype) -> bool:
+    """min/max is shown only for numbers and dates, for strings it says nothing useful"""
+    if pd.api.types.is_bool_dtype(dtype):
+        return False
+    return pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype)
+
+
+def footer_stats(metadata: pq.FileMetaData, column_name: str) -> Optional[dict]:
+    """Non-null count, min and max of a column from parquet footer, without reading the data
+
+    Args:
+        metadata (pq.FileMetaData): footer of parquet file
+        column_name (str): column in the file
+
+    Returns:
+        Optional[dict]: statistics or None if the file has no statistics for the column
+    """
+    nulls = 0
+    mins, maxs = [], []
+    has_range = True
+    for rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(rg)
+        column = next((row_group.column(i) for i in range(row_group.num_columns)
+                       if row_group.column(i).path_in_schema == column_name), None)
+        if column is None or column.statistics is None or not column.statistics.has_null_count:
+            return None
+        stats = column.statistics
+        nulls += stats.null_count
+        if stats.has_min_max:
+            mins.append(stats.min)
+            maxs.append(stats.max)
+        elif stats.num_values:
+            has_range = False
+    result = {"non_null": int(metadata.num_rows - nulls), "min": None, "max": None}
+    if has_range and mins:
+        result["min"] = _jsonable(min(mins))
+        result["max"] = _jsonable(max(maxs))
+    return result
+
+
+def _scan_stats(series: pd.Series) -> dict:
+    """Statistics of a column computed from the data itself"""
+    result = {"non_null": int(series.notna().sum()), "min": None, "max": None}
+    if _has_range(series.dtype) and result["non_null"]:
+        result["min"] = _jsonable(series.min())
+        result["max"] = _jsonable(series.max())
+    return result
+
+
+def build_profile(df: pd.DataFrame, digests: Dict[str, str], footer: Optional[Callable] = None,
+                  previous: Optional[dict] = None) -> dict:
+    """Profile of dataframe state for the prompt. Columns with the same content hash as in previous
+    profile are reused, others take statistics from parquet footer and only without it scan the data.
+
+    Args:
+        df (pd.DataFrame): dataframe of the state
+        digests (Dict[str, str]): content hash of every column
+        footer (Optional[Callable], optional): function column name -> (parquet metadata, column name in file)
+            or None if the column has no parquet file. Defaults to None.
+        previous (Optional[dict], optional): profile of previous state. Defaults to None.
+
+    Returns:
+        dict: json-serializable profile
+    """
+    reuse = {}
+    if previous:
+        reuse = {col["digest"]: col for col in previous.get("columns", [])}
+    columns = []
+    for name in df.columns:
+        series = df[name]
+        columns.append(_column_entry(name, series.dtype, digests.get(name), reuse, footer,
+                                     lambda series=series: _scan_stats(series)))
+    return {
+        "nrows": int(df.shape[0]),
+        "ncols": int(df.shape[1]),
+        "columns": columns,
+        "memory_usage": int(df.memory_usage(index=True, deep=False).sum()),
+        "sample": df.head(SAMPLE_ROWS).to_string(),
+        "head": _head_values(df)
+    }
+
+
+def build_profile_from_parquet(metadata: pq.FileMetaData, dtypes: Dict[str, object], digests: Dict[str, str],
+                               footer: Callable, sample: pd.DataFrame) -> dict:
+    """Profile of a state which was never loaded as a whole dataframe, all statistics come from footers
+
+    Args:
+        metadata (pq.FileMetaData): footer of the state file, gives amount of rows and size
+        dtypes (Dict[str, object]): pandas dtype of every column as it will be loaded
+        digests (Dict[str, str]): content hash of every column
+        footer (Callable): function column name -> (parquet metadata, column name in file)
+        sample (pd.DataFrame): first rows of the state
+
+    Returns:
+        dict: json-serializable profile
+    """
+    def no_stats():
+        return {"non_null": None, "min": None, "max": None}
+    columns = [_column_entry(name, dtype, digests.get(name), {}, footer, no_stats) for name, dtype in dtypes.items()]
+    size = sum(metadata.row_group(rg).total_byte_size for rg in range(metadata.num_row_groups))
+    return {
+        "nrows": int(metadata.num_rows),
+        "ncols": len(columns),
+        "columns": columns,
+        "memory_usage": int(size),
+        "sample": sample.head(SAMPLE_ROWS).to_string(),
+        "head": _head_values(sample)
+    }
+
+
+def _head_values(df: pd.DataFrame) -> Dict[str, list]:
+    """First values of every column, so a summary can show sample of selected columns only"""
+    head = df.head(SAMPLE_ROWS)
+    return {str(name): [None if pd.api.types.is_scalar(value) and pd.isna(value) else _jsonable(value)
+                        for value in head[name].tolist()]
+            for name in head.columns}
+
+
+def _column_entry(name, dtype, digest: Optional[str], reuse: dict, footer: Optional[Callable], scan: Callable) -> dict:
+    """Statistics of one column: from previous profile by content hash, from parquet footer or from scan"""
+    old = reuse.get(digest)
+    if old is not None and old.get("dtype") == str(dtype):
+        stats = {key: old[key] for key in ("non_null", "min", "max")}
+    else:
+        stats = None
+        source = footer(name) if footer is not None else None
+        if source is not None:
+            stats = footer_stats(*source)
+            if stats is not None and not _has_range(dtype):
+                stats["min"] = stats["max"] = None
+        if stats is None:
+            stats = scan()
+    entry = {"name": str(name), "dtype": str(dtype), "digest": digest, **stats}
+    if logical_dtype(dtype) != str(dtype):
+        # compacted storage type, prompt shows the type the column has for the user
+        entry["logical"] = logical_dtype(dtype)
+    return entry
+
+
+def shown_dtype(col: dict) -> str:
+    """Type of a profile column for the prompt: logical type of compacted columns, dtype of others"""
+    return col.get("logical", col["dtype"])
+
+
+def render_profile(profile: dict) -> str:
+    """Text of profile in the form of df.info() with min/max and first rows of the state
+
+    Args:
+        profile (dict): profile from build_profile
+
+    Returns:
+        str: text for the prompt
+    """
+    nrows = profile["nrows"]
+    lines = ["<class 'pandas.core.frame.DataFrame'>"]
+    if nrows:
+        lines.append(f"RangeIndex: {nrows} entries, 0 to {nrows - 1}")
+    else:
+        lines.append("RangeIndex: 0 entries")
+    lines.append(f"Data columns (total {profile['ncols']} columns):")
+    rows = [(" #", "Column", "Non-Null Count", "Dtype", "Min", "Max"),
+            ("---", "------", "--------------", "-----", "---", "---")]
+    for i, col in enumerate(profile["columns"]):
+        non_null = "" if col["non_null"] is None else f"{col['non_null']} non-null"
+        rows.append((f" {i}", col["name"], non_null, shown_dtype(col),
+                     "" if col["min"] is None else str(col["min"]),
+                     "" if col["max"] is None else str(col["max"])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    dtypes = {}
+    for col in profile["columns"]:
+        dtypes[shown_dtype(col)] = dtypes.get(shown_dtype(col), 0) + 1
+    lines.append("dtypes: " + ", ".join(f"{dtype}({count})" for dtype, count in sorted(dtypes.items())))
+    size = float(profile["memory_usage"])
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    lines.append(f"memory usage: {size:.1f}+ {unit}")
+    return "\n".join(lines) + "\n" + profile["sample"]
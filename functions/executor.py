@@ -0,0 +1,245 @@
+import os
+import time
+import uuid
+import queue
+import pickle
+import tempfile
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Any
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+try:
+    import resource
+except ImportError:  # Windows, memory limit is not available
+    resource = None
+
+
+class SandboxError(RuntimeError):
+    """Worker crashed or job was cancelled"""
+
+
+class SandboxTimeout(TimeoutError):
+    """Job did not finish in its wall-clock limit"""
+
+
+def _exchange_dir() -> str:
+    """Folder for Arrow files passed between processes, shared memory if the system has it"""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+# first bytes of every Arrow IPC file
+ARROW_MAGIC = b"ARROW1"
+
+
+def write_ipc(df: pd.DataFrame, path: str) -> None:
+    """Saving dataframe as uncompressed Arrow IPC file. Frames Arrow can not convert
+    (object columns with numbers among strings, arbitrary python objects) are pickled instead"""
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowTypeError, pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        with open(path, "wb") as sink:
+            pickle.dump(df, sink, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+    with pa.OSFile(path, "wb") as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_ipc(path: str) -> pd.DataFrame:
+    """Reading Arrow IPC file through memory map, without decoding step, or a pickled frame of write_ipc"""
+    with open(path, "rb") as source:
+        if source.read(len(ARROW_MAGIC)) != ARROW_MAGIC:
+            source.seek(0)
+            return pickle.load(source)
+    source = pa.memory_map(path, "r")
+    return ipc.open_file(source).read_all().to_pandas()
+
+
+def _set_memory_limit(limit: Optional[int]) -> None:
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (limit if limit else hard, hard))
+
+
+def _worker_main(conn) -> None:
+    """Loop of a sandbox process: pandas is imported once, then jobs are taken from the pipe"""
+    from functions import df_code_analys
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        code, in_path, out_path, memory_limit = job
+        try:
+            _set_memory_limit(memory_limit)
+            df = read_ipc(in_path)
+            result = df_code_analys.normalize_and_execute_code(code, df)
+            del df
+            if isinstance(result, pd.DataFrame):
+                write_ipc(result, out_path)
+                reply = ("frame", out_path)
+            else:
+                try:
+                    pickle.dumps(result)
+                    reply = ("value", result)
+                except Exception:
+                    reply = ("value", repr(result))
+        except MemoryError:
+            reply = ("error", "memory limit exceeded")
+        except Exception as e:
+            reply = ("error", str(e))
+        finally:
+            _set_memory_limit(None)
+        conn.send(reply)
+
+
+class _Worker():
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class SandboxJob():
+    def __init__(self):
+        """Handle of submitted job, result() waits for it, cancel() stops it even while running"""
+        self.future = None
+        self._cancelled = threading.Event()
+    def cancel(self) -> None:
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+    def done(self) -> bool:
+        return self.future.done()
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout)
+
+
+class SandboxExecutor():
+    def __init__(self, workers: Optional[int] = None, timeout: float = 60.0, memory_limit: Optional[int] = None):
+        """Pool of pre-warmed processes for running generated code outside of the main process.
+        Dataframe goes to a worker as Arrow IPC file in shared memory, worker reads it through memory map.
+        A job that runs too long or is cancelled kills its worker, a fresh one takes its place.
+
+        Args:
+            workers (Optional[int], optional): amount of processes. Defaults to number of cpu.
+            timeout (float, optional): default wall-clock limit of a job in seconds. Defaults to 60.
+            memory_limit (Optional[int], optional): default address space limit of a worker in bytes,
+                works only on unix. Defaults to None (no limit).
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.exchange_dir = _exchange_dir()
+        self._ctx = mp.get_context("spawn")
+        self._idle = queue.Queue()
+        for _ in range(self.workers):
+            self._idle.put(_Worker(self._ctx))
+        self._dispatchers = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sandbox")
+    def submit(self, code: str, df: pd.DataFrame, timeout: Optional[float] = None,
+               memory_limit: Optional[int] = None) -> SandboxJob:
+        """Putting code to the queue of the pool
+
+        Args:
+            code (str): code generated by llm
+            df (pd.DataFrame): current df user working with
+            timeout (Optional[float], optional): wall-clock limit in seconds. Defaults to pool timeout.
+            memory_limit (Optional[int], optional): memory limit in bytes. Defaults to pool limit.
+
+        Raises:
+            SandboxError: if df can not be passed to the worker
+
+        Returns:
+            SandboxJob: handle of the job
+        """
+        job = SandboxJob()
+        in_path = os.path.join(self.exchange_dir, f"sandbox_{uuid.uuid4().hex}.arrow")
+        try:
+            write_ipc(df, in_path)
+        except Exception as e:
+            self._remove(in_path)
+            raise SandboxError(f"dataframe can not be passed to sandbox: {e}") from e
+        job.future = self._dispatchers.submit(self._run_job, job, code, in_path,
+                                              timeout if timeout is not None else self.timeout,
+                                              memory_limit if memory_limit is not None else self.memory_limit)
+        job.future.add_done_callback(lambda _: self._remove(in_path))
+        return job
+    def run(self, code: str, df: pd.DataFrame, timeout: Optional[float] = None,
+            memory_limit: Optional[int] = None) -> Any:
+        """Same as normalize_and_execute_code, but in a sandbox process
+
+        Raises:
+            SandboxTimeout: if job runs longer than timeout
+            SandboxError: if worker crashed or job was cancelled
+
+        Returns:
+            Any: result or df depending on what code was generated
+        """
+        return self.submit(code, df, timeout=timeout, memory_limit=memory_limit).result()
+    def _run_job(self, job: SandboxJob, code: str, in_path: str, timeout: float, memory_limit: Optional[int]) -> Any:
+        if job.cancelled():
+            raise SandboxError("job cancelled")
+        worker = self._idle.get()
+        out_path = in_path[:-len(".arrow")] + "_result.arrow"
+        healthy = False
+        try:
+            worker.conn.send((code, in_path, out_path, memory_limit))
+            started = time.monotonic()
+            while not worker.conn.poll(0.05):
+                if job.cancelled():
+                    raise SandboxError("job cancelled")
+                if timeout and time.monotonic() - started >= timeout:
+                    raise SandboxTimeout(f"code did not finish in {timeout} s")
+                if not worker.process.is_alive():
+                    raise SandboxError(f"sandbox process died with code {worker.process.exitcode}")
+            try:
+                kind, payload = worker.conn.recv()
+            except EOFError:
+                raise SandboxError(f"sandbox process died with code {worker.process.exitcode}")
+            healthy = True
+            if kind == "error":
+                raise SandboxError(payload)
+            if kind == "frame":
+                return read_ipc(payload)
+            return payload
+        finally:
+            self._remove(out_path)
+            if healthy:
+                self._idle.put(worker)
+            else:
+                worker.kill()
+                self._idle.put(_Worker(self._ctx))
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    def shutdown(self) -> None:
+        """Stopping dispatchers and all worker processes"""
+        self._dispatchers.shutdown(wait=True, cancel_futures=True)
+        while not self._idle.empty():
+            worker = self._idle.get()
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.kill()
@@ -0,0 +1,126 @@
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, List
+import numpy as np
+import pandas as pd
+from functions.column_store import column_digest
+
+
+def frame_fingerprint(df: pd.DataFrame, digests: Dict[str, str]) -> str:
+    """Hash of the whole dataframe content: column names, dtypes, shape and hash of every column
+
+    Args:
+        df (pd.DataFrame): dataframe
+        digests (Dict[str, str]): column_digest of every column
+
+    Returns:
+        str: sha256 hex digest
+    """
+    return fingerprint_parts(df.shape[0], list(zip(df.columns, df.dtypes)), digests)
+
+
+def fingerprint_parts(nrows: int, dtypes: List[tuple], digests: Dict[str, str]) -> str:
+    """frame_fingerprint for a state known only by its description, without the dataframe itself
+
+    Args:
+        nrows (int): amount of rows
+        dtypes (List[tuple]): (column name, dtype) in column order
+        digests (Dict[str, str]): column_digest of every column
+
+    Returns:
+        str: sha256 hex digest
+    """
+    h = hashlib.sha256()
+    h.update(f"{nrows}x{len(dtypes)}".encode("utf-8"))
+    for name, dtype in dtypes:
+        h.update(f"||{name}|{dtype}|{digests[name]}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _root(arr: np.ndarray) -> np.ndarray:
+    while isinstance(arr.base, np.ndarray):
+        arr = arr.base
+    return arr
+
+
+def _buffer_of(series: pd.Series) -> Optional[tuple]:
+    """Memory of column values: (array owning the memory, key of the exact view).
+    Only numpy and categorical columns, other extension arrays are always hashed again."""
+    if isinstance(series.dtype, np.dtype):
+        arr = series.to_numpy(copy=False)
+        dtype = arr.dtype.str
+    elif isinstance(series.dtype, pd.CategoricalDtype):
+        arr = series.array.codes
+        categories = pd.util.hash_pandas_object(series.dtype.categories, index=False).to_numpy()
+        dtype = "category:" + hashlib.blake2b(categories.tobytes(), digest_size=8).hexdigest()
+    else:
+        return None
+    if not isinstance(arr, np.ndarray):
+        return None
+    key = (arr.__array_interface__["data"][0], arr.strides, arr.shape, dtype)
+    return _root(arr), key
+
+
+class DigestMemo():
+    def __init__(self, max_entries: int = 10000):
+        """Column hashes remembered by the memory they were computed from. A column which still
+        points to the same buffer (unchanged column of the next state, frame from the cache) is not
+        hashed again. Saved states are never changed in place, so same buffer means same content.
+        Entry lives only while the array owning the memory is alive, so the address cannot be reused.
+
+        Args:
+            max_entries (int, optional): amount of remembered columns. Defaults to 10000.
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def get(self, series: pd.Series) -> Optional[str]:
+        buffer = _buffer_of(series)
+        if buffer is None:
+            return None
+        root, key = buffer
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0]() is not root:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    def remember(self, series: pd.Series, digest: str) -> None:
+        buffer = _buffer_of(series)
+        if buffer is None:
+            return
+        root, key = buffer
+        try:
+            ref = weakref.ref(root)
+        except TypeError:
+            return
+        with self._lock:
+            self._entries[key] = (ref, digest)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    def digests(self, df: pd.DataFrame) -> Dict[str, str]:
+        """column_digest of every column, taken from memo where possible
+
+        Args:
+            df (pd.DataFrame): dataframe
+
+        Returns:
+            Dict[str, str]: column name -> digest
+        """
+        result = {}
+        for name in df.columns:
+            series = df[name]
+            digest = self.get(series)
+            if digest is None:
+                self.misses += 1
+                digest = column_digest(series)
+                self.remember(series, digest)
+            else:
+                self.hits += 1
+            result[name] = digest
+        return result
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+import pandas as pd
+from functions import tracing
+
+
+class FrameCache():
+    def __init__(self, max_bytes: int = 1024 ** 3):
+        """Process-local LRU cache of decoded dataframes, so undo/redo between recent states
+        does not read parquet again. Size of a frame is measured with memory_usage(deep=True).
+
+        Args:
+            max_bytes (int, optional): memory budget of the cache, 0 disables it. Defaults to 1 GiB.
+        """
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    @staticmethod
+    def frame_size(df: pd.DataFrame) -> int:
+        return int(df.memory_usage(index=True, deep=True).sum())
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        """Getting frame from cache and marking it as recently used
+
+        Args:
+            key (str): state filename
+
+        Returns:
+            Optional[pd.DataFrame]: shallow copy of cached frame or None
+        """
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is None:
+                self.misses += 1
+                tracing.cache_event("frame", "miss")
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+        tracing.cache_event("frame", "hit")
+        # shallow copy: adding or dropping columns by the caller does not touch cached frame
+        return entry[0].copy(deep=False)
+    def put(self, key: str, df: pd.DataFrame) -> bool:
+        """Saving frame to cache and evicting least recently used frames over the budget.
+        Cached frames are treated as immutable, callers must not change values in place.
+
+        Args:
+            key (str): state filename
+            df (pd.DataFrame): decoded dataframe
+
+        Returns:
+            bool: False if frame alone does not fit into the budget
+        """
+        if self.max_bytes <= 0:
+            return False
+        size = self.frame_size(df)
+        if size > self.max_bytes:
+            self.invalidate(key)
+            return False
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._frames[key] = (df, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._frames.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+        return True
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            entry = self._frames.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self.current_bytes = 0
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "frames": len(self._frames),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes
+            }
@@ -0,0 +1,316 @@
+import io
+import os
+import re
+import uuid
+from typing import Optional, Callable, Dict, Tuple
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from functions import compaction
+from functions.column_store import ColumnHasher, ColumnStore
+
+
+class _CountingReader(io.RawIOBase):
+    def __init__(self, raw, callback: Callable[[int], None]):
+        """File wrapper reporting every read, used for progress of csv reading"""
+        self._raw = raw
+        self._callback = callback
+    def readable(self) -> bool:
+        return True
+    def readinto(self, buffer) -> int:
+        n = self._raw.readinto(buffer)
+        if n:
+            self._callback(n)
+        return n
+    def close(self) -> None:
+        self._raw.close()
+        super().close()
+
+
+def tqdm_progress(total: int) -> Callable[[int, int], None]:
+    """Progress callback drawing tqdm bar in bytes of csv file"""
+    from tqdm import tqdm
+    bar = tqdm(total=total, unit="B", unit_scale=True, desc="csv")
+    def callback(done: int, total: int) -> None:
+        bar.update(done - bar.n)
+        if done >= total:
+            bar.close()
+    return callback
+
+
+# error of arrow csv reader when a block does not match types guessed from the first one
+_TYPE_DRIFT = re.compile(r"CSV column #(\d+).*conversion error to (\w+)")
+
+
+class _TypeDrift(Exception):
+    def __init__(self, name: str, type_name: str):
+        """Column name whose values in a later block do not fit its guessed type"""
+        super().__init__(name, type_name)
+        self.name = name
+        self.type_name = type_name
+
+
+def _string_temporal_types(csv_path: str, read_options: pv.ReadOptions, column_types: dict) -> dict:
+    """String type for columns arrow guesses as dates or timestamps from the first block:
+    pd.read_csv keeps such columns as strings, so both ingestion paths give the same values"""
+    with open(csv_path, "rb") as source:
+        schema = pv.open_csv(source, read_options=read_options,
+                             convert_options=pv.ConvertOptions(column_types=column_types)).schema
+    return {field.name: pa.string() for field in schema
+            if pa.types.is_temporal(field.type) and field.name not in column_types}
+
+
+def csv_to_parquet(csv_path: str, parquet_path: str, block_size: int, column_types: Optional[dict] = None,
+                   progress: Optional[Callable[[int, int], None]] = None) -> pq.FileMetaData:
+    """Streaming csv into parquet: csv is parsed block by block by multi-threaded pyarrow reader,
+    every block is written as a row group, so only a few blocks are in memory at once.
+    The file is written through a temporary one, a failed ingestion leaves nothing at parquet_path.
+    When a later block does not fit the type guessed from the first one, the file is read again with
+    a wider type for that column: integers become float64, other types strings, as in pd.read_csv.
+
+    Args:
+        csv_path (str): path to csv
+        parquet_path (str): path of parquet file to write
+        block_size (int): size of csv block in bytes
+        column_types (Optional[dict], optional): arrow types of columns, needed when type of a column
+            can not be guessed from the first block. Dates and timestamps are parsed only for columns
+            given here, others stay strings as in pd.read_csv. Defaults to None.
+        progress (Optional[Callable[[int, int], None]], optional): callback(bytes read, file size). Defaults to None.
+
+    Raises:
+        ValueError: if a later block does not match a type given in column_types
+
+    Returns:
+        pq.FileMetaData: footer of written file
+    """
+    total = os.path.getsize(csv_path)
+    done = [0]
+    def on_read(n: int) -> None:
+        done[0] += n
+        if progress is not None:
+            progress(min(done[0], total), total)
+    read_options = pv.ReadOptions(block_size=block_size, use_threads=True)
+    given = set(column_types or {})
+    column_types = dict(column_types or {})
+    column_types.update(_string_temporal_types(csv_path, read_options, column_types))
+    def write(path: str) -> None:
+        # empty strings are missing values, same as in pd.read_csv
+        convert_options = pv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+        source = io.BufferedReader(_CountingReader(open(csv_path, "rb"), on_read), buffer_size=1 << 20)
+        writer = None
+        try:
+            reader = pv.open_csv(source, read_options=read_options, convert_options=convert_options)
+            writer = pq.ParquetWriter(path, reader.schema)
+            while True:
+                try:
+                    batch = reader.read_next_batch()
+                except StopIteration:
+                    break
+                except pa.ArrowInvalid as e:
+                    match = _TYPE_DRIFT.search(str(e))
+                    if match is None or reader.schema.names[int(match.group(1))] in given:
+                        raise ValueError(f"Column type changed in the middle of {csv_path}, pass column_types: {e}") from e
+                    raise _TypeDrift(reader.schema.names[int(match.group(1))], match.group(2)) from e
+                writer.write_batch(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+            source.close()
+    while True:
+        try:
+            ColumnStore._atomic_write(parquet_path, write)
+            break
+        except _TypeDrift as drift:
+            # every retry widens one column (int -> float64 -> string), so the loop ends
+            widened = pa.float64() if drift.type_name.startswith(("int", "uint")) else pa.string()
+            column_types[drift.name] = widened
+            done[0] = 0
+    if progress is not None:
+        progress(total, total)
+    return pq.read_metadata(parquet_path)
+
+
+def pandas_dtypes(parquet_path: str) -> Dict[str, object]:
+    """dtypes which pd.read_parquet gives for the whole file: integer columns with missing values
+    become float64, boolean ones become object
+
+    Args:
+        parquet_path (str): parquet file
+
+    Returns:
+        Dict[str, object]: column name -> pandas dtype
+    """
+    metadata = pq.read_metadata(parquet_path)
+    schema = metadata.schema.to_arrow_schema()
+    empty = schema.empty_table().to_pandas()
+    result = {}
+    for i, field in enumerate(schema):
+        nulls = 0
+        for rg in range(metadata.num_row_groups):
+            stats = metadata.row_group(rg).column(i).statistics
+            if stats is None or not stats.has_null_count:
+                # no statistics in the footer, counting over this column only
+                nulls = pq.read_table(parquet_path, columns=[field.name]).column(0).null_count
+                break
+            nulls += stats.null_count
+        dtype = empty.dtypes.iloc[i]
+        if nulls and pa.types.is_integer(field.type):
+            dtype = pd.api.types.pandas_dtype("float64")
+        elif nulls and pa.types.is_boolean(field.type):
+            dtype = pd.api.types.pandas_dtype("object")
+        result[field.name] = dtype
+    return result
+
+
+def compact_parquet(parquet_path: str, plan: Optional[Dict[str, str]], batch_rows: int, strings: str = "category",
+                    int_floor: str = compaction.INT_FLOOR) -> Tuple[pq.FileMetaData, Dict[str, str], dict]:
+    """compaction.compact for a streamed state: the first pass over the file collects minimum and maximum
+    of integer columns and distinct values of string ones (not more than CATEGORY_MAX_UNIQUE of them),
+    the second one rewrites it row group by row group with the chosen storage types
+
+    Args:
+        parquet_path (str): state written by csv_to_parquet, replaced by the compacted one
+        plan (Optional[Dict[str, str]]): storage type by column from previous steps
+        batch_rows (int): rows in one batch
+        strings (str, optional): "category" or "arrow". Defaults to "category".
+        int_floor (str, optional): smallest integer type. Defaults to compaction.INT_FLOOR.
+
+    Returns:
+        Tuple[pq.FileMetaData, Dict[str, str], dict]: footer of the state file, plan for the next steps
+            and report as compaction.compact gives it
+    """
+    plan = dict(plan or {})
+    parquet_file = pq.ParquetFile(parquet_path)
+    schema = parquet_file.schema_arrow
+    rows = parquet_file.metadata.num_rows
+    dtypes = pandas_dtypes(parquet_path)
+    ints = [name for name, dtype in dtypes.items() if pd.api.types.is_integer_dtype(dtype)]
+    texts = [field.name for field in schema if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)]
+    bounds = {}
+    distinct = {name: set() for name in texts}
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=ints + texts):
+        for name in ints:
+            low, high = pc.min_max(batch.column(name)).values()
+            if low.is_valid:
+                previous = bounds.get(name, (low.as_py(), high.as_py()))
+                bounds[name] = (min(previous[0], low.as_py()), max(previous[1], high.as_py()))
+        for name in texts:
+            if distinct[name] is not None:
+                distinct[name].update(pc.unique(batch.column(name).drop_null()).to_pylist())
+                if len(distinct[name]) > compaction.CATEGORY_MAX_UNIQUE:
+                    distinct[name] = None
+    targets = {}
+    changes = {}
+    for name in dtypes:
+        if name in bounds:
+            values = pd.Series(bounds[name], dtype=dtypes[name])
+        elif distinct.get(name) is not None:
+            values = pd.Series(sorted(distinct[name]), dtype=object)
+        else:
+            plan.pop(name, None)
+            continue
+        target = compaction.column_target(values, rows, plan.get(name), strings, int_floor)
+        if target is None:
+            plan.pop(name, None)
+            continue
+        plan[name] = target
+        if target == str(dtypes[name]):
+            continue
+        targets[name] = pd.CategoricalDtype(sorted(distinct[name])) if target == "category" else target
+        changes[name] = [str(dtypes[name]), target]
+    report = {"bytes_before": 0, "bytes_after": 0, "bytes_saved": 0, "columns": changes}
+    if not targets:
+        return parquet_file.metadata, plan, report
+    # types of compacted columns and pandas metadata, so the file is read with the compacted dtypes
+    compacted = pa.Schema.from_pandas(pd.DataFrame({name: pd.Series([], dtype=dtype) for name, dtype in targets.items()}),
+                                      preserve_index=False)
+    target_schema = pa.schema([compacted.field(field.name) if field.name in targets else field for field in schema],
+                              metadata=pa.Schema.from_pandas(
+                                  pd.DataFrame({name: pd.Series([], dtype=targets.get(name, dtype))
+                                                for name, dtype in dtypes.items()}), preserve_index=False).metadata)
+    def convert(batch: pa.RecordBatch) -> pa.RecordBatch:
+        columns = []
+        for field in target_schema:
+            column = batch.column(field.name)
+            if pa.types.is_dictionary(field.type):
+                # one sorted dictionary in every row group, categories are the same as astype("category") gives
+                dictionary = pa.array(targets[field.name].categories.tolist(), type=field.type.value_type)
+                indices = pc.index_in(column, value_set=dictionary).cast(field.type.index_type)
+                column = pa.DictionaryArray.from_arrays(indices, dictionary)
+            elif column.type != field.type:
+                column = column.cast(field.type)
+            columns.append(column)
+        return pa.RecordBatch.from_arrays(columns, schema=target_schema)
+    def write(path: str) -> None:
+        with pq.ParquetWriter(path, target_schema) as writer:
+            for batch in parquet_file.iter_batches(batch_size=batch_rows):
+                converted = convert(batch)
+                report["bytes_before"] += int(batch.to_pandas().memory_usage(index=False, deep=True).sum())
+                report["bytes_after"] += int(converted.to_pandas().memory_usage(index=False, deep=True).sum())
+                writer.write_batch(converted)
+    ColumnStore._atomic_write(parquet_path, write)
+    report["bytes_saved"] = report["bytes_before"] - report["bytes_after"]
+    return pq.read_metadata(parquet_path), plan, report
+
+
+def hash_columns(parquet_path: str, dtypes: Dict[str, object], batch_rows: int,
+                 column_store: Optional[ColumnStore] = None) -> Tuple[Dict[str, str], pd.DataFrame]:
+    """column_digest of every column computed batch by batch. With column_store every column is also
+    written as a chunk, so a columnar state is built without loading the whole dataframe.
+
+    Args:
+        parquet_path (str): written state
+        dtypes (Dict[str, object]): dtypes from pandas_dtypes
+        batch_rows (int): rows in one batch
+        column_store (Optional[ColumnStore], optional): store for columnar mode. Defaults to None.
+
+    Returns:
+        Tuple[Dict[str, str], pd.DataFrame]: digests by column name and first rows of the state
+    """
+    parquet_file = pq.ParquetFile(parquet_path)
+    def to_series(array, name) -> pd.Series:
+        series = array.to_pandas()
+        series.name = name
+        if series.dtype != dtypes[name]:
+            series = series.astype(dtypes[name])
+        return series
+    sample = None
+    digests = {}
+    if column_store is None:
+        hashers = {name: ColumnHasher(dtype) for name, dtype in dtypes.items()}
+        for batch in parquet_file.iter_batches(batch_size=batch_rows):
+            for name in dtypes:
+                series = to_series(batch.column(name), name)
+                hashers[name].update(series)
+            if sample is None:
+                sample = pd.DataFrame({name: to_series(batch.column(name).slice(0, 5), name) for name in dtypes})
+        digests = {name: hasher.hexdigest() for name, hasher in hashers.items()}
+    else:
+        for name, dtype in dtypes.items():
+            hasher = ColumnHasher(dtype)
+            tmp = os.path.join(column_store.chunk_dir, f"ingest_{uuid.uuid4().hex}.tmp")
+            # pandas metadata of the column, compacted Arrow strings are read back as pandas strings
+            metadata = pa.Schema.from_pandas(pd.DataFrame({"v": pd.Series([], dtype=dtype)}), preserve_index=False).metadata
+            writer = None
+            try:
+                for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=[name]):
+                    chunk = pa.table({"v": batch.column(0)}).replace_schema_metadata(metadata)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp, chunk.schema)
+                    writer.write_table(chunk)
+                    hasher.update(to_series(batch.column(0), name))
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp, pa.schema([("v", parquet_file.schema_arrow.field(name).type)],
+                                                             metadata=metadata))
+            finally:
+                if writer is not None:
+                    writer.close()
+            digests[name] = column_store.add_chunk_file(tmp, hasher.hexdigest())
+        first = next(parquet_file.iter_batches(batch_size=5), None)
+        if first is not None:
+            sample = pd.DataFrame({name: to_series(first.column(name), name) for name in dtypes})
+    if sample is None:
+        sample = pd.DataFrame({name: pd.Series([], dtype=dtype) for name, dtype in dtypes.items()})
+    return digests, sample
@@ -0,0 +1,331 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Optional, List, Dict, Any
+import httpx
+import openai
+import pydantic
+from functions.api_integration import AsyncLLMClient
+from functions.streaming import ForbiddenOutput
+from functions import tracing
+
+
+class RouterError(RuntimeError):
+    def __init__(self, message: str, errors: Optional[list] = None, timed_out: bool = False):
+        """All routes failed or the request did not finish in time
+
+        Args:
+            message (str): error text
+            errors (Optional[list], optional): (route, exception) of every failed attempt. Defaults to None.
+            timed_out (bool, optional): some routes were still running when the time ran out. Defaults to False.
+        """
+        super().__init__(message)
+        self.errors = errors or []
+        self.timed_out = timed_out
+
+
+class ModelRefusal(ValueError):
+    """Model answered, but refused or did not fill the response schema"""
+
+
+def is_model_failure(error: Exception) -> bool:
+    """Failure of the answer itself: refusal, answer not matching the schema, forbidden or not compiling code.
+    It repeats for the same prompt and may be negative-cached, unlike timeouts, connection errors,
+    rate limits and server errors.
+
+    Args:
+        error (Exception): error of parse / stream or of checking the parsed answer
+
+    Returns:
+        bool: True if the same request would fail the same way
+    """
+    if isinstance(error, RouterError):
+        return not error.timed_out and bool(error.errors) and all(is_model_failure(e) for _, e in error.errors)
+    return isinstance(error, (ModelRefusal, ForbiddenOutput, pydantic.ValidationError,
+                              openai.LengthFinishReasonError, openai.ContentFilterFinishReasonError))
+
+
+class RouteStats():
+    def __init__(self, window: int = 100):
+        """Rolling statistics of one provider/model: latencies of successful requests and
+        outcomes of the last requests. Changed only from the event loop of the router.
+
+        Args:
+            window (int, optional): amount of last requests taken into account. Defaults to 100.
+        """
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self.consecutive_errors = 0
+        self.cooldown_until = 0.0
+    def record_success(self, latency: float) -> None:
+        self.requests += 1
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_errors = 0
+    def record_error(self, cooldown: float = 0.0) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.outcomes.append(False)
+        self.consecutive_errors += 1
+        if cooldown:
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown)
+    def percentile(self, q: float) -> Optional[float]:
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    def error_rate(self) -> float:
+        outcomes = list(self.outcomes)
+        return outcomes.count(False) / len(outcomes) if outcomes else 0.0
+    def available(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+    def snapshot(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "hedges": self.hedges,
+                "error_rate": round(self.error_rate(), 3), "p50": self.percentile(0.5), "p95": self.percentile(0.95),
+                "cooling_down": not self.available()}
+
+
+class LLMRouter():
+    def __init__(self, routes: List[str], config_path: str = r"D:\pycharm\pythonProject5\api.json",
+                 hedge_percentile: float = 0.95, initial_deadline: float = 10.0, min_deadline: float = 0.5,
+                 max_hedges: int = 1, timeout: float = 120.0, attempt_timeout: float = 60.0, window: int = 100,
+                 cooldown: float = 30.0, max_connections: int = 100):
+        """Client over several providers from api.json. Routes are ordered by rolling latency and
+        error rate. When the request to the best route runs longer than its latency percentile,
+        the same request is sent to the next route and the first answer wins (hedged request).
+        A failed request moves to the next route at once, rate-limited or repeatedly failing
+        routes are skipped for a cooldown period.
+
+        Requests run in the event loop of the router thread with one connection pool per provider,
+        so the router can be used from plain code (parse) and from asyncio code (aparse).
+
+        Args:
+            routes (List[str]): "provider:model" in order of preference, for example "openrouter:qwen/qwen3-30b-a3b:free"
+            config_path (str, optional): The path to the JSON configuration file.
+            hedge_percentile (float, optional): latency percentile after which hedge request is sent. Defaults to 0.95.
+            initial_deadline (float, optional): hedge deadline of route without statistics, seconds. Defaults to 10.
+            min_deadline (float, optional): hedge is never sent earlier than this, seconds. Defaults to 0.5.
+            max_hedges (int, optional): how many hedge requests one call may send. Defaults to 1.
+            timeout (float, optional): limit of the whole call, seconds. Defaults to 120.
+            attempt_timeout (float, optional): limit of one request to a route, stuck request
+                counts as an error and the call fails over. Defaults to 60.
+            window (int, optional): amount of last requests in statistics of a route. Defaults to 100.
+            cooldown (float, optional): seconds a rate-limited or failing route is skipped. Defaults to 30.
+            max_connections (int, optional): connection pool size of one provider. Defaults to 100.
+
+        Raises:
+            ValueError: if no route can be configured
+        """
+        self.hedge_percentile = hedge_percentile
+        self.initial_deadline = initial_deadline
+        self.min_deadline = min_deadline
+        self.max_hedges = max_hedges
+        self.timeout = timeout
+        self.attempt_timeout = attempt_timeout
+        self.cooldown = cooldown
+        self.clients = {}
+        self.routes = []
+        for route in routes:
+            provider, _, model = route.strip().partition(":")
+            if not model:
+                raise ValueError(f"Маршрут должен быть в виде provider:model, получено '{route}'")
+            if provider not in self.clients:
+                try:
+                    self.clients[provider] = AsyncLLMClient(
+                        provider, config_path=config_path, max_retries=0, timeout=attempt_timeout,
+                        http_client=openai.DefaultAsyncHttpxClient(
+                            limits=httpx.Limits(max_connections=max_connections,
+                                                max_keepalive_connections=max_connections)))
+                except ValueError as e:
+                    print(f"Провайдер {provider} пропущен: {e}")
+                    continue
+            self.routes.append(f"{provider}:{model}")
+        if not self.routes:
+            raise ValueError("Не настроен ни один маршрут к модели")
+        self.route_stats = {route: RouteStats(window) for route in self.routes}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-router", daemon=True)
+        self._thread.start()
+    def parse(self, **kwargs) -> Any:
+        """Same as client.chat.completions.parse without model argument, model is taken from the route
+
+        Raises:
+            RouterError: if every route failed or the call timed out
+
+        Returns:
+            Any: ParsedChatCompletion of the route answered first
+        """
+        with tracing.span("llm", streaming=False) as span:
+            return _usage(span, asyncio.run_coroutine_threadsafe(self._parse(kwargs), self._loop).result())
+    async def aparse(self, **kwargs) -> Any:
+        """parse for asyncio code, cancelling the await cancels requests in flight"""
+        with tracing.span("llm", streaming=False) as span:
+            return _usage(span, await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._parse(kwargs), self._loop)))
+    def stream(self, consumer, **kwargs) -> Any:
+        """Streaming parse: every piece of the answer goes to consumer.feed(delta) as soon as it arrives.
+        Exception from feed stops generation and is raised as is. Routes are tried in order, but only
+        until the first piece is received, streamed requests are not hedged.
+
+        Raises:
+            RouterError: if every route failed before answering or the stream broke
+
+        Returns:
+            Any: ParsedChatCompletion
+        """
+        with tracing.span("llm", streaming=True) as span:
+            return _usage(span, asyncio.run_coroutine_threadsafe(self._stream(consumer, kwargs), self._loop).result())
+    async def astream(self, consumer, **kwargs) -> Any:
+        """stream for asyncio code, consumer.feed is called from the router thread"""
+        with tracing.span("llm", streaming=True) as span:
+            return _usage(span, await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(self._stream(consumer, kwargs), self._loop)))
+    async def _stream(self, consumer, kwargs: dict) -> Any:
+        errors = []
+        for route in self._ordered_routes():
+            provider, _, model = route.partition(":")
+            stats = self.route_stats[route]
+            started = time.monotonic()
+            received = False
+            aborted = None
+            try:
+                async with asyncio.timeout(self.timeout):
+                    async with self.clients[provider].chat.completions.stream(model=model, **kwargs) as stream:
+                        async for event in stream:
+                            if event.type != "content.delta":
+                                continue
+                            received = True
+                            try:
+                                consumer.feed(event.delta)
+                            except Exception as e:
+                                # leaving the context closes the connection, the model stops generating
+                                aborted = e
+                                break
+                        if aborted is None:
+                            response = await stream.get_final_completion()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._record_error(stats, e)
+                errors.append((route, e))
+                if received:
+                    raise RouterError(f"Поток ответа {route} оборвался: {e}", errors) from e
+                continue
+            if aborted is not None:
+                raise aborted
+            stats.record_success(time.monotonic() - started)
+            return response
+        raise RouterError("Все маршруты к модели завершились ошибкой: "
+                          + "; ".join(f"{route}: {e}" for route, e in errors), errors)
+    def _ordered_routes(self) -> List[str]:
+        """Available routes first, then by expected latency, configured order for equal ones"""
+        def key(route):
+            stats = self.route_stats[route]
+            p50 = stats.percentile(0.5)
+            expected = p50 if p50 is not None else self.initial_deadline / 2
+            return (not stats.available(), expected * (1 + 4 * stats.error_rate()))
+        return sorted(self.routes, key=key)
+    def _deadline(self, route: str) -> float:
+        latency = self.route_stats[route].percentile(self.hedge_percentile)
+        return max(self.min_deadline, latency if latency is not None else self.initial_deadline)
+    async def _call(self, route: str, kwargs: dict) -> Any:
+        provider, _, model = route.partition(":")
+        stats = self.route_stats[route]
+        started = time.monotonic()
+        try:
+            response = await self.clients[provider].chat.completions.parse(model=model, **kwargs)
+            if kwargs.get("response_format") is not None and response.choices[0].message.parsed is None:
+                raise ModelRefusal(response.choices[0].message.refusal or "модель не вернула ответ по схеме")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_error(stats, e)
+            raise
+        stats.record_success(time.monotonic() - started)
+        return response
+    def _record_error(self, stats: RouteStats, error: Exception) -> None:
+        """Rate-limited route cools down for retry-after seconds, other routes after three errors in a row"""
+        if isinstance(error, openai.RateLimitError):
+            retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+            try:
+                cooldown = float(retry_after) if retry_after else self.cooldown
+            except ValueError:
+                cooldown = self.cooldown
+            stats.record_error(cooldown)
+        else:
+            stats.record_error(self.cooldown if stats.consecutive_errors >= 2 else 0.0)
+    async def _parse(self, kwargs: dict) -> Any:
+        order = self._ordered_routes()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        pending = {}
+        errors = []
+        hedges = 0
+        def launch() -> str:
+            route = order[len(pending) + len(errors)]
+            pending[loop.create_task(self._call(route, kwargs))] = route
+            return route
+        launch()
+        last_launch = loop.time()
+        try:
+            while pending:
+                remaining = self.timeout - (loop.time() - started)
+                if remaining <= 0:
+                    raise RouterError(f"Модель не ответила за {self.timeout} с", errors, timed_out=True)
+                wait = remaining
+                can_hedge = hedges < self.max_hedges and len(pending) + len(errors) < len(order)
+                if can_hedge:
+                    # waiting for the answer until latency percentile of the launched routes
+                    deadline = max(self._deadline(route) for route in pending.values())
+                    wait = min(wait, max(0.0, last_launch + deadline - loop.time()))
+                done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if can_hedge:
+                        hedges += 1
+                        self.route_stats[launch()].hedges += 1
+                        last_launch = loop.time()
+                    continue
+                for task in done:
+                    route = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append((route, task.exception()))
+                if not pending and len(errors) < len(order):
+                    # every launched route failed, failing over to the next one
+                    launch()
+                    last_launch = loop.time()
+            raise RouterError("Все маршруты к модели завершились ошибкой: "
+                              + "; ".join(f"{route}: {e}" for route, e in errors), errors)
+        finally:
+            for task in pending:
+                task.cancel()
+                # loser may fail right before cancel, its error is already in route stats
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    def stats(self) -> Dict[str, dict]:
+        """Rolling statistics of every route"""
+        return {route: stats.snapshot() for route, stats in self.route_stats.items()}
+    def close(self) -> None:
+        """Closing connection pools and stopping the router thread"""
+        async def _close():
+            for client in self.clients.values():
+                await client.close()
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def _usage(span, response: Any) -> Any:
+    """Model and token counts of the answer as attributes of the llm span"""
+    if span.recording:
+        usage = getattr(response, "usage", None)
+        span.set(model=getattr(response, "model", None),
+                 prompt_tokens=getattr(usage, "prompt_tokens", None),
+                 completion_tokens=getattr(usage, "completion_tokens", None))
+        if usage is not None and usage.completion_tokens:
+            tracing.count("llm_tokens", usage.prompt_tokens or 0, kind="prompt")
+            tracing.count("llm_tokens", usage.completion_tokens, kind="completion")
+    return response
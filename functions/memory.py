@@ -1,6 +1,10 @@
 import os
 import io
+import logging
 import json
+import time
+import uuid
+import glob
 import hashlib
 import tempfile
 from typing import Optional, Tuple, Any
@@ -8,9 +12,26 @@ from datetime import datetime
 import pandas as pd
 import redis
 from zoneinfo import ZoneInfo
+from functions.column_store import ColumnStore, ChunkRefs, MANIFEST_SUFFIX, column_digest
+from functions import df_profile, ingest, sampling, compaction, tracing
+from functions.fingerprint import DigestMemo, frame_fingerprint, fingerprint_parts
+from functions.frame_cache import FrameCache
+from functions.result_cache import ResultCache
+from functions.session_scripts import SessionScripts
+from functions.write_behind import StateWriter, StateLostError
+from functions.state_formats import state_formats, format_of
+from concurrent.futures import ThreadPoolExecutor
+
+# set once keys of all sessions have the session id as hash tag
+SESSION_KEYS_TAGGED = "sessions:hash_tagged"
+
+logger = logging.getLogger(__name__)
 
 class MemoryManager():
-    def __init__(self, redis_url: str = "redis://localhost:6379/0", storage_dir: str = "./df_states",timezone: str = "Europe/Moscow"):
+    def __init__(self, redis_url: str = "redis://localhost:6379/0", storage_dir: str = "./df_states",timezone: str = "Europe/Moscow",
+                 storage_mode: str = "parquet", cache_bytes: int = 1024 ** 3, result_cache_bytes: int = 256 * 1024 ** 2,
+                 write_behind: bool = False, hot_format: Optional[str] = None, hot_states: int = 3,
+                 compact: bool = False, compact_strings: str = "category"):
         """The constructor of the class in which the connection to the redis database is set, by default it is localhost
         As well as the folder where df will be stored locally on the system.
 
@@ -18,87 +39,498 @@ class MemoryManager():
             redis_url (_type_, optional): _description_. Defaults to "redis://localhost:6379/0".
             storage_dir (str, optional): _description_. Defaults to "./df_states".
             tz (str, optional): Variable for choosing timezone for metadata. Defaults to Europe/Moscow.
+            storage_mode (str, optional): "parquet" saves every step as a full .parquet file,
+                "columnar" saves every column once under its content hash and a step as a manifest
+                of column references. Defaults to "parquet".
+            cache_bytes (int, optional): memory budget of in-process cache of decoded states,
+                0 disables the cache. Defaults to 1 GiB.
+            result_cache_bytes (int, optional): disk budget of cached results of read-only code,
+                0 disables the cache. Defaults to 256 MiB.
+            write_behind (bool, optional): push_result makes new state current at once and writes it
+                in a background thread. Call flush() before exit. Defaults to False.
+            hot_format (Optional[str], optional): format of recently used states, "arrow" (memory-mapped,
+                no decode on load) or "arrow_lz4". Other states are kept in storage_mode format and states
+                migrate between the two in background. Can be changed per session by set_tiering.
+                Defaults to None (all states in storage_mode format).
+            hot_states (int, optional): how many most recently used states of a session are hot. Defaults to 3.
+            compact (bool, optional): states from csv and from code are stored with smaller dtypes
+                (downcast numbers, low-cardinality strings as categoricals), profile keeps logical types.
+                Defaults to False.
+            compact_strings (str, optional): "category" or "arrow" (Arrow-backed strings) for
+                low-cardinality string columns. Defaults to "category".
         """
+        if storage_mode not in ("parquet", "columnar"):
+            raise ValueError(f"Unknown storage mode: {storage_mode}")
         self.r = redis.from_url(redis_url, decode_responses=True)
+        tracing.instrument_redis(self.r)
+        self._tag_session_keys()
+        self.scripts = SessionScripts(self.r)
         self.storage_dir = storage_dir
         os.makedirs(self.storage_dir, exist_ok=True)
         self.tz = ZoneInfo(timezone)
-    def _state_filename(self,session_id: str, step: int) -> str:
+        self.storage_mode = storage_mode
+        # one storage folder can be used by several processes, reference counts are per folder
+        refs_key = f"chunks:{hashlib.sha256(os.path.abspath(self.storage_dir).encode('utf-8')).hexdigest()[:16]}:refs"
+        self.column_store = ColumnStore(self.storage_dir, refs=ChunkRefs(self.r, refs_key))
+        if not self.column_store.refs.ready():
+            # store from before reference counting, chunks in use are counted by the manifests
+            self.column_store.refs.rebuild(self.column_store.manifests())
+        self.formats = state_formats(self.column_store)
+        hot_format = None if hot_format == "none" else hot_format
+        if hot_format is not None and hot_format not in self.formats:
+            raise ValueError(f"Unknown state format: {hot_format}")
+        self.hot_format = hot_format
+        self.hot_states = hot_states
+        if compact_strings not in ("category", "arrow"):
+            raise ValueError(f"Unknown string compaction: {compact_strings}")
+        self.compact = compact
+        self.compact_strings = compact_strings
+        self._tiering_pool = None
+        self.frame_cache = FrameCache(max_bytes=cache_bytes)
+        self.digest_memo = DigestMemo()
+        self.result_cache = ResultCache(os.path.join(self.storage_dir, "results"), max_bytes=result_cache_bytes)
+        self.llm_cache_stats = {"hits": 0, "negative_hits": 0, "misses": 0, "writes": 0}
+        # id of this process in pending markers of states it has not written yet
+        self.owner = uuid.uuid4().hex
+        self.writer = StateWriter(self._persist_state, heartbeat=self._heartbeat) if write_behind else None
+        if self.writer is not None:
+            self._heartbeat()
+    def _state_filename(self,session_id: str, step: int, fmt: Optional[str] = None) -> str:
         """Generating a file name to save its state
 
         Args:
             session_id (str): id сессии
             step (int): шаг в системе
+            fmt (Optional[str], optional): state format name. Defaults to storage_mode.
 
         Returns:
             str: a string with the session name, as well as a step in the .parquet format
+                 (or .manifest.json in columnar storage mode, .arrow or .lz4.arrow for hot states)
         """
-        return os.path.join(self.storage_dir,f"{session_id}_state_{step}.parquet")
+        extension = self.formats[fmt or self.storage_mode].suffix
+        return os.path.join(self.storage_dir,f"{session_id}_state_{step}{extension}")
+    def _write_state(self, filename: str, df: pd.DataFrame, digests: Optional[dict] = None, fmt: Optional[str] = None) -> None:
+        """Saving df to filename, format is chosen by file extension unless given"""
+        with tracing.span("state.write", file=os.path.basename(filename), step=self._step_of(filename)) as span:
+            (self.formats[fmt] if fmt else format_of(self.formats, filename)).write(filename, df, digests=digests)
+            if span.recording:
+                span.add_bytes("write", self._state_bytes(filename))
+    def _read_state(self, filename: str, columns: Optional[list] = None) -> pd.DataFrame:
+        """Reading df (or only some of its columns) from filename, format is chosen by file extension"""
+        with tracing.span("state.read", file=os.path.basename(filename), step=self._step_of(filename),
+                          partial=columns is not None) as span:
+            df = format_of(self.formats, filename).read(filename, columns=columns)
+            if span.recording:
+                span.add_bytes("read", self._state_bytes(filename, columns))
+            return df
+    def _state_bytes(self, filename: str, columns: Optional[list] = None) -> int:
+        """Size of a state on disk, for manifests - size of chunks of its (selected) columns"""
+        if not filename.endswith(MANIFEST_SUFFIX):
+            return os.path.getsize(filename)
+        wanted = set(columns) if columns is not None else None
+        paths = [self.column_store.chunk_path(entry["chunk"])
+                 for entry in self.column_store.read_manifest(filename)["columns"]
+                 if wanted is None or entry["name"] in wanted]
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    def _state_columns(self, filename: str) -> list:
+        """Column names of saved state, read only from parquet footer, arrow schema or manifest"""
+        return format_of(self.formats, filename).columns(filename)
     @staticmethod
-    def df_describtion(df:pd.DataFrame, sample_n: int = 5) -> str:
+    @tracing.traced("fingerprint")
+    def df_describtion(df:pd.DataFrame, digests: Optional[dict] = None) -> str:
         """Function for creating hash of dataframe to save current df hash.
+        Hash covers the whole content: columns, dtypes, shape and vectorized hash of every column.
 
         Args:
             df (pd.DataFrame): takes df as pd.dataframe
-            sample_n (int, optional): amount of rows including to sample function. Defaults to 5.
+            digests (Optional[dict], optional): already computed column_digest by column name. Defaults to None.
 
         Returns:
             str: hash of dataframe
         """
-        cols = ",".join(map(str, df.columns.tolist()))
-        dtypes = ",".join(str(x) for x in list(df.dtypes))
-        shape = f"{df.shape[0]}x{df.shape[1]}"
-        sample = df.head(sample_n).to_csv()
-        raw = "||".join([cols,dtypes,shape,sample])
-        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
-    def init_session_from_csv(self,session_id: str, csv_path: str) -> dict:
+        if digests is None:
+            digests = {name: column_digest(df[name]) for name in df.columns}
+        return frame_fingerprint(df, digests)
+    def fingerprint(self, df: pd.DataFrame) -> str:
+        """Same hash as df_describtion, columns still pointing to memory of known states are not hashed again"""
+        return self.df_describtion(df, digests=self.digest_memo.digests(df))
+    def state_signature(self, session_id: str, df: Optional[pd.DataFrame] = None) -> str:
+        """Signature of the current state (df) from its metadata, df is hashed only while the state is being written.
+        df is loaded for that if not given"""
+        meta = self.get_current_state_info(session_id)
+        signature = meta.get("signature/df_description") if meta else None
+        if signature:
+            return signature
+        return self.fingerprint(df if df is not None else self.load_current_df(session_id))
+    @tracing.traced("ingest")
+    def init_session_from_csv(self,session_id: str, csv_path: str, streaming: Optional[bool] = None,
+                              max_memory_bytes: int = 256 * 1024 ** 2, column_types: Optional[dict] = None,
+                              progress=None) -> dict:
         """Launch init session from csv file
 
         Args:
             session_id (str): id of session
             csv_path (str): path to current csv
+            streaming (Optional[bool], optional): read csv by blocks straight into parquet, without pandas frame.
+                Defaults to None - streaming for files bigger than max_memory_bytes.
+            max_memory_bytes (int, optional): how much data streaming ingestion may hold in memory. Defaults to 256 MiB.
+            column_types (Optional[dict], optional): pyarrow types of columns for streaming ingestion. Defaults to None.
+            progress (optional): True for tqdm bar or callback(bytes read, file size). Defaults to None.
 
         Returns:
             dict: dictionary with session information and note about init
         """
-        df = pd.read_csv(csv_path)
-        return self._push_new_state(session_id, df,note = f"init_from:{os.path.basename(csv_path)}")
-    def _push_new_state(self,session_id:str,df:pd.DataFrame,note: Optional[str] = None) -> dict:
-        first_key = f"session:{session_id}:states"
-        idx_key = f"session:{session_id}:idx"
-        meta_key = f"session:{session_id}:meta"
+        note = f"init_from:{os.path.basename(csv_path)}"
+        span = tracing.current()
+        if span.recording:
+            span.set(session_id=session_id)
+            span.add_bytes("read", os.path.getsize(csv_path))
+        if streaming is None:
+            streaming = os.path.getsize(csv_path) > max_memory_bytes
+        if not streaming:
+            df, report = self._compact(session_id, pd.read_csv(csv_path))
+            meta = self._push_new_state(session_id, df,note = note, compacted=report)
+            if report is not None:
+                meta["compaction"] = report
+            return meta
+        if progress is True:
+            progress = ingest.tqdm_progress(os.path.getsize(csv_path))
+        # parsed arrow block, its pandas copy and parquet writer buffers stay in memory together
+        block_size = max(1024 ** 2, max_memory_bytes // 4)
+        keys = self.session_keys(session_id)
+        step = self.scripts.reserve_step(keys[0], self.session_key(session_id, "seq"))
+        filename = self._state_filename(session_id, step)
+        columnar = filename.endswith(MANIFEST_SUFFIX)
+        parquet_path = filename + ".ingest.parquet" if columnar else filename
+        try:
+            metadata = ingest.csv_to_parquet(csv_path, parquet_path, block_size, column_types=column_types, progress=progress)
+            row_size = max(1, sum(metadata.row_group(rg).total_byte_size for rg in range(metadata.num_row_groups))
+                           // max(1, metadata.num_rows))
+            batch_rows = max(1000, block_size // row_size)
+            report = None
+            if self.compact:
+                # the file is compacted batch by batch, the state is never loaded as a whole
+                metadata, plan, report = ingest.compact_parquet(parquet_path, self._compaction_plan(session_id), batch_rows,
+                                                                strings=self.compact_strings)
+                self._store_compaction_plan(session_id, plan)
+            dtypes = ingest.pandas_dtypes(parquet_path)
+            digests, sample = ingest.hash_columns(parquet_path, dtypes, batch_rows,
+                                                  column_store=self.column_store if columnar else None)
+            if columnar:
+                self.column_store.write_manifest(filename, metadata.num_rows, [(name, digests[name]) for name in dtypes])
+        finally:
+            if columnar and os.path.exists(parquet_path):
+                os.remove(parquet_path)
+        profile = df_profile.build_profile_from_parquet(metadata, dtypes, digests,
+                                                        self._footer_source(filename, digests), sample)
+        signature = fingerprint_parts(metadata.num_rows, list(dtypes.items()), digests)
+        previous = self.get_current_state_info(session_id)
+        previous_profile = self._node_profile(session_id, previous)
+        schema = {str(name): str(dtype) for name, dtype in dtypes.items()}
+        meta = self._commit_state(session_id, step, filename, profile, signature, schema, previous_profile, note,
+                                  compacted=report)
+        if report is not None:
+            meta["compaction"] = report
+        return meta
+    def _compact(self, session_id: str, df: pd.DataFrame) -> Tuple[pd.DataFrame, Optional[dict]]:
+        """Compacting dtypes of a new state with choices of previous steps of the session, so a column
+        keeps its storage type across steps while its values fit it
 
-        #Pipilene for avoiding race between clients
+        Returns:
+            Tuple[pd.DataFrame, Optional[dict]]: frame to store, report of saved bytes (None if compaction is off)
+        """
+        if not self.compact:
+            return df, None
+        df, plan, report = compaction.compact(df, self._compaction_plan(session_id), strings=self.compact_strings)
+        self._store_compaction_plan(session_id, plan)
+        return df, report
+    def _compaction_plan(self, session_id: str) -> dict:
+        return self.r.hgetall(self.session_key(session_id, "dtypes"))
+    def _store_compaction_plan(self, session_id: str, plan: dict) -> None:
+        key = self.session_key(session_id, "dtypes")
         pipe = self.r.pipeline()
-        pipe.llen(first_key)
-        length = pipe.execute()[0]
-        new_index = length
-        
+        pipe.delete(key)
+        if plan:
+            pipe.hset(key, mapping=plan)
+        pipe.execute()
+    def expand(self, session_id: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Frame generated code runs on: columns compaction changed in the current state get back the types
+        they had before it, so int32 arithmetic does not wrap and categoricals add no empty groups.
+        Other columns, also types the code of the user chose, stay as they are.
+
+        Args:
+            session_id (str): session id
+            df (pd.DataFrame): current state or columns of it
+
+        Returns:
+            pd.DataFrame: df itself if nothing is compacted, otherwise a shallow copy with converted columns
+        """
+        if not self.compact:
+            return df
+        info = self.get_current_state_info(session_id)
+        compacted = info.get("compacted") if info else None
+        return compaction.expand(df, compacted) if compacted else df
+    @staticmethod
+    def session_key(session_id: str, name: str) -> str:
+        """Redis key of a session, session:{id}:name. Session id in braces is the hash tag of the key,
+        so on Redis Cluster all keys of a session are in one slot and Lua scripts can reach node keys
+        they build from the prefix"""
+        return f"session:{{{session_id}}}:{name}"
+    @staticmethod
+    def session_id_of(key: str) -> str:
+        """Session id of a key made by session_key"""
+        return key[key.index("{") + 1:key.index("}:")]
+    def _tag_session_keys(self) -> None:
+        """Keys of sessions from before hash tags (session:id:name) are moved to session:{id}:name once"""
+        if self.r.exists(SESSION_KEYS_TAGGED):
+            return
+        for key in list(self.r.scan_iter("session:*")):
+            if key.startswith("session:{"):
+                continue
+            _, session_id, name = key.split(":", 2)
+            # DUMP / RESTORE instead of RENAME: old and new keys may be in different cluster slots
+            value = self.r.dump(key)
+            if value is None:
+                continue
+            try:
+                self.r.restore(self.session_key(session_id, name), max(0, self.r.pttl(key)), value)
+            except redis.ResponseError:
+                # already moved by another process
+                pass
+            self.r.delete(key)
+        self.r.set(SESSION_KEYS_TAGGED, 1)
+    @classmethod
+    def session_keys(cls, session_id: str) -> list:
+        """Keys of states list, current step and steps zset of the session, then index and meta hash
+        of the old linear history, which are converted to the version graph on first read"""
+        return [cls.session_key(session_id, name) for name in ("states", "head", "nodes", "idx", "meta")]
+    @classmethod
+    def node_prefix(cls, session_id: str) -> str:
+        """Prefix of node hashes, node of a step is session:{id}:node:{step}"""
+        return cls.session_key(session_id, "node:")
+    @staticmethod
+    def _step_of(filename: str) -> int:
+        """Step number of a state file, it never changes when the state migrates between formats"""
+        return int(os.path.basename(filename).rsplit("_state_", 1)[1].split(".", 1)[0])
+    @classmethod
+    def pending_key(cls, session_id: str) -> str:
+        """Hash of states pushed but not written yet: filename -> owner"""
+        return cls.session_key(session_id, "pending")
+    def _heartbeat(self) -> None:
+        self.r.set(f"writer:{self.owner}", int(time.time()), ex=60)
+    def _push_new_state(self,session_id:str,df:pd.DataFrame,note: Optional[str] = None,
+                        background: bool = False, code: str = '', compacted: Optional[dict] = None) -> dict:
+        keys = self.session_keys(session_id)
+        seq_key = self.session_key(session_id, "seq")
+
+        #Reserving unique step number, so concurrent clients never write the same file
+        step = self.scripts.reserve_step(keys[0], seq_key)
+        previous = self.get_current_state_info(session_id)
+        # new state is the most recently used one, it is written in hot format if the session has tiers
+        filename = self._state_filename(session_id, step, self.tiering(session_id)[0])
+        self._touch(session_id, filename)
+
+        if background and self.writer is not None:
+            # state is current at once, file, profile and signature are written by the writer thread
+            self.r.hset(self.pending_key(session_id), filename, self.owner)
+            self.writer.hold(filename, df)
+            self.frame_cache.put(filename, df)
+            meta = self._node_meta(df.shape[0], {name: df[name].dtype for name in df.columns}, note, code, compacted)
+            meta["persisted"] = 0
+            meta["parent"] = self.scripts.push(keys, self.node_prefix(session_id), step, filename, meta)
+            self.writer.submit(filename, df, (session_id, step, previous))
+            return self._decoded(meta, step, filename)
+
         #Saving df
 
-        filename = self._state_filename(session_id,new_index)
-        df.to_parquet(filename,index=False)
+        digests = self.digest_memo.digests(df)
+        self._write_state(filename, df, digests=digests)
+        self.frame_cache.put(filename, df)
+
+        #Profile for the prompt, unchanged columns are taken from previous state profile
+
+        previous_profile = self._node_profile(session_id, previous)
+        profile = df_profile.build_profile(df, digests, footer=self._footer_source(filename, digests),
+                                           previous=previous_profile)
 
         #Compute df description
 
-        descript = self.df_describtion(df)
+        descript = self.df_describtion(df, digests=digests)
+        schema = {name: df[name].dtype for name in df.columns}
+        return self._commit_state(session_id, step, filename, profile, descript, schema, previous_profile, note, code,
+                                  compacted)
+    @tracing.traced("persist")
+    def _persist_state(self, filename: str, df: pd.DataFrame, args: tuple) -> None:
+        """Background part of write-behind push: file, profile, signature and column changes of the state"""
+        session_id, step, previous = args
+        tracing.current().set(session_id=session_id, step=step)
+        digests = self.digest_memo.digests(df)
+        self._write_state(filename, df, digests=digests)
+        previous_profile = self._node_profile(session_id, previous)
+        profile = df_profile.build_profile(df, digests, footer=self._footer_source(filename, digests),
+                                           previous=previous_profile)
+        self.r.set(self.profile_key(session_id, filename), json.dumps(profile, ensure_ascii=False))
+        self.scripts.update_meta(self.node_prefix(session_id) + str(step),
+                                 {"signature/df_description": self.df_describtion(df, digests=digests),
+                                  "changes": json.dumps(self._changes(previous_profile, profile), ensure_ascii=False),
+                                  "persisted": 1})
+        self.r.hdel(self.pending_key(session_id), filename)
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Durability barrier: waiting until all pushed states are written to disk
 
-        pipe = self.r.pipeline()
-        pipe.rpush(first_key,filename)
-        pipe.set(idx_key,new_index)
-        #storing metadata
-        current_tz = datetime.now(self.tz)
+        Raises:
+            RuntimeError: if a state could not be written
+
+        Returns:
+            bool: False if timeout expired
+        """
+        if self.writer is None:
+            return True
+        return self.writer.flush(timeout)
+    def close(self) -> None:
+        """Writing queued states, finishing tier migrations and stopping background threads"""
+        if self._tiering_pool is not None:
+            self._tiering_pool.shutdown(wait=True)
+        if self.writer is not None:
+            self.writer.close()
+            self.r.delete(f"writer:{self.owner}")
+    def _state_valid(self, filename: str) -> bool:
+        """State file exists and is complete: parquet footer is readable, manifest chunks exist"""
+        try:
+            return format_of(self.formats, filename).valid(filename)
+        except ValueError:
+            return False
+    def recover(self, session_id: Optional[str] = None, stale_tmp_seconds: float = 3600) -> dict:
+        """Crash recovery of write-behind states. Pending states of writers without heartbeat are checked:
+        complete files are kept, half-written or missing states are removed from their sessions.
+
+        Args:
+            session_id (Optional[str], optional): session to check. Defaults to None (all sessions).
+            stale_tmp_seconds (float, optional): temporary files older than this are removed. Defaults to one hour.
+
+        Returns:
+            dict: filenames of "kept" and "dropped" states
+        """
+        report = {"kept": [], "dropped": []}
+        keys = [self.pending_key(session_id)] if session_id else list(self.r.scan_iter("session:{*}:pending"))
+        for pending_key in keys:
+            sid = self.session_id_of(pending_key)
+            for filename, owner in self.r.hgetall(pending_key).items():
+                if owner == self.owner or self.r.exists(f"writer:{owner}"):
+                    # still being written by a live process
+                    continue
+                if self._state_valid(filename):
+                    self.r.hdel(pending_key, filename)
+                    report["kept"].append(filename)
+                    continue
+                self._drop_unwritten(sid, filename)
+                report["dropped"].append(filename)
+        for tmp in glob.glob(os.path.join(self.storage_dir, "*.tmp")):
+            try:
+                if time.time() - os.path.getmtime(tmp) > stale_tmp_seconds:
+                    os.remove(tmp)
+            except OSError:
+                pass
+        return report
+    def remove_state_file(self, filename: str) -> int:
+        """Deleting file of a state, chunks of a manifest are released and collected later
+
+        Returns:
+            int: freed bytes, 0 if the file is gone
+        """
+        try:
+            if filename.endswith(MANIFEST_SUFFIX):
+                return self.column_store.remove(filename)
+            size = os.path.getsize(filename)
+            os.remove(filename)
+            return size
+        except (OSError, ValueError):
+            # memory-mapped file can not be removed on Windows while a frame uses it
+            return 0
+    def _commit_state(self, session_id: str, step: int, filename: str, profile: dict, signature: str, schema: dict,
+                      previous_profile: Optional[dict] = None, note: Optional[str] = None, code: str = '',
+                      compacted: Optional[dict] = None) -> dict:
+        """Storing profile and metadata of already written state, state becomes a child of the current one
+        and the current state in one atomic call"""
+        self.r.set(self.profile_key(session_id, filename), json.dumps(profile, ensure_ascii=False))
+        meta = self._node_meta(profile["nrows"], schema, note, code, compacted)
+        meta["signature/df_description"] = signature
+        meta["changes"] = json.dumps(self._changes(previous_profile, profile), ensure_ascii=False)
+        meta["parent"] = self.scripts.push(self.session_keys(session_id), self.node_prefix(session_id), step, filename, meta)
+        return self._decoded(meta, step, filename)
+    def _node_meta(self, nrows: int, schema: dict, note: Optional[str], code: str,
+                   compacted: Optional[dict] = None) -> dict:
+        """Metadata of a new node as it is stored in redis. compacted - report of compaction.compact,
+        its columns (name -> [type before, storage type]) are kept for expand()"""
         meta = {
-            "created_at": current_tz.isoformat(),
-            "index": new_index,
-            "signature/df_description": descript,
+            "created_at": datetime.now(self.tz).isoformat(),
             "note": note or "",
-            "nrows": df.shape[0],
-            "ncols": df.shape[1]
+            "code": code or "",
+            "nrows": int(nrows),
+            "ncols": len(schema),
+            "schema": json.dumps({str(name): str(dtype) for name, dtype in schema.items()}, ensure_ascii=False)
         }
-        pipe.hset(meta_key,mapping=meta)
-        pipe.execute()
+        if compacted and compacted["columns"]:
+            meta["compacted"] = json.dumps(compacted["columns"], ensure_ascii=False)
+        return meta
+    @staticmethod
+    def _decoded(meta: dict, step: int, filename: str) -> dict:
+        """Metadata of a pushed node in the form checkout returns it"""
+        meta.update({"step": step, "filename": filename})
+        if meta["parent"] is None:
+            del meta["parent"]
+        for field in ("schema", "changes", "compacted"):
+            if field in meta:
+                meta[field] = json.loads(meta[field])
         return meta
+    @staticmethod
+    def _changes(previous_profile: Optional[dict], profile: dict) -> dict:
+        """Columns added, removed and modified by a step, found by content hashes of the two profiles"""
+        old = {col["name"]: col["digest"] for col in previous_profile["columns"]} if previous_profile else {}
+        new = {col["name"]: col["digest"] for col in profile["columns"]}
+        return {"added": [name for name in new if name not in old],
+                "removed": [name for name in old if name not in new],
+                "modified": [name for name in new if name in old and (new[name] is None or new[name] != old[name])]}
+    @classmethod
+    def profile_key(cls, session_id: str, filename: str) -> str:
+        return cls.session_key(session_id, f"profile:{os.path.basename(filename)}")
+    def _read_profile(self, session_id: str, filename: str) -> Optional[dict]:
+        raw = self.r.get(self.profile_key(session_id, filename))
+        return json.loads(raw) if raw else None
+    def _node_profile(self, session_id: str, meta: Optional[dict]) -> Optional[dict]:
+        """Profile of a state by its meta. The state may have migrated to another format since the meta
+        was read, so its file is taken from its node again"""
+        if not meta:
+            return None
+        filename = self.r.hget(self.node_prefix(session_id) + str(meta["step"]), "filename") or meta["filename"]
+        return self._read_profile(session_id, filename)
+    def _footer_source(self, filename: str, digests: dict):
+        """Function giving parquet footer where statistics of a column are stored"""
+        return format_of(self.formats, filename).footer(filename, digests)
+    def get_profile(self, session_id: str) -> Optional[dict]:
+        """Profile of current state (columns, non-null counts, min/max, first rows) computed once per state
+
+        Args:
+            session_id (str): session id
+
+        Returns:
+            Optional[dict]: profile, render it with df_profile.render_profile. None for empty session
+        """
+        info = self.get_current_state_info(session_id)
+        if not info:
+            return None
+        filename = info["filename"]
+        if self.writer is not None and self.writer.is_pending(filename):
+            # profile is written together with the state
+            self._wait_written(session_id, filename)
+        profile = self._read_profile(session_id, filename)
+        if profile is None:
+            # states saved before profiles existed
+            df = self.load_current_df(session_id)
+            digests = self.digest_memo.digests(df)
+            profile = df_profile.build_profile(df, digests, footer=self._footer_source(filename, digests))
+            self.r.set(self.profile_key(session_id, filename), json.dumps(profile, ensure_ascii=False))
+        return profile
     def get_current_state_info(self, session_id: str) -> Optional[dict]:
         """Function for getting current info about state in redis db
 
@@ -108,24 +540,15 @@ class MemoryManager():
         Returns:
             Optional[dict]: meta dict or empty dict
         """
-        first_key = f"session:{session_id}:states"
-        idx_key = f"session:{session_id}:idx"
-        length = self.r.llen(first_key)
-        if length == 0:
-            return None
-        idx = int(self.r.get(idx_key) or 0)
-        idx = max(0, min(idx,length - 1))
-        filename = self.r.lindex(first_key, idx)
-        meta_key = f"session:{session_id}:meta"
-        meta = self.r.hgetall(meta_key) or {}
-        meta.update({"index":idx,
-                     "filename":filename})
-        return meta
-    def load_current_df(self,session_id: str) -> Optional[pd.DataFrame]:
-        """Loading current dataframe by session_id
+        return self.scripts.checkout(self.session_keys(session_id), self.node_prefix(session_id))
+    @tracing.traced("load")
+    def load_current_df(self,session_id: str, columns: Optional[list] = None) -> Optional[pd.DataFrame]:
+        """Loading current dataframe by session_id, recently used states are taken from memory
 
         Args:
             session_id (str): session id
+            columns (Optional[list], optional): load only these columns, unknown names are skipped.
+                If none of them exists the whole df is loaded. Defaults to None (all columns).
 
         Raises:
             FileNotFoundError: if no file founded on system
@@ -133,13 +556,95 @@ class MemoryManager():
         Returns:
             Optional[pd.DataFrame]: returns dataframe from .parquet
         """
+        # last use of the session for retention
+        self.r.set(self.session_key(session_id, "seen"), int(time.time()))
+        try:
+            return self._load_state(session_id, columns)
+        except FileNotFoundError:
+            # state was moved to another tier between reading its name and opening the file
+            return self._load_state(session_id, columns)
+    def _load_state(self, session_id: str, columns: Optional[list] = None) -> Optional[pd.DataFrame]:
         info = self.get_current_state_info(session_id)
         if not info:
             return None
         filename = info.get("filename")
+        tracing.current().set(session_id=session_id, step=info.get("step"))
+        cached = self.frame_cache.get(filename) if filename else None
+        if cached is None and filename and self.writer is not None:
+            pending = self.writer.get(filename)
+            cached = pending.copy(deep=False) if pending is not None else None
+        if cached is not None:
+            if columns:
+                selected = [col for col in cached.columns if col in set(columns)]
+                if selected:
+                    # df[list] would copy the columns, the projection shares memory with the cached state
+                    return pd.DataFrame({col: cached[col] for col in selected}, copy=False)
+            return cached
         if not filename or not os.path.exists(filename):
             raise FileNotFoundError(f"State file missing: {filename}")
-        return pd.read_parquet(filename)
+        if columns:
+            selected = [col for col in self._state_columns(filename) if col in set(columns)]
+            if selected:
+                # partial frame is not cached, cache holds only whole states
+                return self._read_state(filename, columns=selected)
+        df = self._read_state(filename)
+        profile = self._read_profile(session_id, filename)
+        if profile:
+            # hashes of loaded columns are known from the profile, next push will not compute them again
+            known = {col["name"]: (col["digest"], col["dtype"]) for col in profile["columns"]}
+            for name in df.columns:
+                digest, dtype = known.get(name, (None, None))
+                if digest and dtype == str(df[name].dtype):
+                    self.digest_memo.remember(df[name], digest)
+        if self.frame_cache.put(filename, df):
+            return df.copy(deep=False)
+        return df
+    def get_sample(self, session_id: str, rows: int = 10000, df: Optional[pd.DataFrame] = None,
+                   signature: Optional[str] = None) -> Optional[pd.DataFrame]:
+        """Stratified sample of current state for previews. Samples are kept by state signature
+        in memory and as parquet files, so the same content is sampled once, after undo/redo too.
+
+        Args:
+            session_id (str): session id
+            rows (int, optional): size of the sample. Defaults to 10000.
+            df (Optional[pd.DataFrame], optional): current df if already loaded. Defaults to None.
+            signature (Optional[str], optional): signature of current df if already known, then a saved sample
+                is returned without loading the state. Defaults to None.
+
+        Returns:
+            Optional[pd.DataFrame]: sample or None if session has no state
+        """
+        if df is None and signature is None:
+            df = self.load_current_df(session_id)
+            if df is None:
+                return None
+        if df is not None and len(df) <= rows:
+            return df
+        signature = signature or self.fingerprint(df)
+        name = hashlib.sha256(f"{signature}||{rows}".encode("utf-8")).hexdigest()
+        path = os.path.join(self.storage_dir, "samples", f"{name}.parquet")
+        sample = self.frame_cache.get(path)
+        if sample is not None:
+            return sample
+        if os.path.exists(path):
+            sample = pd.read_parquet(path)
+        else:
+            # the whole state is loaded only when its sample is not saved yet
+            if df is None:
+                df = self.load_current_df(session_id)
+                if df is None:
+                    return None
+                if len(df) <= rows:
+                    return df
+            sample = sampling.stratified_sample(df, rows)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            os.close(fd)
+            sample.to_parquet(tmp)
+            os.replace(tmp, path)
+        self.frame_cache.put(path, sample)
+        return sample
+    @tracing.traced("push")
     def push_result(self,session_id: str, df_new: pd.DataFrame, code: str = '', note: Optional[str] = None)-> dict:
         """Calling function after succesfull llm code launch and checks for changes in df
 
@@ -153,51 +658,248 @@ class MemoryManager():
             dict: updated meta data with structure changed bool and llm_code str
         """
 
-        df_before = self.load_current_df(session_id)
-        cols_before = set(df_before.columns) if df_before is not None else set()
+        previous = self.get_current_state_info(session_id)
+        cols_before = set(self._columns_of(session_id, previous["filename"])) if previous else set()
         cols_after = set(df_new.columns)
 
-        meta = self._push_new_state(session_id, df_new, note=note)
+        df_new, report = self._compact(session_id, df_new)
+        meta = self._push_new_state(session_id, df_new, note=note, background=True, code=code, compacted=report)
+        self.schedule_migration(session_id)
+        if report is not None:
+            meta["compaction"] = report
 
         structure_changed = cols_before != cols_after
 
         meta["structure_changed"] = structure_changed
         meta["llm_code"] = code
+        tracing.current().set(session_id=session_id, step=meta.get("step"))
         return meta
+    def _columns_of(self, session_id: str, filename: str) -> list:
+        """Column names of a state from its stored profile, without loading the state"""
+        pending = self.writer.get(filename) if self.writer is not None else None
+        if pending is not None:
+            return list(pending.columns)
+        profile = self._read_profile(session_id, filename)
+        if profile is not None:
+            return [col["name"] for col in profile["columns"]]
+        return self._state_columns(filename)
+    @tracing.traced("undo")
     def undo(self, session_id: str) -> Optional[dict]:
-        """unfo function for user to undo what he did, changing index to select previous meta data
+        """unfo function for user to undo what he did, the parent of current state becomes current
 
         Args:
             session_id (str): session id
 
+        Raises:
+            StateLostError: if the current state could not be written, it is dropped and its parent is current
+
         Returns:
             Optional[dict]: current state by idx info
         """
-        first_key = f"session:{session_id}:states"
-        idx_key = f"session:{session_id}:idx"
-        length = self.r.llen(first_key)
-        if length == 0:
-            return None
-        idx = int(self.r.get(idx_key) or 0)
-        if idx <= 0:
-            return self.get_current_state_info(session_id)
-        new_idx = idx - 1
-        self.r.set(idx_key,new_idx)
-        return self.get_current_state_info(session_id)
+        self.before_move(session_id)
+        return self.after_move(session_id, self.scripts.checkout(self.session_keys(session_id), self.node_prefix(session_id), "parent"))
+    @tracing.traced("redo")
     def redo(self,session_id: str) -> Optional[dict]:
-        first_key = f"session:{session_id}:states"
-        idx_key = f"session:{session_id}:idx"
-        length = self.r.llen(first_key)
-        if length == 0:
-            return None
-        idx = int(self.r.get(idx_key) or 0)
-        if idx >= length - 1:
-            return self.get_current_state_info(session_id)
-        new_idx = idx + 1
-        self.r.set(idx_key, new_idx)
-        return self.get_current_state_info(session_id)
+        """Back to the child the session left last by undo (or the last pushed child)"""
+        return self.after_move(session_id, self.scripts.checkout(self.session_keys(session_id), self.node_prefix(session_id), "child"))
+    @tracing.traced("checkout")
+    def checkout(self, session_id: str, step: int) -> Optional[dict]:
+        """Making any state of the session current, the next push starts a new branch from it
+
+        Args:
+            session_id (str): session id
+            step (int): step of the state
+
+        Raises:
+            StateLostError: if the current state could not be written, it is dropped and its parent is current
+
+        Returns:
+            Optional[dict]: meta of the state, None if the session has no such step
+        """
+        self.before_move(session_id)
+        return self.after_move(session_id, self.scripts.checkout(self.session_keys(session_id), self.node_prefix(session_id), int(step)))
+    def before_move(self, session_id: str) -> None:
+        """State being left must be on disk before it is only reachable by redo or checkout.
+        Callers moving the head with their own checkout call it before, and after_move after it
+
+        Raises:
+            StateLostError: if the state could not be written, the head is its parent then
+        """
+        if self.writer is not None:
+            current = self.get_current_state_info(session_id)
+            if current and self.writer.is_pending(current["filename"]):
+                self._wait_written(session_id, current["filename"])
+    def _wait_written(self, session_id: str, filename: str) -> None:
+        """Waiting for background writing of a state. Failed writing is repeated in this thread,
+        if it fails again the state is dropped from the session instead of staying pending forever
+
+        Raises:
+            StateLostError: if the state could not be written
+        """
+        try:
+            self.writer.wait(filename)
+            return
+        except RuntimeError:
+            pass
+        try:
+            self.writer.retry(filename)
+        except Exception as e:
+            self._drop_unwritten(session_id, filename)
+            raise StateLostError(f"Состояние {filename} не записано на диск и удалено из истории: {e}") from e
+    def _drop_unwritten(self, session_id: str, filename: str) -> None:
+        """Removing a state which is not on disk from its session, the head moves to its parent"""
+        self.scripts.drop(self.session_keys(session_id), self.pending_key(session_id), self.node_prefix(session_id),
+                          self._step_of(filename), filename)
+        self.forget_state(session_id, filename)
+        if self.writer is not None:
+            self.writer.discard(filename)
+        self.remove_state_file(filename)
+    def forget_state(self, session_id: str, filename: str) -> None:
+        """Profile, last use time and cached frame of a state dropped from its session, the file is left
+        to remove_state_file"""
+        self.r.delete(self.profile_key(session_id, filename))
+        self.r.zrem(self.access_key(session_id), filename)
+        self.frame_cache.invalidate(filename)
+    def history(self, session_id: str, step: Optional[int] = None) -> list:
+        """Branch of a state: metadata of the states from the first one to step, read only from redis
+
+        Args:
+            session_id (str): session id
+            step (Optional[int], optional): last state of the branch. Defaults to None (current state).
+
+        Returns:
+            list: meta dicts of the branch, the oldest first
+        """
+        return self.scripts.branch(self.session_keys(session_id), self.node_prefix(session_id), step)
+    def tree(self, session_id: str) -> list:
+        """Metadata of all states of the session in step order, every meta has its parent step"""
+        steps = self.r.zrange(self.session_keys(session_id)[2], 0, -1)
+        pipe = self.r.pipeline()
+        for step in steps:
+            pipe.hgetall(self.node_prefix(session_id) + step)
+        return [self.scripts.decode_meta(fields) for fields in pipe.execute() if fields]
+    def lineage(self, session_id: str, column: str, step: Optional[int] = None) -> list:
+        """Steps of a branch which added, removed or changed a column, from metadata only.
+        States still being written (write-behind) are known by added and removed columns only.
+
+        Args:
+            session_id (str): session id
+            column (str): column name
+            step (Optional[int], optional): last state of the branch. Defaults to None (current state).
+
+        Returns:
+            list: meta dicts of the steps with "change" - "added", "removed" or "modified"
+        """
+        result = []
+        previous = None
+        for meta in self.history(session_id, step):
+            columns = set(meta.get("schema", {}))
+            changes = meta.get("changes")
+            if changes is None and previous is not None:
+                # not persisted yet: schema of the parent tells only added and removed columns
+                old = set(previous.get("schema", {}))
+                changes = {"added": list(columns - old), "removed": list(old - columns), "modified": []}
+            for change in ("added", "removed", "modified"):
+                if changes and column in changes[change]:
+                    result.append({**meta, "change": change})
+                    break
+            previous = meta
+        return result
+    def after_move(self, session_id: str, meta: Optional[dict]) -> Optional[dict]:
+        """State became current by undo/redo: it is recently used now, tiers are rebalanced"""
+        if meta:
+            self._touch(session_id, meta["filename"])
+            self.schedule_migration(session_id)
+        return meta
+    def set_tiering(self, session_id: str, hot_format: Optional[str] = None, hot_states: Optional[int] = None) -> None:
+        """Per-session choice of hot state format, overrides the manager defaults
+
+        Args:
+            session_id (str): session id
+            hot_format (Optional[str], optional): "arrow", "arrow_lz4" or "none" to keep all states cold.
+                Defaults to None (manager default).
+            hot_states (Optional[int], optional): amount of hot states. Defaults to None (manager default).
+        """
+        if hot_format not in (None, "none") and hot_format not in self.formats:
+            raise ValueError(f"Unknown state format: {hot_format}")
+        config = {}
+        if hot_format is not None:
+            config["hot_format"] = hot_format
+        if hot_states is not None:
+            config["hot_states"] = hot_states
+        if config:
+            self.r.hset(self.session_key(session_id, "tiers"), mapping=config)
+        self.schedule_migration(session_id)
+    def tiering(self, session_id: str) -> Tuple[Optional[str], int]:
+        """(hot format or None, amount of hot states) of the session"""
+        config = self.r.hgetall(self.session_key(session_id, "tiers"))
+        hot_format = config.get("hot_format", self.hot_format)
+        return (None if hot_format in (None, "none") else hot_format,
+                int(config.get("hot_states", self.hot_states)))
+    @classmethod
+    def access_key(cls, session_id: str) -> str:
+        """Sorted set of state files by last use time"""
+        return cls.session_key(session_id, "access")
+    def _touch(self, session_id: str, filename: str) -> None:
+        self.r.zadd(self.access_key(session_id), {filename: time.time()})
+    def schedule_migration(self, session_id: str) -> None:
+        """Moving states between tiers in a background thread"""
+        if self._tiering_pool is None:
+            self._tiering_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-tiers")
+        self._tiering_pool.submit(self._migrate_logged, session_id)
+    def _migrate_logged(self, session_id: str) -> None:
+        try:
+            self.migrate(session_id)
+        except Exception:
+            logger.exception("Ошибка переноса состояний сессии %s", session_id)
+    def migrate(self, session_id: str) -> dict:
+        """Recently used states go to hot format, others to storage_mode format. States being written are skipped.
+
+        Args:
+            session_id (str): session id
+
+        Returns:
+            dict: new filenames by old ones
+        """
+        hot_format, hot_states = self.tiering(session_id)
+        keys = self.session_keys(session_id)
+        recent = set(self.r.zrevrange(self.access_key(session_id), 0, hot_states - 1)) if hot_format else set()
+        moved = {}
+        for filename in self.r.lrange(keys[0], 0, -1):
+            if self.writer is not None and self.writer.is_pending(filename):
+                continue
+            target = hot_format if filename in recent else self.storage_mode
+            current = format_of(self.formats, filename)
+            if current is self.formats[target] or not os.path.exists(filename):
+                continue
+            new_filename = filename[:-len(current.suffix)] + self.formats[target].suffix
+            cached = self.frame_cache.get(filename)
+            df = cached if cached is not None else self._read_state(filename)
+            digests = self.digest_memo.digests(df)
+            self._write_state(new_filename, df, digests=digests, fmt=target)
+            position = self.scripts.rename(keys[0], self.access_key(session_id),
+                                           [self.profile_key(session_id, filename),
+                                            self.profile_key(session_id, new_filename)],
+                                           self.node_prefix(session_id) + str(self._step_of(filename)),
+                                           filename, new_filename)
+            if position < 0:
+                # state was dropped meanwhile, or another migration has already moved it to the same file
+                if new_filename not in self.r.lrange(keys[0], 0, -1):
+                    self.remove_state_file(new_filename)
+                continue
+            self.frame_cache.invalidate(filename)
+            if cached is not None:
+                self.frame_cache.put(new_filename, cached)
+            # a reader which has just read the old name retries with the new one
+            self.remove_state_file(filename)
+            moved[filename] = new_filename
+        return moved
+    @staticmethod
+    def _normalize_query(user_query: str) -> str:
+        """Bringing user query to one form: lower case, single spaces, no trailing punctuation"""
+        return " ".join(user_query.lower().split()).rstrip(" .!?")
     @staticmethod
-    def _cache_key(prompt_template: str, df_description: str, user_query: str) -> str:
+    def cache_key(prompt_template: str, df_description: str, user_query: str) -> str:
         """static function for caching info for redis. Prompt, info about df and users query
 
         Args:
@@ -208,13 +910,55 @@ class MemoryManager():
         Returns:
             str: hash of all that combain info
         """
-        s = "||".join([prompt_template,df_description,user_query])
+        s = "||".join([prompt_template,df_description,MemoryManager._normalize_query(user_query)])
         return hashlib.sha256(s.encode("utf-8")).hexdigest()
-    def get_cache(self, prompt_template: str, df_description: str, user_query: str,ttl_seconds: int = 60 * 60 * 24) -> Optional[dict]:
-        key = self._cache_key(prompt_template,df_description)
+    def get_cache(self, prompt_template: str, df_description: str, user_query: str) -> Optional[dict]:
+        """Reading cached llm answer for the same prompt, dataframe state and query
+
+        Args:
+            prompt_template (str): current prompt
+            df_description (str): signature of current dataframe state
+            user_query (str): users query
+
+        Returns:
+            Optional[dict]: cached payload or None. Failed generation is cached with "error" key
+        """
+        key = self.cache_key(prompt_template,df_description,user_query)
+        raw = self.r.get(f"llmcache:{key}")
+        if raw is None:
+            self.llm_cache_stats["misses"] += 1
+            tracing.cache_event("llm", "miss")
+            return None
+        payload = json.loads(raw)
+        event = "negative_hits" if payload.get("error") else "hits"
+        self.llm_cache_stats[event] += 1
+        tracing.cache_event("llm", event[:-1])
+        return payload
+    def set_cache(self, prompt_template: str, df_description: str, user_query: str, payload: dict, ttl_seconds: int = 60 * 60 * 24) -> None:
+        """Saving llm answer to cache
+
+        Args:
+            prompt_template (str): current prompt
+            df_description (str): signature of current dataframe state
+            user_query (str): users query
+            payload (dict): answer of the model, for example code and comment
+            ttl_seconds (int, optional): time to live of the record. Defaults to one day.
+        """
+        key = self.cache_key(prompt_template,df_description,user_query)
         redis_key = f"llmcache:{key}"
         payload = dict(payload)
         current_tz = datetime.now(self.tz)
         payload.setdefault("created_at",current_tz.isoformat())
-        self.r.set(redis_key, json.dumps(payload),ex=ttl_seconds)
-    
\ No newline at end of file
+        self.r.set(redis_key, json.dumps(payload, ensure_ascii=False),ex=ttl_seconds)
+        self.llm_cache_stats["writes"] += 1
+    def set_negative_cache(self, prompt_template: str, df_description: str, user_query: str, error: str, ttl_seconds: int = 60 * 5) -> None:
+        """Remembering failed generation for a short time, so the same broken query is not sent again at once
+
+        Args:
+            prompt_template (str): current prompt
+            df_description (str): signature of current dataframe state
+            user_query (str): users query
+            error (str): error text
+            ttl_seconds (int, optional): time to live of the record. Defaults to 5 minutes.
+        """
+        self.set_cache(prompt_template, df_description, user_query, {"error": error}, ttl_seconds=ttl_seconds)
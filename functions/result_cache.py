@@ -0,0 +1,144 @@
+import os
+import ast
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, Any
+from functions import tracing
+
+
+def code_hash(code: str) -> Optional[str]:
+    """Hash of normalized syntax tree: formatting, comments and quotes do not change it
+
+    Args:
+        code (str): generated code
+
+    Returns:
+        Optional[str]: hex digest or None if code does not compile
+    """
+    try:
+        tree = ast.parse(code.strip())
+    except SyntaxError:
+        return None
+    dump = ast.dump(tree, annotate_fields=False, include_attributes=False)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+
+class ResultCache():
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024 ** 2, max_entry_bytes: int = 16 * 1024 ** 2):
+        """Disk cache of results of read-only code by (state signature, code hash). Same code on the same
+        state content gives the same result, after undo/redo or from another session as well.
+        Values are pickled, least recently used ones are removed when the folder exceeds max_bytes.
+
+        Args:
+            cache_dir (str): folder of cached results
+            max_bytes (int, optional): size budget of the folder, 0 disables the cache. Defaults to 256 MiB.
+            max_entry_bytes (int, optional): bigger results are not cached. Defaults to 16 MiB.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # results written by previous runs, oldest used first
+        files = []
+        for name in os.listdir(cache_dir):
+            if name.endswith(".pkl"):
+                stat = os.stat(os.path.join(cache_dir, name))
+                files.append((stat.st_mtime, name[:-len(".pkl")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self.current_bytes += size
+    @staticmethod
+    def key(signature: str, code: str) -> Optional[str]:
+        digest = code_hash(code)
+        if digest is None:
+            return None
+        return hashlib.sha256(f"{signature}||{digest}".encode("utf-8")).hexdigest()
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+    def get(self, key: Optional[str]) -> Tuple[bool, Any]:
+        """Reading cached result
+
+        Args:
+            key (Optional[str]): key from ResultCache.key
+
+        Returns:
+            Tuple[bool, Any]: (found, value), value can be None only when not found
+        """
+        if key is None or not self.max_bytes:
+            return False, None
+        with self._lock:
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as file:
+                value = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                if known and self._entries.pop(key, None) is not None:
+                    self._recount()
+                self.misses += 1
+            tracing.cache_event("result", "miss")
+            return False, None
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        tracing.cache_event("result", "hit")
+        with self._lock:
+            self.hits += 1
+            if not known:
+                # written by another process sharing the folder
+                self._entries[key] = os.path.getsize(self._path(key))
+                self.current_bytes += self._entries[key]
+        return True, value
+    def put(self, key: Optional[str], value: Any) -> bool:
+        """Saving result of read-only code
+
+        Args:
+            key (Optional[str]): key from ResultCache.key
+            value (Any): scalar, Series, small DataFrame or other picklable result
+
+        Returns:
+            bool: False if result was not cached (too big, not picklable, no key)
+        """
+        if key is None or value is None or not self.max_bytes:
+            return False
+        try:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        size = len(payload)
+        if size > min(self.max_entry_bytes, self.max_bytes):
+            return False
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(payload)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self.current_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.current_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+        return True
+    def _recount(self) -> None:
+        self.current_bytes = sum(self._entries.values())
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes}
@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Optional, Callable, Dict, List
+from functions.column_store import MANIFEST_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+
+class Retention():
+    def __init__(self, mgr, ttl_seconds: float = 0, max_steps: int = 0, max_bytes: int = 0,
+                 chunk_grace_seconds: float = 600, on_expire: Optional[Callable[[str], None]] = None):
+        """Retention of session states: sessions unused for ttl_seconds are deleted with their files and redis keys,
+        sessions with more than max_steps states or max_bytes on disk are squashed: the oldest intermediate
+        states are removed and their changes and code are merged into the next state, which becomes a checkpoint.
+        Column chunks shared by states are deleted only when no manifest refers to them.
+        Limits can be changed per session by set_policy, 0 means no limit.
+
+        Args:
+            mgr (MemoryManager): manager of the storage folder
+            ttl_seconds (float, optional): lifetime of an unused session. Defaults to 0.
+            max_steps (int, optional): most states of a session. Defaults to 0.
+            max_bytes (int, optional): most bytes of state files of a session. Defaults to 0.
+            chunk_grace_seconds (float, optional): chunks without references are deleted after this delay,
+                a state being written at the moment may take them again. Defaults to 600.
+            on_expire (Optional[Callable[[str], None]], optional): called with session id after the session
+                is deleted, for files kept outside of the manager. Defaults to None.
+        """
+        self.mgr = mgr
+        self.r = mgr.r
+        self.ttl_seconds = ttl_seconds
+        self.max_steps = max_steps
+        self.max_bytes = max_bytes
+        self.chunk_grace_seconds = chunk_grace_seconds
+        self.on_expire = on_expire
+        self.totals = {"sweeps": 0, "sessions_expired": 0, "states_removed": 0, "chunks_removed": 0,
+                       "bytes_reclaimed": 0, "last_sweep_seconds": None, "last_sweep_at": None}
+        self._stop = threading.Event()
+        self._thread = None
+    def _policy_key(self, session_id: str) -> str:
+        return self.mgr.session_key(session_id, "retention")
+    def set_policy(self, session_id: str, ttl_seconds: Optional[float] = None, max_steps: Optional[int] = None,
+                   max_bytes: Optional[int] = None) -> None:
+        """Per-session limits, override the defaults. None keeps the current value, 0 removes the limit"""
+        config = {name: value for name, value in (("ttl_seconds", ttl_seconds), ("max_steps", max_steps),
+                                                   ("max_bytes", max_bytes)) if value is not None}
+        if any(value < 0 for value in config.values()):
+            raise ValueError("Retention limits must not be negative")
+        if config:
+            self.r.hset(self._policy_key(session_id), mapping=config)
+    def policy(self, session_id: str) -> dict:
+        config = self.r.hgetall(self._policy_key(session_id))
+        return {"ttl_seconds": float(config.get("ttl_seconds", self.ttl_seconds)),
+                "max_steps": int(config.get("max_steps", self.max_steps)),
+                "max_bytes": int(config.get("max_bytes", self.max_bytes))}
+    def sessions(self) -> List[str]:
+        return [self.mgr.session_id_of(key) for key in self.r.scan_iter("session:{*}:states")]
+    def last_used(self, session_id: str) -> Optional[float]:
+        """Time of the last load or state change of the session"""
+        times = []
+        seen = self.r.get(self.mgr.session_key(session_id, "seen"))
+        if seen:
+            times.append(float(seen))
+        touched = self.r.zrevrange(self.mgr.access_key(session_id), 0, 0, withscores=True)
+        if touched:
+            times.append(touched[0][1])
+        info = self.mgr.get_current_state_info(session_id)
+        if info and os.path.exists(info["filename"]):
+            times.append(os.path.getmtime(info["filename"]))
+        return max(times) if times else None
+    def _busy(self, session_id: str) -> bool:
+        """Session has states being written by a live process"""
+        owners = self.r.hvals(self.mgr.pending_key(session_id))
+        return any(self.r.exists(f"writer:{owner}") for owner in owners)
+    def expire(self, session_id: str) -> Optional[dict]:
+        """Deleting the session: state files (chunks are released), profiles, queries and all other keys
+
+        Returns:
+            Optional[dict]: removed "states" and their "bytes", None if states of the session are being written
+        """
+        if self._busy(session_id):
+            return None
+        keys = self.mgr.session_keys(session_id)
+        report = {"states": 0, "bytes": 0}
+        for filename in self.r.lrange(keys[0], 0, -1):
+            self.mgr.frame_cache.invalidate(filename)
+            report["bytes"] += self.mgr.remove_state_file(filename)
+            report["states"] += 1
+        batch = []
+        for key in self.r.scan_iter(self.mgr.session_key(session_id, "*")):
+            batch.append(key)
+            if len(batch) >= 500:
+                self.r.delete(*batch)
+                batch = []
+        if batch:
+            self.r.delete(*batch)
+        if self.on_expire is not None:
+            self.on_expire(session_id)
+        return report
+    def prune(self, session_id: str) -> dict:
+        """Squashing the session down to max_steps states and max_bytes. The current state, the first state
+        and states being written are kept. Intermediate states (one child) go first, oldest first,
+        then leaves of abandoned branches.
+
+        Returns:
+            dict: removed "states" and "bytes" of their files
+        """
+        policy = self.policy(session_id)
+        report = {"states": 0, "bytes": 0}
+        if not policy["max_steps"] and not policy["max_bytes"]:
+            return report
+        nodes = {meta["step"]: meta for meta in self.mgr.tree(session_id)}
+        pending = set(self.r.hkeys(self.mgr.pending_key(session_id)))
+        files: Dict[str, List[str]] = {}
+        sizes: Dict[str, int] = {}
+        while (policy["max_steps"] and len(nodes) > policy["max_steps"]) or \
+                (policy["max_bytes"] and self._bytes(nodes, files, sizes) > policy["max_bytes"]):
+            info = self.mgr.get_current_state_info(session_id)
+            step = self._victim(nodes, info["step"] if info else None, pending)
+            if step is None:
+                break
+            freed = self._remove(session_id, nodes, step)
+            if freed is None:
+                # became current meanwhile
+                pending.add(nodes[step]["filename"])
+                continue
+            report["states"] += 1
+            report["bytes"] += freed
+        return report
+    @staticmethod
+    def _victim(nodes: dict, head: Optional[int], pending: set) -> Optional[int]:
+        children = {}
+        for step, meta in nodes.items():
+            if meta.get("parent") in nodes:
+                children.setdefault(meta["parent"], []).append(step)
+        def removable(step):
+            meta = nodes[step]
+            return step != head and meta.get("parent") in nodes and meta["filename"] not in pending
+        intermediate = [step for step in sorted(nodes) if removable(step) and len(children.get(step, [])) == 1
+                        and nodes[children[step][0]]["filename"] not in pending]
+        if intermediate:
+            return intermediate[0]
+        leaves = [step for step in sorted(nodes) if removable(step) and not children.get(step)]
+        return leaves[0] if leaves else None
+    def _remove(self, session_id: str, nodes: dict, step: int) -> Optional[int]:
+        """Removing one state, its only child takes over its changes and code. Returns freed bytes,
+        None if the state is current now"""
+        meta = nodes[step]
+        prefix = self.mgr.node_prefix(session_id)
+        children = [child for child, child_meta in nodes.items() if child_meta.get("parent") == step]
+        position = self.mgr.scripts.drop(self.mgr.session_keys(session_id), self.mgr.pending_key(session_id),
+                                         prefix, step, meta["filename"], keep_head=True)
+        if position == -2:
+            return None
+        del nodes[step]
+        if position == -1:
+            return 0
+        self.mgr.forget_state(session_id, meta["filename"])
+        for child in children:
+            child_meta = nodes[child]
+            if "parent" in meta:
+                child_meta["parent"] = meta["parent"]
+            else:
+                child_meta.pop("parent", None)
+            if len(children) == 1:
+                fields = self._squashed(meta, child_meta)
+                child_meta.update(fields)
+                self.mgr.scripts.update_meta(prefix + str(child), {
+                    name: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+                    for name, value in fields.items()})
+        return self.mgr.remove_state_file(meta["filename"])
+    @staticmethod
+    def _squashed(removed: dict, child: dict) -> dict:
+        """Meta of a checkpoint: changes and code of the removed state and of its child as one step"""
+        fields = {"code": "\n".join(code for code in (removed.get("code"), child.get("code")) if code),
+                  "squashed": removed.get("squashed", []) + [removed["step"]] + child.get("squashed", [])}
+        first, second = removed.get("changes"), child.get("changes")
+        if first is not None and second is not None:
+            added = [name for name in first["added"] if name not in second["removed"]] + \
+                    [name for name in second["added"] if name not in first["removed"]]
+            removed_columns = [name for name in first["removed"] if name not in second["added"]] + \
+                              [name for name in second["removed"] if name not in first["added"]]
+            modified = [name for name in first["modified"] + second["modified"]
+                        if name not in added and name not in removed_columns]
+            # removed and added again - the same column with other values
+            modified += [name for name in first["removed"] if name in second["added"]]
+            fields["changes"] = {"added": added, "removed": removed_columns, "modified": list(dict.fromkeys(modified))}
+        return fields
+    def _bytes(self, nodes: dict, files: dict, sizes: dict) -> int:
+        """Disk size of the states, column chunks shared by several states are counted once"""
+        total = 0
+        seen = set()
+        for meta in nodes.values():
+            filename = meta["filename"]
+            if filename not in files:
+                files[filename] = [filename]
+                if filename.endswith(MANIFEST_SUFFIX):
+                    try:
+                        manifest = self.mgr.column_store.read_manifest(filename)
+                        files[filename] += [self.mgr.column_store.chunk_path(entry["chunk"]) for entry in manifest["columns"]]
+                    except (OSError, ValueError):
+                        pass
+            for path in files[filename]:
+                if path in seen:
+                    continue
+                seen.add(path)
+                if path not in sizes:
+                    sizes[path] = os.path.getsize(path) if os.path.exists(path) else 0
+                total += sizes[path]
+        return total
+    def sweep(self) -> dict:
+        """One pass over all sessions: expiring unused ones, squashing the others, deleting free chunks
+
+        Returns:
+            dict: sessions checked, expired, states and chunks removed, reclaimed bytes of this pass
+        """
+        started = time.time()
+        report = {"sessions": 0, "expired": 0, "states": 0, "chunks": 0, "bytes": 0}
+        for session_id in self.sessions():
+            report["sessions"] += 1
+            try:
+                ttl = self.policy(session_id)["ttl_seconds"]
+                last_used = self.last_used(session_id) if ttl else None
+                if last_used is not None and started - last_used > ttl:
+                    removed = self.expire(session_id)
+                    if removed is not None:
+                        report["expired"] += 1
+                else:
+                    removed = self.prune(session_id)
+                if removed is not None:
+                    report["states"] += removed["states"]
+                    report["bytes"] += removed["bytes"]
+            except Exception:
+                logger.exception("Ошибка очистки сессии %s", session_id)
+        chunks, freed = self.mgr.column_store.collect(self.chunk_grace_seconds)
+        report["chunks"] += chunks
+        report["bytes"] += freed
+        if self.ttl_seconds:
+            # samples of previews are shared by content, old ones are not used by any live session
+            report["bytes"] += self._remove_old(os.path.join(self.mgr.storage_dir, "samples"), self.ttl_seconds)
+        self.totals["sweeps"] += 1
+        self.totals["sessions_expired"] += report["expired"]
+        self.totals["states_removed"] += report["states"]
+        self.totals["chunks_removed"] += report["chunks"]
+        self.totals["bytes_reclaimed"] += report["bytes"]
+        self.totals["last_sweep_seconds"] = round(time.time() - started, 3)
+        self.totals["last_sweep_at"] = started
+        return report
+    @staticmethod
+    def _remove_old(folder: str, max_age: float) -> int:
+        freed = 0
+        if not os.path.isdir(folder):
+            return freed
+        for entry in os.scandir(folder):
+            try:
+                if entry.is_file() and time.time() - entry.stat().st_mtime > max_age:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    freed += size
+            except OSError:
+                pass
+        return freed
+    def stats(self) -> dict:
+        return dict(self.totals)
+    def start(self, interval: float = 300) -> None:
+        """Sweeping in a background thread every interval seconds"""
+        if self._thread is not None:
+            return
+        def _run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception("Ошибка очистки хранилища")
+        self._thread = threading.Thread(target=_run, name="retention", daemon=True)
+        self._thread.start()
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
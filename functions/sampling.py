@@ -0,0 +1,67 @@
+from typing import Optional, List
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_integer_dtype, is_object_dtype, is_string_dtype
+
+# columns with more distinct values are not used as strata
+MAX_GROUPS = 50
+
+
+def strata_columns(df: pd.DataFrame, max_columns: int = 2, max_groups: int = MAX_GROUPS) -> List[str]:
+    """Low-cardinality columns to stratify by: categories, strings, bools and small integer codes.
+    Candidates are checked on the first rows first, so high-cardinality columns of a large df
+    are not counted in full.
+
+    Args:
+        df (pd.DataFrame): state
+        max_columns (int, optional): most columns in strata. Defaults to 2.
+        max_groups (int, optional): most distinct values of a column. Defaults to MAX_GROUPS.
+
+    Returns:
+        List[str]: columns ordered by number of distinct values
+    """
+    head = df.head(10000)
+    candidates = []
+    for name in df.columns:
+        dtype = df[name].dtype
+        if not (isinstance(dtype, pd.CategoricalDtype) or is_bool_dtype(dtype) or is_object_dtype(dtype)
+                or is_string_dtype(dtype) or is_integer_dtype(dtype)):
+            continue
+        if head[name].nunique(dropna=False) > max_groups:
+            continue
+        groups = df[name].nunique(dropna=False)
+        if 1 < groups <= max_groups:
+            candidates.append((groups, name))
+    return [name for _, name in sorted(candidates, key=lambda item: item[0])[:max_columns]]
+
+
+def stratified_sample(df: pd.DataFrame, rows: int, strata: Optional[List[str]] = None, seed: int = 0) -> pd.DataFrame:
+    """Random rows with the same shares of strata groups as in df, every group gets at least one row,
+    so rare categories are present in the preview. Rows keep their order and index.
+
+    Args:
+        df (pd.DataFrame): state
+        rows (int): size of the sample
+        strata (Optional[List[str]], optional): columns to stratify by. Defaults to strata_columns(df).
+        seed (int, optional): random seed, the same state gives the same sample. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: sample, df itself if it is not bigger than rows
+    """
+    n = len(df)
+    if n <= rows:
+        return df
+    rng = np.random.default_rng(seed)
+    strata = strata_columns(df) if strata is None else strata
+    if not strata:
+        positions = np.sort(rng.choice(n, size=rows, replace=False))
+        return df.iloc[positions]
+    groups = df.groupby(strata, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    sizes = np.bincount(groups)
+    quota = np.maximum(1, np.floor(sizes * rows / n)).astype(np.int64)
+    # random order inside groups: row is taken if its rank in the group is below the group quota
+    order = np.lexsort((rng.random(n, dtype=np.float32), groups))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    ranks = np.arange(n) - starts[groups[order]]
+    positions = np.sort(order[ranks < quota[groups[order]]])
+    return df.iloc[positions]
@@ -0,0 +1,182 @@
+import re
+import difflib
+from collections import OrderedDict
+from typing import Optional, Dict, List, Callable
+from functions.df_profile import render_profile, shown_dtype
+from functions import tracing
+
+DTYPE_SHORT = {"float64": "f64", "float32": "f32", "int64": "i64", "int32": "i32", "int8": "i8", "int16": "i16",
+               "uint8": "u8", "bool": "bool", "object": "str", "category": "cat", "datetime64[ns]": "datetime"}
+# columns with the same name pattern and dtype are shown as one line starting from this size
+GROUP_MIN_SIZE = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count without a tokenizer: about 4 bytes of utf-8 per token,
+    cyrillic takes 2 bytes per letter and gives more tokens, as real tokenizers do"""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def _words(text: str) -> List[str]:
+    """Words of a query or a column name: snake_case, camelCase and digits are split"""
+    text = re.sub(r"([a-zа-яё])([A-ZА-ЯЁ])", r"\1 \2", str(text))
+    return [word for word in re.split(r"[^\wа-яё]+|_", text.lower()) if word and not word.isdigit()]
+
+
+def relevance(column: str, query_words: List[str], description: str = "", cache: Optional[dict] = None) -> float:
+    """How well the column matches the query: whole name in the query, shared words and similar words
+
+    Args:
+        column (str): column name
+        query_words (List[str]): words of user query
+        description (str, optional): description of the column. Defaults to "".
+        cache (Optional[dict], optional): scores by word set, columns like feature_1..feature_800
+            share their words and are compared with the query once. Defaults to None.
+
+    Returns:
+        float: 0 for unrelated column
+    """
+    # whole words of the name, not a substring: Age is not in "average"
+    name_words = frozenset(_words(column))
+    score = 3.0 if len(str(column)) > 2 and name_words and name_words <= set(query_words) else 0.0
+    words = name_words | frozenset(_words(description))
+    if cache is not None and words in cache:
+        return score + cache[words]
+    word_score = 0.0
+    for word in query_words:
+        if len(word) < 3:
+            continue
+        if word in words:
+            word_score += 1.0
+            continue
+        # close forms of the same word: age/ages, возраст/возраста
+        best = max((difflib.SequenceMatcher(None, word, other).ratio() for other in words if len(other) >= 3), default=0)
+        if best >= 0.8:
+            word_score += best - 0.2
+    if cache is not None:
+        cache[words] = word_score
+    return score + word_score
+
+
+def _short_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    text = str(value)
+    return text if len(text) <= 24 else text[:21] + "..."
+
+
+def _column_line(col: dict, nrows: int) -> str:
+    """name: dtype, non-null, [min..max] in one short line"""
+    parts = [DTYPE_SHORT.get(shown_dtype(col), shown_dtype(col))]
+    if col.get("non_null") is not None and col["non_null"] != nrows:
+        parts.append(f"{col['non_null']}/{nrows} non-null")
+    if col.get("min") is not None:
+        parts.append(f"[{_short_value(col['min'])}..{_short_value(col['max'])}]")
+    return f"{col['name']}: " + ", ".join(parts)
+
+
+def _group_line(pattern: str, cols: List[dict], nrows: int) -> str:
+    """One line for columns like feature_1 ... feature_800 with the same dtype"""
+    names = f"{cols[0]['name']} .. {cols[-1]['name']}"
+    parts = [f"{len(cols)} cols", DTYPE_SHORT.get(shown_dtype(cols[0]), shown_dtype(cols[0]))]
+    non_null = [col["non_null"] for col in cols if col.get("non_null") is not None]
+    if non_null and min(non_null) != nrows:
+        parts.append(f"non-null {min(non_null)}-{max(non_null)}/{nrows}")
+    mins = [col["min"] for col in cols if isinstance(col.get("min"), (int, float))]
+    maxs = [col["max"] for col in cols if isinstance(col.get("max"), (int, float))]
+    if mins and maxs:
+        parts.append(f"[{_short_value(min(mins))}..{_short_value(max(maxs))}]")
+    return f"{pattern} ({names}): " + ", ".join(parts)
+
+
+def _groups(cols: List[dict]) -> "OrderedDict[str, List[dict]]":
+    """Columns by name pattern (digits replaced by #) and dtype, in order of first column"""
+    groups = OrderedDict()
+    for col in cols:
+        key = (re.sub(r"\d+", "#", col["name"]), shown_dtype(col))
+        groups.setdefault(key, []).append(col)
+    result = OrderedDict()
+    for (pattern, dtype), members in groups.items():
+        if len(members) >= GROUP_MIN_SIZE:
+            result[f"{pattern}|{dtype}"] = members
+        else:
+            for col in members:
+                result[f"{col['name']}|{dtype}|single"] = [col]
+    return result
+
+
+@tracing.traced("schema_summary")
+def build_schema_summary(profile: dict, query: str = "", budget: int = 2000,
+                         descriptions: Optional[Dict[str, str]] = None, max_relevant: int = 30,
+                         count_tokens: Callable[[str], int] = estimate_tokens) -> str:
+    """Description of the state for the prompt within a token budget. If the usual df.info()-like
+    profile fits, it is used as is. Otherwise columns related to the query are described one per
+    line with their first values, the others are grouped by name pattern and dtype, and what still
+    does not fit is counted by dtype.
+
+    Args:
+        profile (dict): profile from df_profile.build_profile
+        query (str, optional): user query, used to choose columns. Defaults to "".
+        budget (int, optional): token budget of the summary. Defaults to 2000.
+        descriptions (Optional[Dict[str, str]], optional): text description by column name. Defaults to None.
+        max_relevant (int, optional): most columns described in detail. Defaults to 30.
+        count_tokens (Callable[[str], int], optional): token counter. Defaults to estimate_tokens.
+
+    Returns:
+        str: text for the prompt
+    """
+    full = render_profile(profile)
+    if count_tokens(full) <= budget:
+        return full
+    descriptions = descriptions or {}
+    nrows = profile["nrows"]
+    columns = profile["columns"]
+    query_words = _words(query)
+    cache = {}
+    scored = [(relevance(col["name"], query_words, descriptions.get(col["name"], ""), cache), i, col)
+              for i, col in enumerate(columns)]
+    relevant = [col for score, _, col in sorted(scored, key=lambda item: (-item[0], item[1])) if score > 0][:max_relevant]
+
+    lines = [f"DataFrame df: {nrows} rows x {profile['ncols']} columns. "
+             f"Format: name: dtype, non-null if has missing, [min..max]"]
+    used = count_tokens(lines[0])
+    def add(line: str) -> bool:
+        nonlocal used
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            return False
+        lines.append(line)
+        used += cost
+        return True
+
+    shown = set()
+    head = profile.get("head", {})
+    if relevant:
+        add("Columns related to the query:")
+    for col in relevant:
+        line = _column_line(col, nrows)
+        if col["name"] in descriptions:
+            line += f" - {descriptions[col['name']]}"
+        if col["name"] in head:
+            line += " e.g. " + ", ".join("NaN" if value is None else _short_value(value) for value in head[col["name"]][:3])
+        # reserve for the tail line with counts of skipped columns
+        if used + count_tokens(line) + 40 > budget or not add(line):
+            break
+        shown.add(col["name"])
+
+    rest = [col for col in columns if col["name"] not in shown]
+    if rest:
+        add("Other columns:" if shown else "Columns:")
+    skipped = []
+    for key, members in _groups(rest).items():
+        line = _group_line(key.split("|")[0], members, nrows) if len(members) > 1 else _column_line(members[0], nrows)
+        if skipped or used + count_tokens(line) + 40 > budget or not add(line):
+            skipped.extend(members)
+    if skipped:
+        counts = OrderedDict()
+        for col in skipped:
+            counts[shown_dtype(col)] = counts.get(shown_dtype(col), 0) + 1
+        names = ", ".join(col["name"] for col in skipped[:5])
+        lines.append(f"... and {len(skipped)} more columns ({names}, ...): "
+                     + ", ".join(f"{dtype}({count})" for dtype, count in counts.items()))
+    return "\n".join(lines)
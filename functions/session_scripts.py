@@ -0,0 +1,296 @@
+import json
+from typing import Optional, List, Union
+
+# Reserving step number for a new state file. Numbers never repeat inside a session,
+# so two clients pushing at the same time never write to the same file.
+# KEYS: states list, step counter
+RESERVE_STEP = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('SET', KEYS[2], redis.call('LLEN', KEYS[1]) - 1)
+end
+return redis.call('INCR', KEYS[2])
+"""
+
+# States of a session form a version graph. Every step is a node hash session:{id}:node:{step} with its
+# metadata, filename and parent step, head key holds the current step. States list keeps files of all nodes
+# in push order, nodes zset keeps their steps. Node keys are built from the prefix passed in ARGV:
+# parents and children are known only inside the scripts, so they can not be declared in KEYS.
+# The session id in braces is the hash tag of every session key (MemoryManager.session_key), on Redis Cluster
+# the declared keys and the node keys built from the prefix are all in the slot of the session.
+
+# Adding written state as a child of the current one and making it current.
+# KEYS: states list, head, nodes zset
+# ARGV: node key prefix, step, filename, then meta field/value pairs
+PUSH_STATE = """
+local parent = redis.call('GET', KEYS[2])
+local node = ARGV[1] .. ARGV[2]
+if parent then
+    redis.call('HSET', node, 'parent', parent)
+    redis.call('HSET', ARGV[1] .. parent, 'last_child', ARGV[2])
+end
+redis.call('HSET', node, 'step', ARGV[2], 'filename', ARGV[3], unpack(ARGV, 4))
+redis.call('RPUSH', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[3], tonumber(ARGV[2]), ARGV[2])
+redis.call('SET', KEYS[2], ARGV[2])
+return parent
+"""
+
+# Making a node current and returning its metadata. "head" only reads, "parent" is undo, "child" is redo
+# (to the child the session came from last), a step number is checkout of any node.
+# Session in the old linear format (states list, index and one meta hash) becomes a chain of nodes first.
+# KEYS: states list, head, nodes zset, old index, old meta hash
+# ARGV: node key prefix, target
+CHECKOUT_STATE = """
+local head = redis.call('GET', KEYS[2])
+if not head then
+    local states = redis.call('LRANGE', KEYS[1], 0, -1)
+    if #states == 0 then
+        return nil
+    end
+    local current = tonumber(redis.call('GET', KEYS[4]) or '0')
+    local old_meta = redis.call('HGETALL', KEYS[5])
+    local meta_index = nil
+    for i = 1, #old_meta, 2 do
+        if old_meta[i] == 'index' then
+            meta_index = tonumber(old_meta[i + 1])
+        end
+    end
+    local parent = nil
+    for i, name in ipairs(states) do
+        local step = string.match(name, '_state_(%d+)%.') or tostring(i - 1)
+        local node = ARGV[1] .. step
+        redis.call('HSET', node, 'step', step, 'filename', name)
+        if parent then
+            redis.call('HSET', node, 'parent', parent)
+            redis.call('HSET', ARGV[1] .. parent, 'last_child', step)
+        end
+        if meta_index == i - 1 then
+            for j = 1, #old_meta, 2 do
+                if old_meta[j] ~= 'index' then
+                    redis.call('HSET', node, old_meta[j], old_meta[j + 1])
+                end
+            end
+        end
+        redis.call('ZADD', KEYS[3], tonumber(step), step)
+        if i - 1 == current then
+            head = step
+        end
+        parent = step
+    end
+    head = head or parent
+    redis.call('SET', KEYS[2], head)
+    redis.call('DEL', KEYS[4], KEYS[5])
+end
+local target = head
+if ARGV[2] == 'parent' then
+    target = redis.call('HGET', ARGV[1] .. head, 'parent') or head
+elseif ARGV[2] == 'child' then
+    target = redis.call('HGET', ARGV[1] .. head, 'last_child') or head
+elseif ARGV[2] ~= 'head' then
+    if redis.call('EXISTS', ARGV[1] .. ARGV[2]) == 0 then
+        return nil
+    end
+    target = ARGV[2]
+end
+if target ~= head then
+    -- redo from the parent leads back to the node just made current
+    local parent = redis.call('HGET', ARGV[1] .. target, 'parent')
+    if parent then
+        redis.call('HSET', ARGV[1] .. parent, 'last_child', target)
+    end
+    redis.call('SET', KEYS[2], target)
+end
+return redis.call('HGETALL', ARGV[1] .. target)
+"""
+
+# Metadata of one node from the given step (default head) up to the root, in one round trip.
+# KEYS: head
+# ARGV: node key prefix, step or empty string
+BRANCH = """
+local step = ARGV[2]
+if step == '' then
+    step = redis.call('GET', KEYS[1])
+end
+local result = {}
+while step do
+    local fields = redis.call('HGETALL', ARGV[1] .. step)
+    if #fields == 0 then
+        break
+    end
+    table.insert(result, fields)
+    step = redis.call('HGET', ARGV[1] .. step, 'parent')
+end
+return result
+"""
+
+# Filling fields of meta computed after the push (write-behind), only if the node still exists.
+# KEYS: node hash
+# ARGV: meta field/value pairs
+UPDATE_META = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+# Removing a state which was never fully written (writer crashed) or squashed by retention,
+# its children move to its parent. With keep_head the current state is never removed.
+# KEYS: states list, head, nodes zset, pending hash
+# ARGV: node key prefix, step, filename, keep_head (1 or 0)
+DROP_STATE = """
+if ARGV[4] == '1' and redis.call('GET', KEYS[2]) == ARGV[2] then
+    return -2
+end
+redis.call('HDEL', KEYS[4], ARGV[3])
+if redis.call('LREM', KEYS[1], 1, ARGV[3]) == 0 then
+    return -1
+end
+local node = ARGV[1] .. ARGV[2]
+local parent = redis.call('HGET', node, 'parent')
+redis.call('ZREM', KEYS[3], ARGV[2])
+for _, step in ipairs(redis.call('ZRANGE', KEYS[3], 0, -1)) do
+    local child = ARGV[1] .. step
+    if redis.call('HGET', child, 'parent') == ARGV[2] then
+        if parent then
+            redis.call('HSET', child, 'parent', parent)
+        else
+            redis.call('HDEL', child, 'parent')
+        end
+    end
+end
+if parent and redis.call('HGET', ARGV[1] .. parent, 'last_child') == ARGV[2] then
+    local next = redis.call('HGET', node, 'last_child')
+    if next then
+        redis.call('HSET', ARGV[1] .. parent, 'last_child', next)
+    else
+        redis.call('HDEL', ARGV[1] .. parent, 'last_child')
+    end
+end
+if redis.call('GET', KEYS[2]) == ARGV[2] then
+    local rest = redis.call('ZRANGE', KEYS[3], 0, 0)
+    if parent then
+        redis.call('SET', KEYS[2], parent)
+    elseif #rest > 0 then
+        redis.call('SET', KEYS[2], rest[1])
+    else
+        redis.call('DEL', KEYS[2])
+    end
+end
+redis.call('DEL', node)
+return tonumber(ARGV[2])
+"""
+
+# Replacing file of a state by the same state in another format (tier migration).
+# KEYS: states list, access zset, old profile key, new profile key, node hash
+# ARGV: old filename, new filename
+RENAME_STATE = """
+local states = redis.call('LRANGE', KEYS[1], 0, -1)
+for i, name in ipairs(states) do
+    if name == ARGV[1] then
+        redis.call('LSET', KEYS[1], i - 1, ARGV[2])
+        if redis.call('HGET', KEYS[5], 'filename') == ARGV[1] then
+            redis.call('HSET', KEYS[5], 'filename', ARGV[2])
+        end
+        local used = redis.call('ZSCORE', KEYS[2], ARGV[1])
+        if used then
+            redis.call('ZREM', KEYS[2], ARGV[1])
+            redis.call('ZADD', KEYS[2], used, ARGV[2])
+        end
+        if redis.call('EXISTS', KEYS[3]) == 1 then
+            redis.call('RENAME', KEYS[3], KEYS[4])
+        end
+        return i - 1
+    end
+end
+return -1
+"""
+
+
+class SessionScripts():
+    def __init__(self, r):
+        """Server side scripts of session operations, each operation is one atomic round trip.
+        redis-py sends scripts by sha and reloads them itself after SCRIPT FLUSH.
+
+        Args:
+            r (redis.Redis): redis connection, redis.asyncio connection for AsyncSessionScripts
+        """
+        self._reserve = r.register_script(RESERVE_STEP)
+        self._push = r.register_script(PUSH_STATE)
+        self._checkout = r.register_script(CHECKOUT_STATE)
+        self._branch = r.register_script(BRANCH)
+        self._update_meta = r.register_script(UPDATE_META)
+        self._drop = r.register_script(DROP_STATE)
+        self._rename = r.register_script(RENAME_STATE)
+    def reserve_step(self, states_key: str, seq_key: str) -> int:
+        return int(self._reserve(keys=[states_key, seq_key]))
+    def push(self, keys: List[str], prefix: str, step: int, filename: str, meta: dict) -> Optional[int]:
+        """Adding node of the state as a child of current one, returns the parent step"""
+        return self._parent(self._push(keys=keys[:3], args=[prefix, step] + self._push_args(filename, meta)))
+    def checkout(self, keys: List[str], prefix: str, target: Union[str, int] = "head") -> Optional[dict]:
+        """Making a node current and reading its metadata
+
+        Args:
+            keys (List[str]): states list, head, nodes zset, old index and old meta keys
+            prefix (str): node key prefix of the session
+            target (Union[str, int], optional): "head" - current state, "parent" - undo, "child" - redo,
+                step number - any node. Defaults to "head".
+
+        Returns:
+            Optional[dict]: meta of the node with its step and filename, None for empty session or unknown step
+        """
+        return self._meta_from_reply(self._checkout(keys=keys, args=[prefix, target]))
+    def branch(self, keys: List[str], prefix: str, step: Optional[int] = None) -> List[dict]:
+        """Metadata of nodes from the root to step (default current), without changing the current node"""
+        return self._branch_from_reply(self._branch(keys=keys[1:2], args=[prefix, "" if step is None else step]))
+    def update_meta(self, node_key: str, fields: dict) -> bool:
+        return bool(self._update_meta(keys=[node_key], args=self._pairs(fields)))
+    def drop(self, keys: List[str], pending_key: str, prefix: str, step: int, filename: str, keep_head: bool = False) -> int:
+        """Removing state from the session, returns its step, -1 if it was not there, -2 if it is current and kept"""
+        return int(self._drop(keys=keys[:3] + [pending_key], args=[prefix, step, filename, int(keep_head)]))
+    def rename(self, states_key: str, access_key: str, profile_keys: List[str], node_key: str,
+               filename: str, new_filename: str) -> int:
+        """Pointing the state to its new file, returns its position or -1 if the state is gone"""
+        return int(self._rename(keys=[states_key, access_key] + profile_keys + [node_key], args=[filename, new_filename]))
+    @classmethod
+    def _push_args(cls, filename: str, meta: dict) -> list:
+        return [filename] + cls._pairs(meta)
+    @staticmethod
+    def _pairs(fields: dict) -> list:
+        args = []
+        for field, value in fields.items():
+            args.extend([field, value])
+        return args
+    @staticmethod
+    def _parent(reply) -> Optional[int]:
+        return int(reply) if reply else None
+    @classmethod
+    def _meta_from_reply(cls, reply) -> Optional[dict]:
+        if not reply:
+            return None
+        return cls.decode_meta(dict(zip(reply[::2], reply[1::2])))
+    @staticmethod
+    def decode_meta(meta: dict) -> dict:
+        """Node hash as read from redis to meta dict: step numbers as int, json fields decoded"""
+        for field in ("step", "parent", "last_child"):
+            if field in meta:
+                meta[field] = int(meta[field])
+        for field in ("schema", "changes", "squashed", "compacted"):
+            if field in meta:
+                meta[field] = json.loads(meta[field])
+        return meta
+    @classmethod
+    def _branch_from_reply(cls, reply) -> List[dict]:
+        return [cls._meta_from_reply(fields) for fields in reversed(reply or [])]
+
+
+class AsyncSessionScripts(SessionScripts):
+    """Same scripts for redis.asyncio connection, every operation is awaited"""
+    async def reserve_step(self, states_key: str, seq_key: str) -> int:
+        return int(await self._reserve(keys=[states_key, seq_key]))
+    async def push(self, keys: List[str], prefix: str, step: int, filename: str, meta: dict) -> Optional[int]:
+        return self._parent(await self._push(keys=keys[:3], args=[prefix, step] + self._push_args(filename, meta)))
+    async def checkout(self, keys: List[str], prefix: str, target: Union[str, int] = "head") -> Optional[dict]:
+        return self._meta_from_reply(await self._checkout(keys=keys, args=[prefix, target]))
+    async def branch(self, keys: List[str], prefix: str, step: Optional[int] = None) -> List[dict]:
+        return self._branch_from_reply(await self._branch(keys=keys[1:2], args=[prefix, "" if step is None else step]))
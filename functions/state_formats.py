@@ -0,0 +1,125 @@
+import os
+from typing import Optional, Callable, List
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from functions.column_store import ColumnStore, MANIFEST_SUFFIX
+
+
+class StateFormat():
+    """File format of saved states. Format of a state is known from its file suffix"""
+    name = ""
+    suffix = ""
+    def write(self, path: str, df: pd.DataFrame, digests: Optional[dict] = None) -> None:
+        raise NotImplementedError
+    def read(self, path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        raise NotImplementedError
+    def columns(self, path: str) -> List[str]:
+        raise NotImplementedError
+    def valid(self, path: str) -> bool:
+        """File exists and is complete"""
+        try:
+            self.columns(path)
+            return True
+        except Exception:
+            return False
+    def footer(self, path: str, digests: dict) -> Callable:
+        """Function column name -> (parquet metadata, column name in file) with column statistics, None without them"""
+        return lambda name: None
+
+
+class ParquetFormat(StateFormat):
+    """Compressed parquet, small on disk, needs full decode on load. Format of cold states"""
+    name = "parquet"
+    suffix = ".parquet"
+    def write(self, path: str, df: pd.DataFrame, digests: Optional[dict] = None) -> None:
+        # through temporary file, a crash never leaves half-written state under its name
+        ColumnStore._atomic_write(path, lambda tmp: df.to_parquet(tmp, index=False))
+    def read(self, path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        return pd.read_parquet(path, columns=columns)
+    def columns(self, path: str) -> List[str]:
+        return pq.read_schema(path).names
+    def valid(self, path: str) -> bool:
+        try:
+            pq.read_metadata(path)
+            return True
+        except Exception:
+            return False
+    def footer(self, path: str, digests: dict) -> Callable:
+        metadata = {}
+        def source(name):
+            if "footer" not in metadata:
+                metadata["footer"] = pq.read_metadata(path)
+            return metadata["footer"], name
+        return source
+
+
+class ArrowFormat(StateFormat):
+    def __init__(self, compression: Optional[str] = None):
+        """Arrow IPC file. Uncompressed file is memory-mapped on load: numeric columns without
+        missing values become read-only views of the mapped file, without decode and copy.
+        LZ4 is smaller on disk but is decompressed on load. Format of hot states.
+
+        Args:
+            compression (Optional[str], optional): None or "lz4". Defaults to None.
+        """
+        self.compression = compression
+        self.name = "arrow" if compression is None else f"arrow_{compression}"
+        # own suffix per codec, so format_of and tier migration tell compressed files from plain ones
+        self.suffix = ".arrow" if compression is None else f".{compression}.arrow"
+    def write(self, path: str, df: pd.DataFrame, digests: Optional[dict] = None) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        options = ipc.IpcWriteOptions(compression=self.compression)
+        def _dump(tmp):
+            with pa.OSFile(tmp, "wb") as sink:
+                with ipc.new_file(sink, table.schema, options=options) as writer:
+                    writer.write_table(table)
+        ColumnStore._atomic_write(path, _dump)
+    def read(self, path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        table = ipc.open_file(pa.memory_map(path, "r")).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        # split blocks: every column keeps its own buffer instead of being copied into a 2d block
+        return table.to_pandas(split_blocks=True)
+    def columns(self, path: str) -> List[str]:
+        return ipc.open_file(pa.memory_map(path, "r")).schema.names
+
+
+class ManifestFormat(StateFormat):
+    """Manifest of shared column chunks (storage_mode="columnar"), unchanged columns are stored once"""
+    name = "columnar"
+    suffix = MANIFEST_SUFFIX
+    def __init__(self, column_store: ColumnStore):
+        self.column_store = column_store
+    def write(self, path: str, df: pd.DataFrame, digests: Optional[dict] = None) -> None:
+        self.column_store.write(df, path, digests=digests)
+    def read(self, path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        return self.column_store.read(path, columns=columns)
+    def columns(self, path: str) -> List[str]:
+        return [entry["name"] for entry in self.column_store.read_manifest(path)["columns"]]
+    def valid(self, path: str) -> bool:
+        try:
+            manifest = self.column_store.read_manifest(path)
+        except Exception:
+            return False
+        return all(os.path.exists(self.column_store.chunk_path(entry["chunk"])) for entry in manifest["columns"])
+    def footer(self, path: str, digests: dict) -> Callable:
+        def source(name):
+            chunk = self.column_store.chunk_path(digests[name])
+            return (pq.read_metadata(chunk), "v") if os.path.exists(chunk) else None
+        return source
+
+
+def state_formats(column_store: ColumnStore) -> dict:
+    """Known formats by name"""
+    formats = [ParquetFormat(), ArrowFormat(), ArrowFormat("lz4"), ManifestFormat(column_store)]
+    return {fmt.name: fmt for fmt in formats}
+
+
+def format_of(formats: dict, path: str) -> StateFormat:
+    """Format of a saved state by its suffix, the longest matching one: .lz4.arrow is not plain .arrow"""
+    for fmt in sorted(formats.values(), key=lambda fmt: len(fmt.suffix), reverse=True):
+        if path.endswith(fmt.suffix):
+            return fmt
+    raise ValueError(f"Unknown state format: {path}")
@@ -0,0 +1,74 @@
+import re
+import ast
+from typing import Optional, Callable
+import jiter
+
+# Output the prompt forbids: printing, reading input and imports. Checked on unfinished code,
+# so generation is stopped as soon as one of them appears.
+FORBIDDEN_PATTERNS = [
+    (re.compile(r"\bprint\s*\("), "print"),
+    (re.compile(r"\binput\s*\("), "input"),
+    (re.compile(r"^\s*(import\s+\w|from\s+[\w.]+\s+import\b)", re.MULTILINE), "import"),
+    (re.compile(r"\b__import__\s*\("), "import"),
+]
+
+
+class ForbiddenOutput(ValueError):
+    """Generation was stopped: forbidden call in code or code that does not compile"""
+
+
+def check_forbidden(code: str) -> None:
+    """Raises ForbiddenOutput if code (maybe unfinished) contains forbidden output"""
+    for pattern, name in FORBIDDEN_PATTERNS:
+        if pattern.search(code):
+            raise ForbiddenOutput(f"Модель сгенерировала запрещенный код ({name})")
+
+
+class StreamingCodeParser():
+    def __init__(self, on_code: Optional[Callable[[str], None]] = None,
+                 on_progress: Optional[Callable[[str], None]] = None):
+        """Incremental parser of PandasCode json (code, comment) from streamed tokens.
+        Unfinished code is checked for forbidden output after every token, finished code
+        is compiled at once, before the model writes the comment.
+
+        Args:
+            on_code (Optional[Callable[[str], None]], optional): called once when code field is closed
+                and compiles, for example to start loading needed columns. Must not block. Defaults to None.
+            on_progress (Optional[Callable[[str], None]], optional): called with every new piece of code. Defaults to None.
+        """
+        self.on_code = on_code
+        self.on_progress = on_progress
+        self.buffer = ""
+        self.code = None
+        self._shown = 0
+    def feed(self, delta: str) -> None:
+        """Adding next piece of the answer
+
+        Raises:
+            ForbiddenOutput: if code contains forbidden output or does not compile
+        """
+        self.buffer += delta
+        if self.code is not None:
+            return
+        try:
+            partial = jiter.from_json(self.buffer.encode("utf-8"), partial_mode="trailing-strings")
+        except ValueError:
+            # not json (yet), whole answer is validated at the end
+            return
+        code = partial.get("code") if isinstance(partial, dict) else None
+        if not isinstance(code, str):
+            return
+        check_forbidden(code)
+        if self.on_progress is not None and len(code) > self._shown:
+            self.on_progress(code[self._shown:])
+            self._shown = len(code)
+        if '"' in delta and "code" in jiter.from_json(self.buffer.encode("utf-8"), partial_mode="on"):
+            self._code_closed(code)
+    def _code_closed(self, code: str) -> None:
+        self.code = code
+        try:
+            ast.parse(code.strip())
+        except SyntaxError as e:
+            raise ForbiddenOutput(f"Сгенерированный код не компилируется: {e}") from e
+        if self.on_code is not None:
+            self.on_code(code)
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import inspect
+import functools
+import threading
+import contextvars
+from typing import Optional, Dict, Tuple
+
+# Timed spans of query stages and metrics in Prometheus text format.
+# Turned off by default: span() returns a shared no-op object and counters return at once,
+# so instrumented code costs one flag check per call.
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(13))  # 1 KiB .. 16 GiB
+PREFIX = "anal_app_"
+
+_enabled = False
+_current = contextvars.ContextVar("tracing_span", default=None)
+_bound = contextvars.ContextVar("tracing_attrs", default={})
+
+
+class Metrics():
+    def __init__(self):
+        """Counters and histograms by (metric name, sorted labels), thread-safe"""
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+    def count(self, name: str, value: float, labels: dict) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    def observe(self, name: str, value: float, labels: dict, buckets: Tuple[float, ...]) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                self.buckets.setdefault(name, buckets)
+                # counts per bucket (last one is +Inf), sum, count
+                entry = self.histograms[key] = [[0] * (len(self.buckets[name]) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets[name], value)] += 1
+            entry[1] += value
+            entry[2] += 1
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.buckets.clear()
+    def prometheus(self) -> str:
+        """Text exposition format: counters as <name>, histograms as cumulative <name>_bucket, _sum and _count"""
+        def labels_text(labels, extra=()):
+            pairs = [f'{key}="{_escape(value)}"' for key, value in tuple(labels) + tuple(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self.histograms.items())
+            buckets = dict(self.buckets)
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+            lines.append(f"{PREFIX}{name}{labels_text(labels)} {_number(value)}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets[name] + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(f"{PREFIX}{name}_bucket{labels_text(labels, (('le', le),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{labels_text(labels)} {_number(total)}")
+            lines.append(f"{PREFIX}{name}_count{labels_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+    def snapshot(self) -> dict:
+        """Counters and count / sum / mean of histograms, for json stats"""
+        with self._lock:
+            result = {"counters": {_series(name, labels): value for (name, labels), value in self.counters.items()},
+                      "histograms": {}}
+            for (name, labels), (_, total, count) in self.histograms.items():
+                result["histograms"][_series(name, labels)] = {"count": count, "sum": round(total, 6),
+                                                               "mean": round(total / count, 6) if count else None}
+        return result
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _series(name: str, labels: tuple) -> str:
+    return name + ("{" + ",".join(f"{key}={value}" for key, value in labels) + "}" if labels else "")
+
+
+class TraceFile():
+    def __init__(self, path: str):
+        """Finished spans as json lines, one file shared by threads of the process"""
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+metrics = Metrics()
+_trace_file: Optional[TraceFile] = None
+
+
+class Span():
+    __slots__ = ("name", "attrs", "trace_id", "span_id", "parent_id", "started", "_start", "_token", "_ended")
+    recording = True
+    def __init__(self, name: str, attrs: dict):
+        """Timed stage of a query. Spans opened inside it (also in threads started with copied context)
+        become its children and share its trace id."""
+        parent = _current.get()
+        self.name = name
+        self.attrs = dict(_bound.get(), **attrs)
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._token = None
+        self._ended = False
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+    def add(self, key: str, value: float) -> None:
+        """Adding to a numeric attribute, for example time of redis calls inside the span"""
+        self.attrs[key] = self.attrs.get(key, 0) + value
+    def add_bytes(self, direction: str, size: int) -> None:
+        """Bytes read or written by the stage, also observed in the stage_bytes histogram"""
+        self.add(f"bytes_{direction}", size)
+        metrics.observe("stage_bytes", size, {"stage": self.name, "direction": direction}, BYTES_BUCKETS)
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.attrs.setdefault("error", f"{exc_type.__name__}: {exc}")
+        self.end()
+    def end(self) -> None:
+        """Closing the span opened by begin(), calling it again does nothing"""
+        if self._ended:
+            return
+        self._ended = True
+        seconds = time.perf_counter() - self._start
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                # closed in another context than opened, for example after await in another task
+                pass
+        metrics.observe("stage_seconds", seconds, {"stage": self.name}, SECONDS_BUCKETS)
+        trace_file = _trace_file
+        if trace_file is not None:
+            attrs = {key: round(value, 6) if isinstance(value, float) else value for key, value in self.attrs.items()}
+            trace_file.write(dict(attrs, trace=self.trace_id, span=self.span_id, parent=self.parent_id,
+                                  name=self.name, start=round(self.started, 6), seconds=round(seconds, 6)))
+
+
+class _NoopSpan():
+    recording = False
+    def set(self, **attrs) -> None:
+        pass
+    def add(self, key: str, value: float) -> None:
+        pass
+    def add_bytes(self, direction: str, size: int) -> None:
+        pass
+    def end(self) -> None:
+        pass
+    def __enter__(self) -> "_NoopSpan":
+        return self
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+NOOP = _NoopSpan()
+
+
+def configure(enabled: bool = True, trace_file: Optional[str] = None) -> None:
+    """Turning tracing on or off
+
+    Args:
+        enabled (bool, optional): record spans and metrics. Defaults to True.
+        trace_file (Optional[str], optional): json lines file for finished spans, None - only metrics. Defaults to None.
+    """
+    global _enabled, _trace_file
+    old, _trace_file = _trace_file, None
+    if old is not None:
+        old.close()
+    if enabled and trace_file:
+        _trace_file = TraceFile(trace_file)
+    _enabled = enabled
+
+
+def configure_from_env() -> None:
+    """TRACING=1 turns tracing on, TRACE_FILE - path of json lines trace"""
+    configure(os.getenv("TRACING", "0") == "1", os.getenv("TRACE_FILE") or None)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def span(name: str, **attrs):
+    """with tracing.span("state.write", step=3) as s: ... - timed stage, s.set() adds attributes"""
+    if not _enabled:
+        return NOOP
+    return Span(name, attrs)
+
+
+def begin(name: str, **attrs):
+    """Span opened without with-block, closed by its end()"""
+    if not _enabled:
+        return NOOP
+    return Span(name, attrs).__enter__()
+
+
+def current():
+    """Innermost open span, no-op object when there is none"""
+    if not _enabled:
+        return NOOP
+    return _current.get() or NOOP
+
+
+class bind():
+    def __init__(self, **attrs):
+        """Attributes of every span opened inside the block, for example session_id"""
+        self.attrs = attrs
+        self._token = None
+    def __enter__(self) -> "bind":
+        if _enabled:
+            self._token = _bound.set(dict(_bound.get(), **self.attrs))
+        return self
+    def __exit__(self, *exc) -> None:
+        if self._token is not None:
+            _bound.reset(self._token)
+            self._token = None
+
+
+def traced(name: str):
+    """Decorator: every call of the function is a span"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with Span(name, {}):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    """Counter increment, name without _total suffix is extended with it"""
+    if not _enabled:
+        return
+    metrics.count(name if name.endswith("_total") else f"{name}_total", value, labels)
+
+
+def cache_event(cache: str, event: str) -> None:
+    """hit / miss / negative_hit of frame, result or llm cache"""
+    count("cache_events", cache=cache, event=event)
+
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] = SECONDS_BUCKETS, **labels) -> None:
+    if not _enabled:
+        return
+    metrics.observe(name, value, labels, buckets)
+
+
+def instrument_redis(client) -> None:
+    """Timing every command of a redis client (sync or asyncio): redis_seconds histogram by command,
+    calls and time are also added to the current span"""
+    execute = client.execute_command
+    def record(args, seconds):
+        command = str(args[0]).split()[0].upper() if args else "?"
+        metrics.observe("redis_seconds", seconds, {"command": command}, SECONDS_BUCKETS)
+        parent = _current.get()
+        if parent is not None:
+            parent.add("redis_calls", 1)
+            parent.add("redis_seconds", seconds)
+    if inspect.iscoroutinefunction(execute):
+        @functools.wraps(execute)
+        async def async_execute(*args, **options):
+            if not _enabled:
+                return await execute(*args, **options)
+            started = time.perf_counter()
+            try:
+                return await execute(*args, **options)
+            finally:
+                record(args, time.perf_counter() - started)
+        client.execute_command = async_execute
+        return
+    @functools.wraps(execute)
+    def sync_execute(*args, **options):
+        if not _enabled:
+            return execute(*args, **options)
+        started = time.perf_counter()
+        try:
+            return execute(*args, **options)
+        finally:
+            record(args, time.perf_counter() - started)
+    client.execute_command = sync_execute
+
+
+def prometheus_text() -> str:
+    return metrics.prometheus()
+
+
+def stats() -> dict:
+    return dict(metrics.snapshot(), enabled=_enabled, trace_file=_trace_file.path if _trace_file is not None else None)
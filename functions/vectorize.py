@@ -0,0 +1,676 @@
+import ast
+import copy
+import time
+from typing import Optional, Callable, Tuple, List, Set
+import numpy as np
+import pandas as pd
+
+# rows of df on which rewritten code is compared with the original one
+VERIFY_ROWS = 500
+
+_ARITHMETIC = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_COMPARISONS = (ast.Lt, ast.Gt, ast.LtE, ast.GtE, ast.Eq, ast.NotEq)
+# str methods of a cell which have the same .str method of a column
+_STR_METHODS = {"lower", "upper", "strip", "lstrip", "rstrip", "title", "capitalize",
+                "startswith", "endswith", "replace", "zfill"}
+# numpy functions working the same on a number and on a column
+_NP_FUNCTIONS = {"abs", "sqrt", "log", "log1p", "log10", "log2", "exp", "floor", "ceil", "sign"}
+_CONCAT_KEYWORDS = {"ignore_index", "axis"}
+# aggregations of a group which groupby().transform gives for every row
+_TRANSFORMS = {"mean", "sum", "min", "max", "median", "std", "var", "count", "nunique", "prod"}
+# kinds of numpy numeric columns, see column_kind
+_NUMBER_KINDS = ("int", "float")
+
+
+class _Unsupported(Exception):
+    """Expression can not be rewritten safely"""
+
+
+def _name(id_: str) -> ast.Name:
+    return ast.Name(id=id_, ctx=ast.Load())
+
+
+def _attr(value: ast.AST, attr: str) -> ast.Attribute:
+    return ast.Attribute(value=value, attr=attr, ctx=ast.Load())
+
+
+def _call(func: ast.AST, *args, **keywords) -> ast.Call:
+    return ast.Call(func=func, args=list(args), keywords=[ast.keyword(arg=k, value=v) for k, v in keywords.items()])
+
+
+def _column(frame: ast.AST, name: str) -> ast.Subscript:
+    return ast.Subscript(value=copy.deepcopy(frame), slice=ast.Constant(value=name), ctx=ast.Load())
+
+
+def _is_pure(node: ast.AST) -> bool:
+    """Expression without calls and assignments, it can be evaluated several times"""
+    return not any(isinstance(sub, (ast.Call, ast.NamedExpr, ast.Await, ast.Yield, ast.YieldFrom, ast.Lambda))
+                   for sub in ast.walk(node))
+
+
+def _str_constant(node: ast.AST) -> Optional[str]:
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else None
+
+
+class _Vectorizer():
+    def __init__(self, column_of: Callable[[ast.AST], Optional[ast.AST]], forbidden: Set[str],
+                 kind_of: Callable[[ast.AST], Optional[str]] = lambda node: None):
+        """Turns expression over one row or one cell into the same expression over whole columns
+
+        Args:
+            column_of (Callable[[ast.AST], Optional[ast.AST]]): column expression for a node reading a cell
+                (row['a'], x, df.at[i, 'a']), None for other nodes
+            forbidden (Set[str]): loop or lambda variables which can not stay in the result
+            kind_of (Callable[[ast.AST], Optional[str]], optional): "string" (only str values, no missing),
+                "int" or "float" (numpy dtypes) for a column expression, None when unknown.
+                Only columns of a known kind are read: apply infers the dtype of its result from the values,
+                the vector form of an object column would stay object. len, str(), float() and str methods
+                of a cell are rewritten only for columns of the kind on which the vector form gives the same
+                values and the same errors.
+        """
+        self.column_of = column_of
+        self.forbidden = forbidden
+        self.kind_of = kind_of
+        self.uses_columns = False
+    def _require(self, node: ast.AST, *kinds: str) -> None:
+        if self.kind_of(node) not in kinds:
+            # .str of a column with other values gives NaN where the cell code raises TypeError
+            raise _Unsupported("column type does not guarantee the same result")
+    def convert(self, node: ast.AST) -> Tuple[ast.AST, str]:
+        """Returns (new node, kind): kind is "bool" for masks, "array" for np.where results, "value" otherwise
+
+        Raises:
+            _Unsupported: for any construction without exact vector form
+        """
+        column = self.column_of(node)
+        if column is not None:
+            if self.kind_of(column) is None:
+                raise _Unsupported("column of unknown type")
+            self.uses_columns = True
+            return column, "value"
+        if isinstance(node, ast.Constant) and node.value is not None:
+            return copy.deepcopy(node), "value"
+        if isinstance(node, ast.Name):
+            if node.id in self.forbidden:
+                raise _Unsupported(f"whole {node.id} is used")
+            return copy.deepcopy(node), "value"
+        if isinstance(node, ast.BinOp) and isinstance(node.op, _ARITHMETIC):
+            left, left_kind = self.convert(node.left)
+            right, right_kind = self.convert(node.right)
+            kind = "array" if "array" in (left_kind, right_kind) else "value"
+            return ast.BinOp(left=left, op=copy.deepcopy(node.op), right=right), kind
+        if isinstance(node, ast.UnaryOp):
+            operand, kind = self.convert(node.operand)
+            if isinstance(node.op, ast.Not):
+                if kind != "bool":
+                    raise _Unsupported("not of a value")
+                return ast.UnaryOp(op=ast.Invert(), operand=operand), "bool"
+            if isinstance(node.op, (ast.USub, ast.UAdd)):
+                return ast.UnaryOp(op=copy.deepcopy(node.op), operand=operand), kind
+            raise _Unsupported("unary operator")
+        if isinstance(node, ast.Compare):
+            return self._compare(node), "bool"
+        if isinstance(node, ast.BoolOp):
+            values = []
+            for value in node.values:
+                converted, kind = self.convert(value)
+                if kind != "bool":
+                    # `a and b` returns one of the values, not a mask
+                    raise _Unsupported("and/or of values")
+                values.append(converted)
+            op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+            result = values[0]
+            for value in values[1:]:
+                result = ast.BinOp(left=result, op=op, right=value)
+            return result, "bool"
+        if isinstance(node, ast.IfExp):
+            test, kind = self.convert(node.test)
+            if kind != "bool":
+                raise _Unsupported("condition is not a comparison")
+            body, _ = self.convert(node.body)
+            orelse, _ = self.convert(node.orelse)
+            return _call(_attr(_name("np"), "where"), test, body, orelse), "array"
+        if isinstance(node, ast.Call):
+            return self._call(node)
+        raise _Unsupported(type(node).__name__)
+    def _compare(self, node: ast.Compare) -> ast.AST:
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            if isinstance(op, _COMPARISONS):
+                left_vec, _ = self.convert(left)
+                right_vec, _ = self.convert(right)
+                parts.append(ast.Compare(left=left_vec, ops=[copy.deepcopy(op)], comparators=[right_vec]))
+            elif isinstance(op, (ast.In, ast.NotIn)) and isinstance(right, (ast.List, ast.Tuple, ast.Set)) \
+                    and all(isinstance(elt, ast.Constant) for elt in right.elts):
+                left_vec, _ = self.convert(left)
+                values = ast.List(elts=copy.deepcopy(right.elts), ctx=ast.Load())
+                part = _call(_attr(left_vec, "isin"), values)
+                parts.append(ast.UnaryOp(op=ast.Invert(), operand=part) if isinstance(op, ast.NotIn) else part)
+            elif isinstance(op, (ast.In, ast.NotIn)) and _str_constant(left) is not None:
+                right_vec, _ = self.convert(right)
+                self._require(right_vec, "string")
+                part = _call(_attr(_attr(right_vec, "str"), "contains"), copy.deepcopy(left),
+                             regex=ast.Constant(value=False))
+                parts.append(ast.UnaryOp(op=ast.Invert(), operand=part) if isinstance(op, ast.NotIn) else part)
+            else:
+                raise _Unsupported("comparison")
+            left = right
+        result = parts[0]
+        for part in parts[1:]:
+            result = ast.BinOp(left=result, op=ast.BitAnd(), right=part)
+        return result
+    def _call(self, node: ast.Call) -> Tuple[ast.AST, str]:
+        if node.keywords:
+            raise _Unsupported("call with keywords")
+        func = node.func
+        if isinstance(func, ast.Name) and func.id == "abs" and len(node.args) == 1:
+            arg, kind = self.convert(node.args[0])
+            return _call(_attr(_name("np"), "abs"), arg), kind
+        if isinstance(func, ast.Name) and func.id == "round" and len(node.args) == 2:
+            # round(x) without digits gives int, column keeps float
+            arg, kind = self.convert(node.args[0])
+            digits, _ = self.convert(node.args[1])
+            return _call(_attr(_name("np"), "round"), arg, digits), kind
+        if isinstance(func, ast.Name) and func.id == "len" and len(node.args) == 1:
+            arg, _ = self.convert(node.args[0])
+            self._require(arg, "string")
+            return _call(_attr(_attr(arg, "str"), "len")), "value"
+        if isinstance(func, ast.Name) and func.id in ("str", "float") and len(node.args) == 1:
+            arg, _ = self.convert(node.args[0])
+            self._require(arg, *(("string",) + _NUMBER_KINDS if func.id == "str" else _NUMBER_KINDS))
+            return _call(_attr(arg, "astype"), _name(func.id)), "value"
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "np" \
+                and func.attr in _NP_FUNCTIONS and len(node.args) == 1:
+            arg, kind = self.convert(node.args[0])
+            return _call(copy.deepcopy(func), arg), kind
+        if isinstance(func, ast.Attribute) and func.attr in _STR_METHODS:
+            target, _ = self.convert(func.value)
+            self._require(target, "string")
+            args = [self.convert(arg)[0] for arg in node.args]
+            if func.attr == "replace":
+                # str.replace of a cell never uses regex
+                return _call(_attr(_attr(target, "str"), "replace"), *args, regex=ast.Constant(value=False)), "value"
+            return _call(_attr(_attr(target, "str"), func.attr), *args), "value"
+        raise _Unsupported("call")
+
+
+def _lambda_param(node: ast.AST) -> Optional[str]:
+    if not isinstance(node, ast.Lambda):
+        return None
+    args = node.args
+    if len(args.args) != 1 or args.vararg or args.kwarg or args.kwonlyargs or args.defaults or args.posonlyargs:
+        return None
+    return args.args[0].arg
+
+
+class _Rewriter(ast.NodeTransformer):
+    def __init__(self, tree: ast.Module, columns: Set[str], column_kind: Callable[[str], Optional[str]] = lambda name: None):
+        """Finds slow pandas idioms and replaces them with vector forms
+
+        Args:
+            tree (ast.Module): parsed code, needed to check where loop variables are used
+            columns (Set[str]): columns of df, row.attr is rewritten only for them
+            column_kind (Callable[[str], Optional[str]], optional): kind of a column of df before the code runs,
+                see _Vectorizer. Defaults to unknown for every column.
+        """
+        self.tree = tree
+        self.columns = columns
+        self.column_kind = column_kind
+        self.fired = []
+        self._float_rows = None
+        assigned = _assigned_columns(tree)
+        self.assigned = assigned
+        def kind_of(node: ast.AST) -> Optional[str]:
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "astype" \
+                    and len(node.args) == 1 and isinstance(node.args[0], ast.Name) and node.args[0].id == "float" \
+                    and kind_of(node.func.value) is not None:
+                return "float"
+            # only df['a'] of a column the code never assigns still has the type it had before the code
+            if assigned is None or not (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                                        and node.value.id == "df"):
+                return None
+            name = _str_constant(node.slice)
+            return column_kind(name) if name is not None and name not in assigned else None
+        self.kind_of = kind_of
+    def _rows_are_float(self, frame: ast.AST) -> bool:
+        """iterrows and apply(axis=1) give rows of one dtype: in df of only int and float columns
+        integers of a row are floats"""
+        if not (isinstance(frame, ast.Name) and frame.id == "df"):
+            return False
+        if self._float_rows is None:
+            kinds = set()
+            for name in self.columns:
+                kinds.add(self.column_kind(name))
+                if not kinds <= set(_NUMBER_KINDS):
+                    break
+            self._float_rows = kinds == set(_NUMBER_KINDS)
+        return self._float_rows
+    def _row_reader(self, frame: ast.AST, row: Optional[str], index: Optional[str], frame_name: Optional[str],
+                    reads: Set[str]) -> Callable[[ast.AST], Optional[ast.AST]]:
+        """Cell readers of a row: row['a'], row.a, df.at[i, 'a'], df.loc[i, 'a'], df['a'][i]"""
+        def column_of(node: ast.AST) -> Optional[ast.AST]:
+            name = None
+            if row is not None and isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) \
+                    and node.value.id == row:
+                name = _str_constant(node.slice)
+            elif row is not None and isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+                    and node.value.id == row and node.attr in self.columns:
+                name = node.attr
+            elif index is not None and frame_name is not None and isinstance(node, ast.Subscript):
+                name = self._indexed_cell(node, frame_name, index)
+                if name is not None:
+                    reads.add(name)
+                    return _column(frame, name)
+            if name is None:
+                return None
+            reads.add(name)
+            column = _column(frame, name)
+            if self.kind_of(column) == "int" and self._rows_are_float(frame):
+                return _call(_attr(column, "astype"), _name("float"))
+            return column
+        return column_of
+    @staticmethod
+    def _indexed_cell(node: ast.Subscript, frame_name: str, index: str) -> Optional[str]:
+        """Column of df.at[i, 'a'] / df.loc[i, 'a'] / df['a'][i], None for other subscripts"""
+        value = node.value
+        if isinstance(value, ast.Attribute) and value.attr in ("at", "loc") and isinstance(value.value, ast.Name) \
+                and value.value.id == frame_name and isinstance(node.slice, ast.Tuple) and len(node.slice.elts) == 2:
+            first, second = node.slice.elts
+            if isinstance(first, ast.Name) and first.id == index:
+                return _str_constant(second)
+        if isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name) and value.value.id == frame_name \
+                and isinstance(node.slice, ast.Name) and node.slice.id == index:
+            return _str_constant(value.slice)
+        return None
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and func.attr in ("apply", "map") and len(node.args) == 1):
+            return node
+        param = _lambda_param(node.args[0])
+        frame = func.value
+        if param is None or not _is_pure(frame):
+            return node
+        keywords = {keyword.arg: keyword.value for keyword in node.keywords}
+        row_wise = func.attr == "apply" and set(keywords) == {"axis"} and isinstance(keywords["axis"], ast.Constant) \
+            and keywords["axis"].value in (1, "columns")
+        if row_wise:
+            vectorizer = _Vectorizer(self._row_reader(frame, param, None, None, set()), {param}, self.kind_of)
+        elif not keywords:
+            vectorizer = _Vectorizer(lambda sub: copy.deepcopy(frame) if isinstance(sub, ast.Name) and sub.id == param
+                                     else None, {param}, self.kind_of)
+        else:
+            return node
+        try:
+            vector, kind = vectorizer.convert(node.args[0].body)
+        except _Unsupported:
+            return node
+        if not vectorizer.uses_columns:
+            return node
+        if kind == "array":
+            keywords = {"index": _attr(copy.deepcopy(frame), "index")}
+            if not row_wise:
+                keywords["name"] = _attr(copy.deepcopy(frame), "name")
+            vector = _call(_attr(_name("pd"), "Series"), vector, **keywords)
+        elif row_wise:
+            # apply(axis=1) gives unnamed series
+            vector = _call(_attr(vector, "rename"), ast.Constant(value=None))
+        self.fired.append("apply(axis=1)" if row_wise else f"{func.attr}(lambda)")
+        # empty frame: apply(axis=1) returns DataFrame, the original call is kept for it
+        return ast.IfExp(test=_call(_name("len"), copy.deepcopy(frame)), body=vector, orelse=node)
+    def visit_For(self, node: ast.For) -> ast.AST:
+        self.generic_visit(node)
+        if node.orelse:
+            return node
+        rewritten = self._row_loop(node)
+        if rewritten is None:
+            rewritten = self._group_loop(node)
+        if rewritten is not None:
+            return rewritten
+        return self._concat_loop(node)
+    def _used_outside(self, names: Set[str], loop: ast.For) -> bool:
+        inside = {id(sub) for sub in ast.walk(loop)}
+        return any(isinstance(sub, ast.Name) and sub.id in names and id(sub) not in inside
+                   for sub in ast.walk(self.tree))
+    def _row_loop(self, node: ast.For) -> Optional[ast.AST]:
+        """for i, row in df.iterrows(): df.at[i, 'c'] = ... and for i in df.index: df.loc[i, 'c'] = ..."""
+        iterator, target = node.iter, node.target
+        if isinstance(iterator, ast.Call) and isinstance(iterator.func, ast.Attribute) \
+                and iterator.func.attr == "iterrows" and not iterator.args and not iterator.keywords \
+                and isinstance(iterator.func.value, ast.Name) and isinstance(target, ast.Tuple) \
+                and len(target.elts) == 2 and all(isinstance(elt, ast.Name) for elt in target.elts):
+            frame_name = iterator.func.value.id
+            index, row = target.elts[0].id, target.elts[1].id
+            kind = "iterrows"
+        elif isinstance(iterator, ast.Attribute) and iterator.attr == "index" and isinstance(iterator.value, ast.Name) \
+                and isinstance(target, ast.Name):
+            frame_name, index, row = iterator.value.id, target.id, None
+            kind = "for over index"
+        else:
+            return None
+        names = {index} | ({row} if row else set())
+        if self._used_outside(names, node):
+            return None
+        frame = _name(frame_name)
+        reads, writes = set(), set()
+        vectorizer = _Vectorizer(self._row_reader(frame, row, index, frame_name, reads), names, self.kind_of)
+        statements = []
+        try:
+            for statement in node.body:
+                written = set(writes)
+                reads.clear()
+                statements.extend(self._row_statement(statement, vectorizer, frame_name, index, writes))
+                if reads & written:
+                    # iterrows gives rows as they were before the loop, a column written by an earlier
+                    # statement would be read with new values in vector form
+                    return None
+        except _Unsupported:
+            return None
+        if not statements:
+            return None
+        self.fired.append(kind)
+        guard = ast.BoolOp(op=ast.And(), values=[_attr(_attr(_name(frame_name), "index"), "is_unique"),
+                                                 _call(_name("len"), _name(frame_name))])
+        # duplicated index or empty df - original loop
+        return ast.If(test=guard, body=statements, orelse=[node])
+    def _store(self, frame_name: str, column: str, value: ast.AST, where: Optional[ast.AST] = None) -> List[ast.stmt]:
+        """df.loc[where, 'c'] = value with the dtype a loop of cell writes gives: a new column starts
+        as float NaN and is not created when no row is written, an existing one keeps its dtype"""
+        frame = _name(frame_name)
+        if column in self.columns and self.column_kind(column) not in _NUMBER_KINDS + ("string",):
+            # numbers written cell by cell into bool or mixed columns turn them to object
+            raise _Unsupported("column of unknown type")
+        target = ast.Subscript(value=_attr(frame, "loc"),
+                               slice=ast.Tuple(elts=[where if where is not None else ast.Slice(),
+                                                     ast.Constant(value=column)], ctx=ast.Load()),
+                               ctx=ast.Store())
+        new = ast.Subscript(value=copy.deepcopy(frame), slice=ast.Constant(value=column), ctx=ast.Store())
+        create = ast.If(test=ast.Compare(left=ast.Constant(value=column), ops=[ast.NotIn()],
+                                         comparators=[_attr(copy.deepcopy(frame), "columns")]),
+                        body=[ast.Assign(targets=[new], value=_attr(_name("np"), "nan"))], orelse=[])
+        statements = [create, ast.Assign(targets=[target], value=value)]
+        if where is None:
+            return statements
+        return [ast.If(test=_call(_attr(copy.deepcopy(where), "any")), body=statements, orelse=[])]
+    def _row_statement(self, statement: ast.stmt, vectorizer: _Vectorizer, frame_name: str, index: str,
+                       writes: Set[str]) -> List[ast.stmt]:
+        def target_column(stmt: ast.stmt) -> Tuple[str, ast.AST]:
+            if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                    and isinstance(stmt.targets[0], ast.Subscript)):
+                raise _Unsupported("statement")
+            target = stmt.targets[0]
+            if not (isinstance(target.value, ast.Attribute) and target.value.attr in ("at", "loc")):
+                raise _Unsupported("assignment target")
+            column = self._indexed_cell(target, frame_name, index)
+            if column is None:
+                raise _Unsupported("assignment target")
+            writes.add(column)
+            return column, stmt.value
+        def value_of(node: ast.AST) -> ast.AST:
+            vector, kind = vectorizer.convert(node)
+            if kind == "bool" or any(isinstance(sub, ast.Constant) and isinstance(sub.value, bool)
+                                     for sub in ast.walk(node)):
+                # bools written cell by cell mix with the NaN of a new column into object
+                raise _Unsupported("bool value")
+            return vector
+        if isinstance(statement, ast.If):
+            if len(statement.body) != 1 or len(statement.orelse) > 1:
+                raise _Unsupported("if")
+            column, value = target_column(statement.body[0])
+            test, kind = vectorizer.convert(statement.test)
+            if kind != "bool":
+                raise _Unsupported("condition")
+            body = value_of(value)
+            if statement.orelse:
+                other_column, other_value = target_column(statement.orelse[0])
+                if other_column != column:
+                    raise _Unsupported("if with different columns")
+                orelse = value_of(other_value)
+                return self._store(frame_name, column, _call(_attr(_name("np"), "where"), test, body, orelse))
+            return self._store(frame_name, column, body, test)
+        column, value = target_column(statement)
+        return self._store(frame_name, column, value_of(value))
+    def _group_loop(self, node: ast.For) -> Optional[ast.AST]:
+        """for g in df['k'].unique(): df.loc[df['k'] == g, 'c'] = df.loc[df['k'] == g, 'v'].mean()
+        -> groupby('k')['v'].transform('mean')"""
+        iterator, target = node.iter, node.target
+        if not (isinstance(target, ast.Name) and isinstance(iterator, ast.Call) and not iterator.args
+                and not iterator.keywords and isinstance(iterator.func, ast.Attribute)
+                and iterator.func.attr == "unique" and len(node.body) == 1):
+            return None
+        keys = iterator.func.value
+        if not (isinstance(keys, ast.Subscript) and isinstance(keys.value, ast.Name)
+                and _str_constant(keys.slice) is not None):
+            return None
+        frame_name, key, group = keys.value.id, _str_constant(keys.slice), target.id
+        statement = node.body[0]
+        def masked(sub: ast.AST) -> Optional[str]:
+            """Column of df.loc[df['k'] == g, 'c']"""
+            if not (isinstance(sub, ast.Subscript) and isinstance(sub.value, ast.Attribute) and sub.value.attr == "loc"
+                    and isinstance(sub.value.value, ast.Name) and sub.value.value.id == frame_name
+                    and isinstance(sub.slice, ast.Tuple) and len(sub.slice.elts) == 2):
+                return None
+            mask, column = sub.slice.elts
+            if not (isinstance(mask, ast.Compare) and len(mask.ops) == 1 and isinstance(mask.ops[0], ast.Eq)):
+                return None
+            sides = [mask.left, mask.comparators[0]]
+            expected = [ast.dump(ast.Subscript(value=_name(frame_name), slice=ast.Constant(value=key), ctx=ast.Load())),
+                        ast.dump(_name(group))]
+            if sorted(ast.dump(side) for side in sides) != sorted(expected):
+                return None
+            return _str_constant(column)
+        if not (isinstance(statement, ast.Assign) and len(statement.targets) == 1
+                and isinstance(statement.value, ast.Call) and not statement.value.args
+                and not statement.value.keywords and isinstance(statement.value.func, ast.Attribute)
+                and statement.value.func.attr in _TRANSFORMS):
+            return None
+        written = masked(statement.targets[0])
+        source = masked(statement.value.func.value)
+        if written is None or source is None or self._used_outside({group}, node):
+            return None
+        # rows with missing key are not in any group of the loop
+        where = _call(_attr(_column(_name(frame_name), key), "notna"))
+        try:
+            store = self._store(frame_name, written, None, where)
+        except _Unsupported:
+            return None
+        transform = _call(_attr(ast.Subscript(value=_call(_attr(_name(frame_name), "groupby"), ast.Constant(value=key)),
+                                              slice=ast.Constant(value=source), ctx=ast.Load()), "transform"),
+                          ast.Constant(value=statement.value.func.attr))
+        store[0].body[-1].value = transform
+        self.fired.append("loop over groups")
+        guard = ast.BoolOp(op=ast.And(), values=[_attr(_attr(_name(frame_name), "index"), "is_unique"),
+                                                 _call(_name("len"), _name(frame_name))])
+        return ast.If(test=guard, body=store, orelse=[node])
+    def _concat_loop(self, node: ast.For) -> ast.AST:
+        """for ...: res = pd.concat([res, part]) -> parts are collected and concatenated once"""
+        found = None
+        for position, statement in enumerate(node.body):
+            if isinstance(statement, ast.Assign) and len(statement.targets) == 1 \
+                    and isinstance(statement.targets[0], ast.Name) and isinstance(statement.value, ast.Call):
+                call = statement.value
+                if isinstance(call.func, ast.Attribute) and call.func.attr == "concat" \
+                        and isinstance(call.func.value, ast.Name) and call.func.value.id == "pd" \
+                        and len(call.args) == 1 and isinstance(call.args[0], ast.List) \
+                        and len(call.args[0].elts) == 2 and isinstance(call.args[0].elts[0], ast.Name) \
+                        and call.args[0].elts[0].id == statement.targets[0].id \
+                        and {keyword.arg for keyword in call.keywords} <= _CONCAT_KEYWORDS:
+                    if found is not None:
+                        return node
+                    found = position
+        if found is None:
+            return node
+        statement = node.body[found]
+        result = statement.targets[0].id
+        # result must not be read or changed anywhere else in the loop
+        uses = [sub for sub in ast.walk(node) if isinstance(sub, ast.Name) and sub.id == result]
+        if len(uses) != 2:
+            return node
+        parts = f"_parts_{result}"
+        call = statement.value
+        body = list(node.body)
+        body[found] = ast.Expr(value=_call(_attr(_name(parts), "append"), call.args[0].elts[1]))
+        loop = ast.For(target=node.target, iter=node.iter, body=body, orelse=[], type_comment=None)
+        joined = ast.BinOp(left=ast.List(elts=[_name(result)], ctx=ast.Load()), op=ast.Add(), right=_name(parts))
+        concat = ast.Call(func=copy.deepcopy(call.func), args=[joined], keywords=copy.deepcopy(call.keywords))
+        self.fired.append("concat in loop")
+        return [ast.Assign(targets=[ast.Name(id=parts, ctx=ast.Store())], value=ast.List(elts=[], ctx=ast.Load())),
+                loop,
+                ast.If(test=_name(parts), body=[ast.Assign(targets=[ast.Name(id=result, ctx=ast.Store())],
+                                                          value=concat)], orelse=[])]
+
+
+def _assigned_columns(tree: ast.Module) -> Optional[Set[str]]:
+    """Columns of df the code assigns (df['a'] = ..., df.loc[..., 'a'] = ...), None if df itself
+    is reassigned or a column is assigned by a non-literal name"""
+    assigned = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "df" and isinstance(node.ctx, ast.Store):
+            return None
+        if not (isinstance(node, ast.Subscript) and isinstance(node.ctx, (ast.Store, ast.Del))):
+            continue
+        value, key = node.value, node.slice
+        if isinstance(value, ast.Attribute) and value.attr in ("loc", "at", "iloc", "iat"):
+            value = value.value
+            key = key.elts[-1] if isinstance(key, ast.Tuple) and key.elts else None
+        if not (isinstance(value, ast.Name) and value.id == "df"):
+            continue
+        if _str_constant(key) is None:
+            return None
+        assigned.add(_str_constant(key))
+    return assigned
+
+
+def column_kind(series: pd.Series) -> Optional[str]:
+    """"int" and "float" for numpy numeric columns, "string" for columns of only str values without missing ones.
+    Bool columns are unknown: python operators on a bool cell give int, numpy ones on the column keep bool"""
+    dtype = series.dtype
+    if isinstance(dtype, np.dtype) and dtype.kind in "iu":
+        return "int"
+    if isinstance(dtype, np.dtype) and dtype.kind == "f":
+        return "float"
+    if (dtype == object or isinstance(dtype, pd.StringDtype)) and not series.hasnans \
+            and pd.api.types.infer_dtype(series, skipna=False) == "string":
+        return "string"
+    return None
+
+
+def rewrite(code: str, columns, column_kind: Callable[[str], Optional[str]] = lambda name: None) -> Tuple[str, List[str]]:
+    """Static part: code with slow idioms replaced. Rewrites which depend on values of a column
+    (len, str methods, str(), float()) fire only when column_kind guarantees the same result
+
+    Args:
+        code (str): normalized code
+        columns: columns of df
+        column_kind (Callable[[str], Optional[str]], optional): kind of a column by name, see vectorize.column_kind.
+            Defaults to unknown for every column.
+
+    Returns:
+        Tuple[str, List[str]]: new code and names of rewrites which fired
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code, []
+    rewriter = _Rewriter(tree, {str(column) for column in columns}, column_kind)
+    new_tree = ast.fix_missing_locations(rewriter.visit(tree))
+    if not rewriter.fired:
+        return code, []
+    return ast.unparse(new_tree), rewriter.fired
+
+
+def _run(code: str, df: pd.DataFrame) -> Tuple[object, pd.DataFrame, float]:
+    """Same outcome as normalize_and_execute_code: result or changed df, plus run time"""
+    scope = {"df": df, "pd": pd, "np": np}
+    started = time.perf_counter()
+    exec(code, {}, scope)
+    elapsed = time.perf_counter() - started
+    return scope.get("result"), df, elapsed
+
+
+def _same(a, b) -> bool:
+    if isinstance(a, pd.DataFrame) or isinstance(b, pd.DataFrame):
+        if not (isinstance(a, pd.DataFrame) and isinstance(b, pd.DataFrame)):
+            return False
+        try:
+            pd.testing.assert_frame_equal(a, b)
+        except AssertionError:
+            return False
+        return True
+    if isinstance(a, pd.Series) or isinstance(b, pd.Series):
+        if not (isinstance(a, pd.Series) and isinstance(b, pd.Series)):
+            return False
+        try:
+            pd.testing.assert_series_equal(a, b)
+        except AssertionError:
+            return False
+        return True
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(np.asarray(a), np.asarray(b), equal_nan=True)
+    if type(a) != type(b) and not (np.isscalar(a) and np.isscalar(b)):
+        return False
+    try:
+        return bool(a == b) or bool(pd.isna(a) and pd.isna(b))
+    except (TypeError, ValueError):
+        return repr(a) == repr(b)
+
+
+def _sample(df: pd.DataFrame, rows: int) -> pd.DataFrame:
+    """Rows for the check: head, rows with missing values (where most rewrites would differ) and tail"""
+    if len(df) <= rows:
+        return df
+    missing = np.flatnonzero(df.isna().any(axis=1).to_numpy())[:rows // 4]
+    edge = (rows - len(missing)) // 2
+    positions = np.unique(np.concatenate([np.arange(edge), missing, np.arange(len(df) - edge, len(df))]))
+    return df.iloc[positions]
+
+
+def optimize(code: str, df: pd.DataFrame, report: Optional[dict] = None, verify_rows: int = VERIFY_ROWS) -> str:
+    """Rewrites iterrows/index loops, row-wise apply, apply/map with lambda and pd.concat in a loop
+    into vector forms. Rewrites are safe by construction: the ones depending on values of a column fire
+    only for columns whose dtype guarantees the same values and errors (see column_kind). The run on
+    a sample of df is a sanity and speed check only - the rewritten code is kept if it gives the same
+    result there and is faster, otherwise the original code is returned. The sample is the whole df
+    when it is small, otherwise first and last rows plus rows with missing values.
+
+    Args:
+        code (str): normalized code
+        df (pd.DataFrame): dataframe the code will run on
+        report (Optional[dict], optional): filled with "rewrites", "speedup" and times on the sample. Defaults to None.
+        verify_rows (int, optional): maximal size of the sample. Defaults to VERIFY_ROWS.
+
+    Returns:
+        str: code to execute
+    """
+    kinds = {}
+    def kind(name: str) -> Optional[str]:
+        if name not in kinds:
+            column = df[name] if name in df.columns and df.columns.is_unique else None
+            kinds[name] = column_kind(column) if isinstance(column, pd.Series) else None
+        return kinds[name]
+    new_code, fired = rewrite(code, df.columns, kind)
+    if not fired:
+        return code
+    sample = _sample(df, verify_rows)
+    try:
+        expected, expected_df, original_time = _run(code, sample.copy())
+    except Exception:
+        # original code fails on the sample, equivalence can not be checked
+        return code
+    try:
+        actual, actual_df, new_time = _run(new_code, sample.copy())
+    except Exception:
+        actual, actual_df, new_time = None, None, None
+    equivalent = new_time is not None and _same(expected, actual) and _same(expected_df, actual_df)
+    speedup = original_time / new_time if equivalent and new_time else None
+    if report is not None:
+        report["rewrites"] = fired
+        report["equivalent"] = equivalent
+        report["sample_rows"] = len(sample)
+        report["original_time"] = original_time
+        report["rewritten_time"] = new_time
+        report["speedup"] = speedup
+        report["applied"] = bool(speedup and speedup > 1)
+    # .str methods are python loops as well, such rewrites may give nothing
+    return new_code if speedup and speedup > 1 else code
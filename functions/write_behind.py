@@ -0,0 +1,143 @@
+import queue
+import logging
+import threading
+from typing import Callable, Optional, Dict
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class StateLostError(RuntimeError):
+    """State could not be written to disk even by a retry and was dropped from its session"""
+
+
+class StateWriter():
+    def __init__(self, persist: Callable[[str, pd.DataFrame, tuple], None], heartbeat: Optional[Callable[[], None]] = None,
+                 heartbeat_interval: float = 10.0):
+        """Write-behind queue of new states. A state is current at once, one background thread writes
+        states to disk in push order. Until then the frame is kept here, so it can always be loaded.
+
+        Args:
+            persist (Callable[[str, pd.DataFrame, tuple], None]): writes one state: filename, frame, extra arguments
+            heartbeat (Optional[Callable[[], None]], optional): called every heartbeat_interval seconds while the
+                writer is alive, lets other processes tell a crashed writer from a slow one. Defaults to None.
+            heartbeat_interval (float, optional): seconds between heartbeats. Defaults to 10.
+        """
+        self._persist = persist
+        self._heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self._queue = queue.Queue()
+        self._pending: Dict[str, pd.DataFrame] = {}
+        self._errors: Dict[str, BaseException] = {}
+        # extra arguments of states whose writing failed, for retry()
+        self._failed: Dict[str, tuple] = {}
+        self._done = threading.Condition()
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+        self._thread.start()
+    def hold(self, filename: str, df: pd.DataFrame) -> None:
+        """Keeping frame of a state which is about to be submitted, get() already returns it"""
+        with self._done:
+            self._pending[filename] = df
+            self._errors.pop(filename, None)
+            self._failed.pop(filename, None)
+    def submit(self, filename: str, df: pd.DataFrame, args: tuple = ()) -> None:
+        """Queueing state for writing, df must not be changed in place afterwards"""
+        self.hold(filename, df)
+        self._queue.put((filename, df, args))
+    def get(self, filename: str) -> Optional[pd.DataFrame]:
+        """Frame of a state which is not written yet"""
+        with self._done:
+            return self._pending.get(filename)
+    def is_pending(self, filename: str) -> bool:
+        with self._done:
+            return filename in self._pending
+    def wait(self, filename: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        """Durability barrier: waiting until the state (or every queued state) is on disk
+
+        Args:
+            filename (Optional[str], optional): state to wait for. Defaults to None (all states).
+            timeout (Optional[float], optional): seconds to wait. Defaults to None (no limit).
+
+        Raises:
+            RuntimeError: if writing of the state failed, the state stays in memory
+
+        Returns:
+            bool: False if timeout expired
+        """
+        with self._done:
+            def written():
+                if filename is None:
+                    return not self._pending or all(name in self._errors for name in self._pending)
+                return filename not in self._pending or filename in self._errors
+            if not self._done.wait_for(written, timeout):
+                return False
+            failed = [name for name in ([filename] if filename else list(self._pending)) if name in self._errors]
+            if failed:
+                raise RuntimeError(f"Состояние {failed[0]} не записано на диск: {self._errors[failed[0]]}")
+        return True
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self.wait(None, timeout)
+    def retry(self, filename: str) -> None:
+        """Writing a state whose background writing failed again, in the calling thread
+
+        Raises:
+            Exception: error of persist if it fails again, the state stays failed
+        """
+        with self._done:
+            df = self._pending.get(filename)
+            args = self._failed.get(filename)
+        if df is None or args is None:
+            return
+        self._persist(filename, df, args)
+        with self._done:
+            if self._pending.get(filename) is df:
+                del self._pending[filename]
+            self._errors.pop(filename, None)
+            self._failed.pop(filename, None)
+            self.written += 1
+            self._done.notify_all()
+    def discard(self, filename: str) -> None:
+        """Forgetting a state which will not be written, for example a failed one dropped from its session"""
+        with self._done:
+            self._pending.pop(filename, None)
+            self._errors.pop(filename, None)
+            self._failed.pop(filename, None)
+            self._done.notify_all()
+    def stats(self) -> dict:
+        with self._done:
+            return {"pending": len(self._pending), "failed": len(self._errors), "written": self.written}
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Writing everything queued and stopping the thread"""
+        self._queue.put(None)
+        self._thread.join(timeout)
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self._queue.get(timeout=self.heartbeat_interval)
+            except queue.Empty:
+                job = False
+            if self._heartbeat is not None:
+                try:
+                    self._heartbeat()
+                except Exception:
+                    logger.warning("Сердцебиение процесса записи не отправлено", exc_info=True)
+            if job is None:
+                break
+            if job is False:
+                continue
+            filename, df, args = job
+            try:
+                self._persist(filename, df, args)
+            except Exception as e:
+                logger.exception("Ошибка записи состояния %s", filename)
+                with self._done:
+                    self._errors[filename] = e
+                    self._failed[filename] = args
+                    self._done.notify_all()
+                continue
+            with self._done:
+                if self._pending.get(filename) is df:
+                    del self._pending[filename]
+                self.written += 1
+                self._done.notify_all()
@@ -1,84 +1,317 @@
 import os
+import time
 import pandas as pd
 from dotenv import load_dotenv
-from functions import df_code_analys, api_integration, prompts
+from functions import df_code_analys, prompts, schema_summary, tracing
 from endpoints import endpoints
 from functions.memory import MemoryManager
+from functions.write_behind import StateLostError
+from functions.retention import Retention
+from functions.executor import SandboxExecutor, SandboxError, SandboxTimeout
+from functions.llm_router import LLMRouter, ModelRefusal, is_model_failure
+from functions.streaming import StreamingCodeParser
+from concurrent.futures import ThreadPoolExecutor
 
 #Задаем все условности
 load_dotenv()
 SESSION_ID = "default"
-mgr = MemoryManager(redis_url=os.getenv("REDIS_URL"))
-client = api_integration.LLMClient(provider_name="openrouter")
-
-# Загружаем df в redis
-meta = mgr.get_current_state_info(SESSION_ID)
-if not meta:
-    meta = mgr.init_session_from_csv(SESSION_ID, r"C:\Users\tviva\Desktop\Titanic-Dataset.csv")
-    print("Исходный DataFrame загружен:", meta)
-else:
-    print("Найдено состояние:", meta)
-
-df = mgr.load_current_df(SESSION_ID)
-
-# Имитация диалога
-print("\nВведи запрос для анализа данных.")
-print("   Команды: 'undo', 'redo', 'exit'.\n")
-
-while True:
-    user_input = input("Запрос: ").strip()
-    if user_input.lower() in ["exit", "quit"]:
-        print("Завершение работы.")
-        break
-
-    elif user_input.lower() == "undo":
-        meta = mgr.undo(SESSION_ID)
-        if meta:
-            df = mgr.load_current_df(SESSION_ID)
-            print("Откат к предыдущему состоянию:", meta)
-            print(df.head())
+MODEL = "qwen/qwen3-30b-a3b:free"
+# маршруты provider:model через запятую, медленный или упавший маршрут подменяется следующим
+LLM_ROUTES = os.getenv("LLM_ROUTES", f"openrouter:{MODEL}").split(",")
+# потоковая генерация: код проверяется и колонки грузятся до конца ответа модели
+LLM_STREAM = os.getenv("LLM_STREAM", "0") == "1"
+# сколько токенов можно потратить на описание df в промпте, широкие таблицы сжимаются под этот бюджет
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 2000))
+# шаблон промпта для ключа кэша ответов модели: ответ зависит от всех маршрутов, при сбое отвечает не первый
+PROMPT_TEMPLATE = f"{','.join(LLM_ROUTES)}||{prompts.CODE_GENERATION_SYSTEM_PROMPT}"
+# сколько процессов-песочниц запускать для кода модели, 0 - выполнять в текущем процессе
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", 0))
+SANDBOX_TIMEOUT = float(os.getenv("SANDBOX_TIMEOUT", 60))
+SANDBOX_MEMORY_LIMIT = int(os.getenv("SANDBOX_MEMORY_LIMIT", 0)) or None
+# для больших состояний код сначала выполняется на кэшированной стратифицированной выборке,
+# полный расчет идет в фоне и его можно отменить
+PREVIEW_MIN_ROWS = int(os.getenv("PREVIEW_MIN_ROWS", 1_000_000))
+PREVIEW_SAMPLE_ROWS = int(os.getenv("PREVIEW_SAMPLE_ROWS", 10_000))
+# целевое время предпросмотра в секундах, в песочнице это жесткий лимит
+PREVIEW_TIMEOUT = float(os.getenv("PREVIEW_TIMEOUT", 5))
+
+
+def run_code(sandbox, code, frame, timeout=None):
+    """Запуск кода модели в песочнице, если она включена, иначе в текущем процессе"""
+    if sandbox is None:
+        return df_code_analys.normalize_and_execute_code(code, frame)
+    try:
+        with tracing.span("sandbox", rows=len(frame), preview=timeout is not None):
+            return sandbox.run(code, frame, timeout=timeout)
+    except (SandboxError, SandboxTimeout) as e:
+        print(f"\n--- Ошибка при выполнении кода: {e} ---")
+        return None
+
+
+def run_with_preview(mgr, sandbox, background, code, df, frame, signature):
+    """Предпросмотр на выборке, затем полный расчет в фоне. Возвращает полный результат
+    и признак отмены. Без песочницы отмена не прерывает уже начатый расчет, а только отбрасывает его"""
+    sample = mgr.get_sample(SESSION_ID, PREVIEW_SAMPLE_ROWS, df=df, signature=signature)
+    if frame is not df:
+        sample = sample[list(frame.columns)]
+    sample = mgr.expand(SESSION_ID, sample)
+    started = time.monotonic()
+    preview = run_code(sandbox, code, sample, timeout=PREVIEW_TIMEOUT)
+    elapsed = time.monotonic() - started
+    print(f"\nПредпросмотр на выборке из {len(sample)} строк ({elapsed:.2f} с):")
+    print(preview.head() if isinstance(preview, pd.DataFrame) else preview)
+    if elapsed > PREVIEW_TIMEOUT:
+        print(f"Предпросмотр дольше целевых {PREVIEW_TIMEOUT} с, уменьшите PREVIEW_SAMPLE_ROWS.")
+    if sandbox is not None:
+        try:
+            job = sandbox.submit(code, frame)
+        except SandboxError as e:
+            print(f"\n--- Ошибка при выполнении кода: {e} ---")
+            return None, False
+    else:
+        job = background.submit(df_code_analys.normalize_and_execute_code, code, frame)
+    answer = input(f"Полный расчет на {len(frame)} строках идет в фоне. "
+                   "Enter - дождаться результата, 'cancel' - отменить: ").strip().lower()
+    if answer == "cancel":
+        job.cancel()
+        print("Полный расчет отменен, состояние не изменено.")
+        return None, True
+    try:
+        result = job.result()
+    except (SandboxError, SandboxTimeout) as e:
+        print(f"\n--- Ошибка при выполнении кода: {e} ---")
+        return None, False
+    return result, False
+
+
+def main():
+    # TRACING=1 - время этапов каждого запроса, TRACE_FILE - файл со спанами в json lines
+    tracing.configure_from_env()
+    mgr = MemoryManager(redis_url=os.getenv("REDIS_URL"), storage_mode=os.getenv("STORAGE_MODE", "parquet"),
+                        cache_bytes=int(os.getenv("DF_CACHE_BYTES", 1024 ** 3)),
+                        result_cache_bytes=int(os.getenv("RESULT_CACHE_BYTES", 256 * 1024 ** 2)),
+                        write_behind=os.getenv("WRITE_BEHIND", "1") == "1",
+                        hot_format=os.getenv("HOT_STATE_FORMAT", "arrow"),
+                        hot_states=int(os.getenv("HOT_STATES", 3)),
+                        compact=os.getenv("COMPACT_DTYPES", "0") == "1",
+                        compact_strings=os.getenv("COMPACT_STRINGS", "category"))
+    # состояния, которые не успели записаться при прошлом падении, удаляются из истории
+    recovered = mgr.recover(SESSION_ID)
+    if recovered["dropped"]:
+        print("Не записанные на диск состояния удалены из истории:", recovered["dropped"])
+    # старые сессии удаляются, длинные истории сжимаются до лимитов, свободные чанки столбцов удаляются
+    retention = Retention(mgr, ttl_seconds=float(os.getenv("RETENTION_TTL", 0)),
+                          max_steps=int(os.getenv("RETENTION_MAX_STEPS", 0)),
+                          max_bytes=int(os.getenv("RETENTION_MAX_BYTES", 0)),
+                          chunk_grace_seconds=float(os.getenv("CHUNK_GRACE_SECONDS", 600)))
+    retention.start(float(os.getenv("RETENTION_INTERVAL", 300)))
+    client = LLMRouter(LLM_ROUTES)
+    background = ThreadPoolExecutor(max_workers=1)
+    sandbox = SandboxExecutor(workers=SANDBOX_WORKERS, timeout=SANDBOX_TIMEOUT,
+                              memory_limit=SANDBOX_MEMORY_LIMIT) if SANDBOX_WORKERS else None
+
+    # Загружаем df в redis
+    meta = mgr.get_current_state_info(SESSION_ID)
+    if not meta:
+        # большие csv читаются блоками прямо в parquet, порог памяти задается INGEST_MEMORY_BYTES
+        meta = mgr.init_session_from_csv(SESSION_ID, r"C:\Users\tviva\Desktop\Titanic-Dataset.csv",
+                                         max_memory_bytes=int(os.getenv("INGEST_MEMORY_BYTES", 256 * 1024 ** 2)),
+                                         progress=True)
+        print("Исходный DataFrame загружен:", meta)
+        if "compaction" in meta:
+            print(f"Сжатие типов: {meta['compaction']['bytes_before']} -> {meta['compaction']['bytes_after']} байт")
+    else:
+        print("Найдено состояние:", meta)
+
+    df = mgr.load_current_df(SESSION_ID)
+
+    # Имитация диалога
+    print("\nВведи запрос для анализа данных.")
+    print("   Команды: 'undo', 'redo', 'history', 'checkout <шаг>', 'exit'.\n")
+
+    # спан текущего запроса закрывается перед чтением следующего
+    query = tracing.NOOP
+    while True:
+        query.end()
+        user_input = input("Запрос: ").strip()
+        if user_input.lower() in ["exit", "quit"]:
+            print("Кэш состояний:", mgr.frame_cache.stats())
+            print("Кэш ответов модели:", mgr.llm_cache_stats)
+            print("Кэш результатов:", mgr.result_cache.stats())
+            print("Маршруты модели:", client.stats())
+            print("Очистка хранилища:", retention.stats())
+            if tracing.enabled():
+                print("Метрики этапов:", tracing.stats()["histograms"])
+                tracing.configure(False)
+            retention.stop()
+            # новые состояния пишутся в фоне, перед выходом дожидаемся записи
+            mgr.close()
+            client.close()
+            background.shutdown(cancel_futures=True)
+            print("Завершение работы.")
+            if sandbox is not None:
+                sandbox.shutdown()
+            break
+
+        elif user_input.lower() == "undo":
+            try:
+                meta = mgr.undo(SESSION_ID)
+            except StateLostError as e:
+                # состояние не удалось записать, оно удалено, текущим стало предыдущее
+                print(e)
+                df = mgr.load_current_df(SESSION_ID)
+                print(df.head())
+                continue
+            if meta:
+                df = mgr.load_current_df(SESSION_ID)
+                print("Откат к предыдущему состоянию:", meta)
+                print(df.head())
+            else:
+                print("Нет предыдущих состояний.")
+            continue
+
+        elif user_input.lower() == "redo":
+            meta = mgr.redo(SESSION_ID)
+            if meta:
+                df = mgr.load_current_df(SESSION_ID)
+                print("Перемотка вперёд:", meta)
+                print(df.head())
+            else:
+                print("Нет следующих состояний.")
+            continue
+
+        elif user_input.lower() == "history":
+            # ветка текущего состояния только из метаданных, файлы состояний не читаются
+            for node in mgr.history(SESSION_ID):
+                changes = node.get("changes") or {}
+                touched = ", ".join(f"{kind}: {', '.join(changes[kind])}" for kind in ("added", "removed", "modified")
+                                    if changes.get(kind))
+                print(f"  шаг {node['step']}: {node.get('nrows')}x{node.get('ncols')} {node.get('note', '')} {touched}")
+            continue
+
+        elif user_input.lower().startswith("checkout "):
+            step = user_input.split(maxsplit=1)[1]
+            try:
+                meta = mgr.checkout(SESSION_ID, int(step)) if step.isdigit() else None
+            except StateLostError as e:
+                print(e)
+                df = mgr.load_current_df(SESSION_ID)
+                continue
+            if meta:
+                df = mgr.load_current_df(SESSION_ID)
+                print("Переход к состоянию:", meta)
+                print(df.head())
+            else:
+                print(f"Нет состояния с шагом {step}.")
+            continue
+
+        query = tracing.begin("query", session_id=SESSION_ID, query=user_input)
+        # колонки, которые прочитает код, загружаются в фоне, пока модель пишет комментарий
+        prefetch = {}
+        # подпись состояния берётся из метаданных, df хэшируется только пока состояние пишется в фоне
+        signature = mgr.state_signature(SESSION_ID, df)
+
+        cached = mgr.get_cache(PROMPT_TEMPLATE, signature, user_input)
+        if cached and cached.get("error"):
+            print("Этот запрос недавно завершился ошибкой:", cached["error"])
+            continue
+        if cached:
+            print("Ответ модели взят из кэша.")
+            parsed_result = endpoints.PandasCode(code=cached["code"], comment=cached["comment"])
+        else:
+            # получаем info о текущем df, профиль считается один раз на состояние,
+            # для широких таблиц - сжатое описание с колонками, подходящими к запросу
+            try:
+                profile = mgr.get_profile(SESSION_ID)
+            except StateLostError as e:
+                print(e)
+                df = mgr.load_current_df(SESSION_ID)
+                continue
+            info = schema_summary.build_schema_summary(profile, user_input, budget=PROMPT_TOKEN_BUDGET)
+
+            # формируем промпт
+            system_prompt = prompts.prompt_code_generation(info=info, querry=user_input)
+
+            print("Отправляем запрос модели...")
+            try:
+                if LLM_STREAM:
+                    # код показывается по мере генерации и проверяется до того, как модель допишет комментарий
+                    def on_code(code):
+                        columns = df_code_analys.projected_columns(code)
+                        if columns:
+                            prefetch[code] = background.submit(mgr.load_current_df, SESSION_ID, columns=columns)
+                    parser = StreamingCodeParser(on_code=on_code,
+                                                 on_progress=lambda piece: print(piece, end="", flush=True))
+                    try:
+                        response = client.stream(
+                            parser,
+                            messages=system_prompt,
+                            response_format=endpoints.PandasCode,
+                            temperature=0,
+                            top_p=0.95
+                        )
+                    finally:
+                        print()
+                else:
+                    response = client.parse(
+                        messages=system_prompt,
+                        response_format=endpoints.PandasCode,
+                        temperature=0,
+                        top_p=0.95
+                    )
+                parsed_result = response.choices[0].message.parsed
+                if parsed_result is None:
+                    raise ModelRefusal(response.choices[0].message.refusal or "модель не вернула код")
+            except Exception as e:
+                print(f"Ошибка генерации: {e}")
+                # запоминается только отказ модели или неверный ответ, сетевые ошибки и лимиты повторяются
+                if is_model_failure(e):
+                    mgr.set_negative_cache(PROMPT_TEMPLATE, signature, user_input, error=str(e))
+                continue
+            mgr.set_cache(PROMPT_TEMPLATE, signature, user_input,
+                          {"code": parsed_result.code, "comment": parsed_result.comment, "model": response.model})
+
+        # выводим результат от модели
+        print("\nКомментарий модели:", parsed_result.comment)
+        print("Сгенерированный код:\n", parsed_result.code)
+
+        # результат того же кода на том же содержимом df уже посчитан, если код только читает df
+        # и не зависит от случайных чисел и текущего времени
+        code = parsed_result.code
+        cacheable = df_code_analys.is_read_only(code) and df_code_analys.is_deterministic(code)
+        result_key = mgr.result_cache.key(signature, code) if cacheable else None
+        found, execution_result = mgr.result_cache.get(result_key)
+        if found:
+            print("Результат выполнения взят из кэша.")
         else:
-            print("Нет предыдущих состояний.")
-        continue
-
-    elif user_input.lower() == "redo":
-        meta = mgr.redo(SESSION_ID)
-        if meta:
-            df = mgr.load_current_df(SESSION_ID)
-            print("Перемотка вперёд:", meta)
+            # код, который только читает df, выполняется на тех колонках, к которым обращается,
+            # результат тот же, что и на полном df, поэтому код выполняется один раз.
+            # Колонки берутся из кэша состояний или читаются с диска без копирования всего df
+            columns = df_code_analys.projected_columns(parsed_result.code)
+            if code in prefetch:
+                frame = prefetch[code].result()
+            else:
+                frame = mgr.load_current_df(SESSION_ID, columns=columns) if columns else df
+            # сжатие типов только для хранения, код видит столбцы в исходных типах
+            frame = mgr.expand(SESSION_ID, frame)
+            if len(df) >= PREVIEW_MIN_ROWS:
+                execution_result, cancelled = run_with_preview(mgr, sandbox, background, parsed_result.code,
+                                                               df, frame, signature)
+                if cancelled:
+                    continue
+            else:
+                execution_result = run_code(sandbox, parsed_result.code, frame)
+            mgr.result_cache.put(result_key, execution_result)
+
+        if isinstance(execution_result, pd.DataFrame):
+            meta = mgr.push_result(SESSION_ID, execution_result, code=parsed_result.code)
+            # при сжатии типов состояние хранится не в том виде, в каком его вернул код
+            df = mgr.load_current_df(SESSION_ID) if "compaction" in meta else execution_result
+            print("DataFrame изменён. Метаданные:", meta)
             print(df.head())
         else:
-            print("Нет следующих состояний.")
-        continue
-
-    # получаем info о текущем df
-    info = df_code_analys.pd_getinfo(df)
-
-    # формируем промпт
-    system_prompt = prompts.prompt_code_generation(info=info, querry=user_input)
-
-    print("Отправляем запрос модели...")
-    response = client.chat.completions.parse(
-        model="qwen/qwen3-30b-a3b:free",
-        messages=system_prompt,
-        response_format=endpoints.PandasCode,
-        temperature=0,
-        top_p=0.95
-    )
-
-    parsed_result = response.choices[0].message.parsed
-
-    # выводим результат от модели
-    print("\nКомментарий модели:", parsed_result.comment)
-    print("Сгенерированный код:\n", parsed_result.code)
-
-    # выполняем код
-    execution_result = df_code_analys.normalize_and_execute_code(parsed_result.code, df)
-
-    if isinstance(execution_result, pd.DataFrame):
-        meta = mgr.push_result(SESSION_ID, execution_result, code=parsed_result.code)
-        df = execution_result
-        print("DataFrame изменён. Метаданные:", meta)
-        print(df.head())
-    else:
-        print("Результат выполнения запроса:", execution_result)
+            print("Результат выполнения запроса:", execution_result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import os
+import io
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+from typing import Callable, Dict, List, Optional
+import numpy as np
+import pandas as pd
+import redis
+from functions.memory import MemoryManager
+from functions.df_code_analys import pd_getinfo, normalize_and_execute_code
+
+# Бенчмарк MemoryManager и пути исполнения кода на синтетических таблицах.
+# Запуск: python -m tests.benchmark --redis fake --sizes 10000,1000000
+#         python -m tests.benchmark --redis redis://localhost:6379/15 --save-baseline
+# Каждый замер: медиана времени по повторам и пиковый RSS процесса во время замера.
+# С --baseline результаты сравниваются с сохранёнными, регрессии дают код выхода 1.
+# Для 50M строк нужно порядка 10 ГБ памяти и места на диске: --sizes 50000000 --shapes narrow
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+SHAPES = {"narrow": 8, "wide": 200}
+# код, который типично генерирует модель: только чтение и изменение таблицы
+READ_CODE = "df.groupby('category')['amount'].agg(['mean', 'sum', 'count'])"
+WRITE_CODE = "df['amount_share'] = df['amount'] / df['amount'].sum()\ndf = df[df['flag']]"
+
+
+def make_frame(rows: int, columns: int, seed: int = 0) -> pd.DataFrame:
+    """Synthetic table with mixed dtypes: ints, floats with gaps, low and high cardinality strings,
+    bools and timestamps. Columns after the first eight repeat the same kinds with other values."""
+    rng = np.random.default_rng(seed)
+    categories = np.array([f"cat_{i}" for i in range(50)], dtype=object)
+    kinds = [
+        ("id", lambda: np.arange(rows, dtype=np.int64)),
+        ("category", lambda: categories[rng.integers(0, len(categories), rows)]),
+        ("amount", lambda: rng.normal(1000, 250, rows).round(2)),
+        ("count", lambda: rng.integers(0, 1000, rows)),
+        ("flag", lambda: rng.random(rows) < 0.5),
+        ("ratio", lambda: np.where(rng.random(rows) < 0.05, np.nan, rng.random(rows))),
+        ("created", lambda: pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 365 * 86400, rows), unit="s")),
+        ("code", lambda: pd.Series(rng.integers(0, rows * 10, rows)).map("c{:x}".format).to_numpy(dtype=object)),
+    ]
+    data = {}
+    for i in range(columns):
+        name, values = kinds[i % len(kinds)]
+        data[name if i < len(kinds) else f"{name}_{i}"] = values()
+    return pd.DataFrame(data)
+
+
+class PeakRSS():
+    def __init__(self, interval: float = 0.005):
+        """Peak resident memory of the process while the block runs, sampled in a background thread
+
+        Args:
+            interval (float, optional): sampling period, seconds. Defaults to 0.005.
+        """
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+    @staticmethod
+    def current() -> int:
+        """Resident memory in bytes, /proc on Linux and peak of the whole process elsewhere"""
+        try:
+            with open("/proc/self/statm") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            import resource
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+    def __enter__(self) -> "PeakRSS":
+        self.start = self.peak = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def measure(func: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> dict:
+    """Median time of func over repeat runs and peak RSS over all of them, setup runs before each run untimed"""
+    times = []
+    with PeakRSS() as rss:
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            gc.collect()
+            started = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - started)
+    times.sort()
+    return {"seconds": times[len(times) // 2], "min_seconds": times[0], "repeat": repeat,
+            "peak_rss_mb": round(rss.peak / 1024 ** 2, 1), "rss_growth_mb": round((rss.peak - rss.start) / 1024 ** 2, 1)}
+
+
+def quiet(func: Callable[[], object]) -> Callable[[], object]:
+    """normalize_and_execute_code prints the code and every step, printing is not what is measured"""
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+    return run
+
+
+@contextlib.contextmanager
+def redis_backend(url: str, flush_db: bool = False):
+    """'fake' - in-process fakeredis (pip install fakeredis lupa), anything else - url of a real redis.
+    A real database is flushed before and after the run, so it needs flush_db and a spare database, never db 0."""
+    if url != "fake":
+        client = redis.from_url(url)
+        db = int(client.connection_pool.connection_kwargs.get("db") or 0)
+        if not flush_db or db == 0:
+            raise SystemExit("Бенчмарк очищает базу redis: укажите свободную базу в url (не 0, например "
+                             "redis://localhost:6379/15) и флаг --flush-db")
+        client.flushdb()
+        yield url
+        client.flushdb()
+        return
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("Для --redis fake нужен пакет fakeredis (и lupa для Lua-скриптов)")
+    server = fakeredis.FakeServer()
+    original = redis.from_url
+    redis.from_url = lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs)
+    try:
+        yield "redis://fake"
+    finally:
+        redis.from_url = original
+
+
+def bench_dataset(mgr: MemoryManager, name: str, df: pd.DataFrame, workdir: str, repeat: int) -> Dict[str, dict]:
+    """All measured operations on one synthetic table, results by operation name"""
+    results = {}
+    csv_path = os.path.join(workdir, f"{name}.csv")
+    df.to_csv(csv_path, index=False)
+    session_id = f"bench-{name}"
+    counter = iter(range(10 ** 6))
+
+    results["init_session_from_csv"] = measure(
+        lambda: mgr.init_session_from_csv(f"{session_id}-init-{next(counter)}", csv_path), repeat)
+    mgr.init_session_from_csv(session_id, csv_path)
+    mgr.flush()
+
+    results["load_current_df/cold"] = measure(lambda: mgr.load_current_df(session_id), repeat,
+                                              setup=mgr.frame_cache.clear)
+    results["load_current_df/warm"] = measure(lambda: mgr.load_current_df(session_id), repeat)
+    current = mgr.load_current_df(session_id)
+
+    results["df_describtion"] = measure(lambda: mgr.df_describtion(current), repeat)
+    results["pd_getinfo"] = measure(lambda: pd_getinfo(current), repeat)
+    results["normalize_and_execute_code/read"] = measure(
+        quiet(lambda: normalize_and_execute_code(READ_CODE, current)), repeat)
+    results["normalize_and_execute_code/write"] = measure(
+        quiet(lambda: normalize_and_execute_code(WRITE_CODE, current)), repeat)
+
+    changed = current.assign(amount_share=current["amount"] / current["amount"].sum())
+    results["push_result"] = measure(lambda: mgr.push_result(session_id, changed, code=WRITE_CODE), repeat)
+    mgr.flush()
+    results["undo"] = measure(lambda: mgr.undo(session_id), repeat, setup=lambda: mgr.redo(session_id))
+    results["redo"] = measure(lambda: mgr.redo(session_id), repeat, setup=lambda: mgr.undo(session_id))
+    os.remove(csv_path)
+    return results
+
+
+def run(sizes: List[int], shapes: List[str], redis_url: str, storage_mode: str, repeat: int,
+        write_behind: bool, compact: bool, flush_db: bool = False) -> dict:
+    results = {}
+    with redis_backend(redis_url, flush_db) as url, tempfile.TemporaryDirectory() as workdir:
+        mgr = MemoryManager(redis_url=url, storage_dir=os.path.join(workdir, "states"), storage_mode=storage_mode,
+                            write_behind=write_behind, compact=compact)
+        try:
+            for shape in shapes:
+                for rows in sizes:
+                    # wide tables of the same total size as narrow ones
+                    rows_of_shape = max(1, rows * SHAPES["narrow"] // SHAPES[shape])
+                    name = f"{shape}-{rows_of_shape}"
+                    print(f"{name}: генерация...", flush=True)
+                    df = make_frame(rows_of_shape, SHAPES[shape])
+                    for operation, result in bench_dataset(mgr, name, df, workdir, repeat).items():
+                        results[f"{name}/{operation}"] = result
+                        print(f"  {operation:<36} {result['seconds'] * 1000:10.1f} мс  "
+                              f"RSS {result['peak_rss_mb']:8.1f} МБ", flush=True)
+                    del df
+                    mgr.frame_cache.clear()
+        finally:
+            mgr.close()
+    return {"environment": environment(redis_url, storage_mode, write_behind, compact), "results": results}
+
+
+def environment(redis_url: str, storage_mode: str, write_behind: bool, compact: bool) -> dict:
+    return {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "redis": "fake" if redis_url == "fake" else "server", "storage_mode": storage_mode,
+            "write_behind": write_behind, "compact": compact}
+
+
+def compare(current: dict, baseline: dict, tolerance: float, min_seconds: float, min_rss_mb: float) -> List[str]:
+    """Regressions of current run against baseline: slower or bigger by more than tolerance share,
+    differences below min_seconds / min_rss_mb are noise"""
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline["results"].get(key)
+        if base is None:
+            continue
+        slower = result["seconds"] - base["seconds"]
+        if slower > min_seconds and result["seconds"] > base["seconds"] * (1 + tolerance):
+            regressions.append(f"{key}: время {base['seconds'] * 1000:.1f} -> {result['seconds'] * 1000:.1f} мс "
+                               f"(+{slower / base['seconds']:.0%})")
+        grown = result["rss_growth_mb"] - base["rss_growth_mb"]
+        if grown > min_rss_mb and result["rss_growth_mb"] > base["rss_growth_mb"] * (1 + tolerance):
+            regressions.append(f"{key}: память {base['rss_growth_mb']:.1f} -> {result['rss_growth_mb']:.1f} МБ")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="rows of narrow tables, comma separated")
+    parser.add_argument("--shapes", default="narrow,wide", help=f"from {', '.join(SHAPES)}")
+    parser.add_argument("--redis", default="fake", help="'fake' (in-process fakeredis) or redis url")
+    parser.add_argument("--flush-db", action="store_true",
+                        help="allow flushing the database of a real redis url, db 0 is always refused")
+    parser.add_argument("--storage-mode", default="parquet", choices=["parquet", "columnar"])
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write results as the new baseline")
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed slowdown share")
+    parser.add_argument("--min-seconds", type=float, default=0.01)
+    parser.add_argument("--min-rss-mb", type=float, default=20)
+    args = parser.parse_args()
+    shapes = [shape for shape in args.shapes.split(",") if shape]
+    unknown = [shape for shape in shapes if shape not in SHAPES]
+    if unknown:
+        parser.error(f"unknown shapes: {', '.join(unknown)}")
+
+    report = run([int(size) for size in args.sizes.split(",") if size], shapes, args.redis, args.storage_mode,
+                 max(1, args.repeat), args.write_behind, args.compact, args.flush_db)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+        print(f"Базовая линия сохранена: {args.baseline}")
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f"Нет базовой линии {args.baseline}, сравнение пропущено")
+        sys.exit(0)
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline.get("environment") != report["environment"]:
+        print("Внимание: окружение отличается от базовой линии:", baseline.get("environment"))
+    regressions = compare(report, baseline, args.tolerance, args.min_seconds, args.min_rss_mb)
+    missing = sorted(set(report["results"]) - set(baseline["results"]))
+    if missing:
+        print(f"Нет в базовой линии: {len(missing)} замеров")
+    if regressions:
+        print("Регрессии:")
+        for line in regressions:
+            print("  ", line)
+        sys.exit(1)
+    print("Регрессий нет")
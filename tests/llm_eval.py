@@ -0,0 +1,257 @@
+import os
+import io
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from endpoints.endpoints import PandasCode
+from functions import df_code_analys, prompts
+from functions.llm_router import LLMRouter
+from tests.mock_llm_server import MockServer, MockModel
+from tests.openai_api_test import EVAL_DF, EVALUATION_DATASET, compare_results
+
+# Параллельный прогон оценочного датасета по нескольким моделям.
+# Офлайн на mock-сервере:  python -m tests.llm_eval --mock fast=0.1 --mock slow=0.5,0.1 --repeat 50
+# На настоящих моделях:    python -m tests.llm_eval --route openrouter:qwen/qwen3-8b:free --config api.json
+# Ответы моделей сохраняются в --cache-dir, повторный прогон с --replay не ходит в сеть.
+# Для каждой модели: точность, задержка p50/p95/p99, токены в секунду и время выполнения кода.
+
+# код, которым mock-сервер отвечает на запросы датасета
+REFERENCE_CODE = {
+    "T01_SimpleMean": "df['Age'].mean()",
+    "T02_FilterAndCount": "df[(df['Sex'] == 'female') & (df['Survived'] == 1)].shape[0]",
+    "T03_DropColumn": "df.drop(columns=['Embarked'], inplace=True)",
+    "T04_CreateColumn": "df['AgeGroup'] = pd.cut(df['Age'], bins=[0, 18, 40, 100], labels=['Child', 'Adult', 'Senior'])",
+    "T05_GroupBy": "df.groupby('Pclass')['Fare'].mean()",
+}
+_PROMPT_CODE = {case["prompt"]: REFERENCE_CODE[case["id"]] for case in EVALUATION_DATASET}
+
+
+def reference_answer(messages: list) -> str:
+    """answer callback of the mock server: reference code for prompts of the dataset"""
+    query = messages[-1]["content"] if messages else ""
+    code = _PROMPT_CODE.get(query, "df.shape[0]")
+    return json.dumps({"code": code, "comment": "mock"}, ensure_ascii=False)
+
+
+class ResponseCache():
+    def __init__(self, cache_dir: str):
+        """Answers of models on disk, one json file per (route, messages, temperature, schema)"""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+    @staticmethod
+    def key(route: str, messages: list, temperature: float, sample: str = "") -> str:
+        """sample tells apart repeated runs of the same case, each of them gets its own answer"""
+        payload = json.dumps({"route": route, "messages": messages, "temperature": temperature, "sample": sample,
+                              "schema": PandasCode.model_json_schema()}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+    def put(self, key: str, entry: dict) -> None:
+        # через временный файл, параллельные прогоны не видят половину ответа
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(tmp, self._path(key))
+
+
+class Evaluator():
+    def __init__(self, routes: List[str], config_path: str, cache: Optional[ResponseCache] = None,
+                 replay: bool = False, concurrency: int = 8, temperature: float = 0.0, timeout: float = 120.0):
+        """Runs the dataset against every route separately (no failover or hedging between them)
+
+        Args:
+            routes (List[str]): "provider:model" routes to compare
+            config_path (str): api.json with the providers
+            cache (Optional[ResponseCache], optional): answers are taken from it and saved to it. Defaults to None.
+            replay (bool, optional): answers only from cache, a case without cached answer is an error. Defaults to False.
+            concurrency (int, optional): requests in flight per route. Defaults to 8.
+            temperature (float, optional): Defaults to 0.
+            timeout (float, optional): limit of one request, seconds. Defaults to 120.
+        """
+        self.routes = routes
+        self.cache = cache
+        self.replay = replay
+        self.concurrency = concurrency
+        self.temperature = temperature
+        self.routers = {} if replay else {
+            route: LLMRouter([route], config_path=config_path, max_hedges=0, cooldown=0,
+                             timeout=timeout, attempt_timeout=timeout, max_connections=concurrency)
+            for route in routes}
+        self.info = df_code_analys.pd_getinfo(EVAL_DF)
+        # normalize_and_execute_code печатает ход выполнения, перенаправление stdout общее для потоков
+        self._exec_lock = threading.Lock()
+    def _answer(self, route: str, messages: list, sample: str) -> dict:
+        """Answer of the model: content, usage, latency and whether it came from cache"""
+        key = ResponseCache.key(route, messages, self.temperature, sample) if self.cache is not None else None
+        if key is not None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                return dict(entry, cached=True)
+        if self.replay:
+            raise LookupError("нет сохранённого ответа для --replay")
+        started = time.monotonic()
+        response = self.routers[route].parse(messages=messages, response_format=PandasCode,
+                                             temperature=self.temperature)
+        latency = time.monotonic() - started
+        usage = response.usage
+        entry = {"route": route, "content": response.choices[0].message.content, "latency": latency,
+                 "prompt_tokens": usage.prompt_tokens if usage else 0,
+                 "completion_tokens": usage.completion_tokens if usage else 0}
+        if key is not None:
+            self.cache.put(key, entry)
+        return dict(entry, cached=False)
+    def run_case(self, route: str, case: dict) -> dict:
+        result = {"route": route, "id": case["id"], "status": "ERROR", "message": "", "cached": False,
+                  "latency": None, "completion_tokens": 0, "exec_seconds": None}
+        messages = prompts.prompt_code_generation(info=self.info, querry=case["prompt"])
+        try:
+            answer = self._answer(route, messages, case["id"].partition("#")[2])
+            result.update(cached=answer["cached"], latency=answer["latency"],
+                          completion_tokens=answer["completion_tokens"])
+            parsed = PandasCode.model_validate_json(answer["content"])
+            with self._exec_lock, contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                actual = df_code_analys.normalize_and_execute_code(parsed.code, EVAL_DF.copy())
+                result["exec_seconds"] = time.perf_counter() - started
+            passed, message = compare_results(actual, case["expected_result"])
+            result.update(status="PASS" if passed else "FAIL", message=message, code=parsed.code)
+        except Exception as e:
+            result["message"] = f"{type(e).__name__}: {e}"
+        return result
+    def run(self, cases: List[dict]) -> List[dict]:
+        """Every case on every route, routes run at the same time with concurrency requests each"""
+        pools = {route: ThreadPoolExecutor(self.concurrency) for route in self.routes}
+        try:
+            futures = [pools[route].submit(self.run_case, route, case) for route in self.routes for case in cases]
+            return [future.result() for future in futures]
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
+    def close(self) -> None:
+        for router in self.routers.values():
+            router.close()
+
+
+def _percentile(values: list, q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(results: List[dict]) -> Dict[str, dict]:
+    """Accuracy and speed by route. tokens_per_second is completion tokens over the time of answers"""
+    summary = {}
+    for route in dict.fromkeys(result["route"] for result in results):
+        rows = [result for result in results if result["route"] == route]
+        latencies = [row["latency"] for row in rows if row["latency"] is not None]
+        exec_times = [row["exec_seconds"] for row in rows if row["exec_seconds"] is not None]
+        tokens = sum(row["completion_tokens"] for row in rows if row["latency"] is not None)
+        summary[route] = {
+            "cases": len(rows),
+            "passed": sum(row["status"] == "PASS" for row in rows),
+            "failed": sum(row["status"] == "FAIL" for row in rows),
+            "errors": sum(row["status"] == "ERROR" for row in rows),
+            "accuracy": sum(row["status"] == "PASS" for row in rows) / len(rows),
+            "cached": sum(row["cached"] for row in rows),
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p95": _percentile(latencies, 0.95),
+            "latency_p99": _percentile(latencies, 0.99),
+            "tokens_per_second": tokens / sum(latencies) if latencies and sum(latencies) > 0 else None,
+            "exec_mean_seconds": sum(exec_times) / len(exec_times) if exec_times else None,
+            "exec_p95_seconds": _percentile(exec_times, 0.95),
+        }
+    return summary
+
+
+def print_report(results: List[dict], summary: Dict[str, dict], wall: float) -> None:
+    fmt = lambda value, scale=1.0, digits=3: "-" if value is None else f"{value * scale:.{digits}f}"
+    print("\n" + "=" * 20 + " ИТОГОВЫЙ ОТЧЕТ " + "=" * 20)
+    print(f"Время прогона: {wall:.1f} с")
+    for route, stats in summary.items():
+        print(f"\n{route}: точность {stats['passed']}/{stats['cases']} ({stats['accuracy']:.0%}), "
+              f"ошибок {stats['errors']}, из кэша {stats['cached']}")
+        print(f"  задержка p50={fmt(stats['latency_p50'])} p95={fmt(stats['latency_p95'])} "
+              f"p99={fmt(stats['latency_p99'])} с, токенов/с {fmt(stats['tokens_per_second'], digits=1)}")
+        print(f"  выполнение кода: среднее {fmt(stats['exec_mean_seconds'], 1000, 2)} мс, "
+              f"p95 {fmt(stats['exec_p95_seconds'], 1000, 2)} мс")
+        by_case = {}
+        for row in results:
+            if row["route"] == route:
+                by_case.setdefault(row["id"].split("#")[0], []).append(row)
+        for case_id, rows in by_case.items():
+            passed = sum(row["status"] == "PASS" for row in rows)
+            exec_times = [row["exec_seconds"] for row in rows if row["exec_seconds"] is not None]
+            line = f"    {case_id:<22} {passed}/{len(rows)}  выполнение {fmt(_percentile(exec_times, 0.5), 1000, 2)} мс"
+            failed = next((row for row in rows if row["status"] != "PASS"), None)
+            if failed is not None:
+                line += f"  {failed['status']}: {failed['message'][:100]}"
+            print(line)
+
+
+def expand_cases(repeat: int) -> List[dict]:
+    """Dataset repeated to simulate a bigger eval set, ids get #n suffix"""
+    if repeat <= 1:
+        return list(EVALUATION_DATASET)
+    return [dict(case, id=f"{case['id']}#{n}") for n in range(repeat) for case in EVALUATION_DATASET]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--route", action="append", default=[], help="provider:model, can be repeated")
+    parser.add_argument("--config", default=os.getenv("LLM_CONFIG", "api.json"))
+    parser.add_argument("--mock", action="append", default=[],
+                        help="name=latency,tail,error_rate,rate_limit - local mock model, can be repeated")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1, help="run every case this many times")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--cache-dir", default="llm_eval_cache")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--replay", action="store_true", help="only cached answers, no requests")
+    parser.add_argument("--output", help="write results and summary to this json file")
+    args = parser.parse_args()
+    if not args.route and not args.mock:
+        parser.error("нужен --route или --mock")
+    if args.replay and args.no_cache:
+        parser.error("--replay работает только с кэшем")
+
+    cache = None if args.no_cache else ResponseCache(args.cache_dir)
+    cases = expand_cases(args.repeat)
+    with contextlib.ExitStack() as stack:
+        routes = list(args.route)
+        config_path = args.config
+        if args.mock:
+            models = {name: MockModel.from_spec(spec) for name, spec in (item.split("=", 1) for item in args.mock)}
+            tmp = stack.enter_context(tempfile.TemporaryDirectory())
+            if not args.replay:
+                server = stack.enter_context(MockServer(models, port=args.port, answer=reference_answer))
+                config_path = os.path.join(tmp, "api.json")
+                with open(config_path, "w") as file:
+                    json.dump({"mock": {"base_url": server.base_url, "requires_api_key": False}}, file)
+            routes += [f"mock:{name}" for name in models]
+        evaluator = Evaluator(routes, config_path, cache=cache, replay=args.replay, concurrency=args.concurrency,
+                              temperature=args.temperature, timeout=args.timeout)
+        stack.callback(evaluator.close)
+        print(f"Кейсов: {len(cases)}, моделей: {len(routes)}, параллельно: {args.concurrency} на модель")
+        started = time.monotonic()
+        results = evaluator.run(cases)
+        wall = time.monotonic() - started
+    summary = summarize(results)
+    print_report(results, summary, wall)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"summary": summary, "results": results, "wall_seconds": wall}, file, indent=2, ensure_ascii=False)
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from endpoints.endpoints import PandasCode
+from functions.llm_router import LLMRouter, RouterError
+from tests.mock_llm_server import MockServer, MockModel
+
+# Роутер на локальном mock-сервере: python -m pytest tests/llm_router_test.py
+# Отчет о задержках: python -m tests.llm_router_test
+# tail - модель, у которой каждый десятый ответ в 20 раз медленнее, flaky - падает в половине случаев.
+MODELS = {
+    "tail": MockModel(latency=0.05, tail=0.1, tail_latency=1.0),
+    "fast": MockModel(latency=0.15),
+    "flaky": MockModel(latency=0.05, error_rate=0.5),
+    "limited": MockModel(latency=0.05, rate_limit=1.0),
+}
+MESSAGES = [{"role": "user", "content": "Сколько строк?"}]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(router: LLMRouter, n: int = 200) -> tuple:
+    """Задержки запросов по возрастанию и ошибки роутера"""
+    errors = []
+    def one(_):
+        started = time.monotonic()
+        try:
+            response = router.parse(messages=MESSAGES, response_format=PandasCode, temperature=0)
+            assert response.choices[0].message.parsed.code == "df.shape[0]"
+        except RouterError as e:
+            errors.append(e)
+        return time.monotonic() - started
+    with ThreadPoolExecutor(8) as pool:
+        return sorted(pool.map(one, range(n))), errors
+
+
+def percentile(latencies: list, q: float) -> float:
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def report(name: str, latencies: list, router: LLMRouter) -> None:
+    p = lambda q: percentile(latencies, q)
+    print(f"\n{name}: p50={p(0.5):.3f} p95={p(0.95):.3f} p99={p(0.99):.3f} max={latencies[-1]:.3f}")
+    for route, stats in router.stats().items():
+        print("  ", route, stats)
+
+
+@pytest.fixture(scope="module")
+def config_path():
+    with MockServer(MODELS, port=free_port()) as server, tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "api.json")
+        with open(path, "w") as file:
+            json.dump({"mock": {"base_url": server.base_url, "requires_api_key": False}}, file)
+        yield path
+
+
+def test_hedging_cuts_tail(config_path):
+    # короткий общий срок: зависший запрос падает, а не держит прогон тестов
+    single = LLMRouter(["mock:tail"], config_path=config_path, max_hedges=0, timeout=30)
+    try:
+        latencies, errors = run(single, 100)
+    finally:
+        single.close()
+    assert not errors
+    # без хеджирования медленные ответы tail видны в хвосте
+    assert latencies[-1] >= 0.9
+    hedged = LLMRouter(["mock:tail", "mock:fast"], config_path=config_path, hedge_percentile=0.8, min_deadline=0.1,
+                       timeout=30)
+    try:
+        # первые запросы идут без хеджирования, пока у маршрута нет статистики задержек
+        run(hedged, 40)
+        hedged_latencies, errors = run(hedged, 100)
+        stats = hedged.stats()
+    finally:
+        hedged.close()
+    assert not errors
+    assert sum(route["hedges"] for route in stats.values()) > 0
+    slow = lambda values: sum(value >= 0.9 for value in values)
+    assert slow(hedged_latencies) < slow(latencies) / 2
+
+
+def test_failover_hides_errors(config_path):
+    failover = LLMRouter(["mock:limited", "mock:flaky", "mock:fast"], config_path=config_path,
+                         cooldown=5, attempt_timeout=5, timeout=30)
+    try:
+        _, errors = run(failover, 50)
+        stats = failover.stats()
+    finally:
+        failover.close()
+    assert not errors
+    # limited всегда отвечает 429 и пропускается после первых ошибок, ответы дают flaky и fast
+    assert 0 < stats["mock:limited"]["errors"] == stats["mock:limited"]["requests"] < 50
+    assert stats["mock:fast"]["requests"] - stats["mock:fast"]["errors"] > 0
+
+
+if __name__ == "__main__":
+    with MockServer(MODELS, port=8001) as server, tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "api.json")
+        with open(config_path, "w") as file:
+            json.dump({"mock": {"base_url": server.base_url, "requires_api_key": False}}, file)
+
+        single = LLMRouter(["mock:tail"], config_path=config_path, max_hedges=0)
+        report("Один маршрут без хеджирования", run(single)[0], single)
+        single.close()
+
+        hedged = LLMRouter(["mock:tail", "mock:fast"], config_path=config_path,
+                           hedge_percentile=0.8, min_deadline=0.1)
+        report("Хеджирование tail -> fast", run(hedged)[0], hedged)
+        hedged.close()
+
+        failover = LLMRouter(["mock:limited", "mock:flaky", "mock:fast"], config_path=config_path,
+                             cooldown=5, attempt_timeout=5)
+        report("Переключение при ошибках", run(failover)[0], failover)
+        failover.close()
@@ -0,0 +1,138 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from typing import Callable, Dict, Optional
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+# Локальный OpenAI-совместимый сервер для проверки роутера и прогонов без сети.
+# Поведение каждой модели: задержка, доля медленных ответов, доля ошибок 500 и 429.
+# Запуск: python -m tests.mock_llm_server --port 8001 --model fast=0.1 --model slow=2 --model flaky=0.1,0,0.5
+
+
+class MockModel():
+    def __init__(self, latency: float = 0.1, tail: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = 0.0, tail_latency: Optional[float] = None, token_latency: float = 0.01):
+        """Behaviour of one mock model
+
+        Args:
+            latency (float, optional): usual answer time, seconds. Defaults to 0.1.
+            tail (float, optional): share of slow answers. Defaults to 0.
+            error_rate (float, optional): share of 500 answers. Defaults to 0.
+            rate_limit (float, optional): share of 429 answers. Defaults to 0.
+            tail_latency (Optional[float], optional): time of slow answer. Defaults to 20 * latency.
+            token_latency (float, optional): pause between streamed pieces, seconds. Defaults to 0.01.
+        """
+        self.latency = latency
+        self.tail = tail
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.tail_latency = tail_latency if tail_latency is not None else latency * 20
+        self.token_latency = token_latency
+        self.requests = 0
+        self.streamed_chunks = 0
+    @classmethod
+    def from_spec(cls, spec: str) -> "MockModel":
+        """'latency,tail,error_rate,rate_limit' - missing values are zero"""
+        values = [float(v) for v in spec.split(",")] + [0.0] * 4
+        return cls(latency=values[0], tail=values[1], error_rate=values[2], rate_limit=values[3])
+
+
+def default_answer(messages: list) -> str:
+    return json.dumps({"code": "df.shape[0]", "comment": "mock"}, ensure_ascii=False)
+
+
+def create_app(models: Dict[str, MockModel], answer: Callable[[list], str] = default_answer) -> FastAPI:
+    """Mock app with /v1/chat/completions, answer(messages) gives content of the reply"""
+    app = FastAPI()
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "mock"} for name in models]}
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            # хеджирующий клиент уже получил ответ от другой модели
+            return Response(status_code=499)
+        model = models.get(body.get("model"))
+        if model is None:
+            return JSONResponse(status_code=404, content={"error": {"message": f"unknown model {body.get('model')}"}})
+        model.requests += 1
+        roll = random.random()
+        if roll < model.rate_limit:
+            return JSONResponse(status_code=429, headers={"retry-after": "1"},
+                                content={"error": {"message": "rate limited", "type": "rate_limit"}})
+        if roll < model.rate_limit + model.error_rate:
+            await asyncio.sleep(model.latency)
+            return JSONResponse(status_code=500, content={"error": {"message": "mock failure"}})
+        await asyncio.sleep(model.tail_latency if random.random() < model.tail else model.latency)
+        content = answer(body.get("messages", []))
+        if body.get("stream"):
+            return StreamingResponse(_stream_chunks(model, body["model"], content), media_type="text/event-stream")
+        return {
+            "id": f"mock-{model.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": _usage(body.get("messages", []), content)
+        }
+    return app
+
+
+def _usage(messages: list, content: str) -> dict:
+    """Rough token counts, about four characters per token, for tokens/sec in reports"""
+    prompt = sum(len(str(message.get("content", ""))) for message in messages) // 4
+    completion = max(1, len(content) // 4)
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+
+async def _stream_chunks(model: MockModel, name: str, content: str, piece: int = 4):
+    """Answer as server-sent events of a few characters, like tokens of a real model"""
+    def chunk(delta: dict, finish_reason: Optional[str] = None) -> str:
+        payload = {"id": f"mock-{model.requests}", "object": "chat.completion.chunk", "created": int(time.time()),
+                   "model": name, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    yield chunk({"role": "assistant", "content": ""})
+    for start in range(0, len(content), piece):
+        await asyncio.sleep(model.token_latency)
+        model.streamed_chunks += 1
+        yield chunk({"content": content[start:start + piece]})
+    yield chunk({}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+class MockServer():
+    def __init__(self, models: Dict[str, MockModel], port: int = 8001, answer: Callable[[list], str] = default_answer):
+        """Mock server in a background thread: with MockServer(...) as server: ..."""
+        self.models = models
+        self.port = port
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+        config = uvicorn.Config(create_app(models, answer), host="127.0.0.1", port=port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+    def __enter__(self) -> "MockServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+    def __exit__(self, *exc) -> None:
+        self._server.should_exit = True
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--model", action="append", default=[], help="name=latency,tail,error_rate,rate_limit")
+    args = parser.parse_args()
+    specs = dict(item.split("=", 1) for item in args.model) or {"mock": "0.1"}
+    uvicorn.run(create_app({name: MockModel.from_spec(spec) for name, spec in specs.items()}),
+                host="127.0.0.1", port=args.port)
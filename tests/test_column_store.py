@@ -0,0 +1,116 @@
+import os
+import pandas as pd
+import pytest
+import redis
+from functions.column_store import ChunkRefs, ColumnStore, column_digest
+from functions.memory import MemoryManager
+
+# Хранилище столбцов и счетчики ссылок на фрагменты: python -m pytest tests/test_column_store.py
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+
+@pytest.fixture
+def store(tmp_path):
+    refs = ChunkRefs(fakeredis.FakeRedis(decode_responses=True), "chunks:test")
+    return ColumnStore(str(tmp_path), refs=refs)
+
+
+def count(store: ColumnStore, digest: str) -> int:
+    return int(store.refs.r.hget(store.refs.key, digest) or 0)
+
+
+def test_shared_column_is_stored_once(store, tmp_path):
+    df = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+    first = store.write(df, str(tmp_path / "1.manifest.json"))
+    second = store.write(df.rename(columns={"a": "c"}), str(tmp_path / "2.manifest.json"))
+    digest = first["columns"][0]["chunk"]
+    assert second["columns"][0]["chunk"] == digest
+    assert count(store, digest) == 2
+    restored = store.read(str(tmp_path / "2.manifest.json"), columns=["c"])
+    pd.testing.assert_frame_equal(restored, df[["a"]].rename(columns={"a": "c"}))
+
+
+def test_chunk_is_collected_after_last_release(store, tmp_path):
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    digest = column_digest(df["a"])
+    paths = [str(tmp_path / f"{step}.manifest.json") for step in range(2)]
+    for path in paths:
+        store.write(df, path)
+    store.remove(paths[0])
+    # у фрагмента осталась ссылка второго состояния
+    assert store.collect(grace_seconds=0) == (0, 0)
+    assert count(store, digest) == 1
+    store.remove(paths[1])
+    assert count(store, digest) == 0
+    # фрагмент ждет конца льготного периода
+    assert store.collect(grace_seconds=600) == (0, 0)
+    removed, freed = store.collect(grace_seconds=0)
+    assert removed == 1 and freed > 0
+    assert not os.path.exists(store.chunk_path(digest))
+
+
+def test_chunk_taken_again_is_not_collected(store, tmp_path):
+    df = pd.DataFrame({"a": [1, 2, 3]})
+    digest = column_digest(df["a"])
+    store.write(df, str(tmp_path / "1.manifest.json"))
+    store.remove(str(tmp_path / "1.manifest.json"))
+    # фрагмент снова нужен до сборки: он остается на диске, хотя был в очереди на удаление
+    store.write(df, str(tmp_path / "2.manifest.json"))
+    assert store.collect(grace_seconds=0) == (0, 0)
+    assert os.path.exists(store.chunk_path(digest))
+    assert count(store, digest) == 1
+
+
+def test_rebuild_counts_manifests(store, tmp_path):
+    df = pd.DataFrame({"a": [1, 2], "b": [1, 2]})
+    manifest = store.write(df, str(tmp_path / "1.manifest.json"))
+    store.refs.r.delete(store.refs.key)
+    assert not store.refs.ready()
+    # одинаковые столбцы a и b - один фрагмент с двумя ссылками
+    assert store.refs.rebuild(store.manifests()) == 1
+    assert store.refs.ready()
+    assert count(store, manifest["columns"][0]["chunk"]) == 2
+
+
+def test_replaced_manifest_releases_its_chunks(store, tmp_path):
+    path = str(tmp_path / "1.manifest.json")
+    old = pd.DataFrame({"a": [1, 2, 3], "b": [4, 5, 6]})
+    store.write(old, path)
+    # та же запись еще раз (повтор или гонка переносов) не добавляет ссылок
+    store.write(old, path)
+    assert count(store, column_digest(old["a"])) == 1
+    store.write(old.assign(b=[7, 8, 9]), path)
+    assert count(store, column_digest(old["a"])) == 1
+    assert count(store, column_digest(old["b"])) == 0
+    assert store.refs.r.zscore(store.refs.free_key, column_digest(old["b"])) is not None
+
+
+def test_tier_migration_keeps_counts(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"a": range(10), "b": range(10, 20)}).to_csv(csv_path, index=False)
+    mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"), storage_mode="columnar",
+                        hot_format="arrow", hot_states=1)
+    try:
+        mgr.init_session_from_csv("s", str(csv_path))
+        for step in range(3):
+            mgr.push_result("s", mgr.load_current_df("s").assign(c=step), code=f"df['c'] = {step}")
+        mgr.undo("s")
+        write_state = mgr._write_state
+        def racing_write(filename, df, **kwargs):
+            # две миграции одного состояния пишут один и тот же файл
+            write_state(filename, df, **kwargs)
+            write_state(filename, df, **kwargs)
+        monkeypatch.setattr(mgr, "_write_state", racing_write)
+        mgr.set_tiering("s", hot_format="none")
+        mgr.close()
+        assert all(name.endswith(".manifest.json") for name in mgr.r.lrange(MemoryManager.session_keys("s")[0], 0, -1))
+        refs = mgr.column_store.refs
+        counts = refs.r.hgetall(refs.key)
+        # счетчики совпадают с подсчетом по манифестам на диске
+        refs.rebuild(mgr.column_store.manifests())
+        assert refs.r.hgetall(refs.key) == counts
+    finally:
+        mgr.close()
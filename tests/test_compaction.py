@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+import redis
+from functions import compaction
+from functions.memory import MemoryManager
+
+# Сжатие типов состояний: python -m pytest tests/test_compaction.py
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+SESSION = "s"
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+
+    def create(**kwargs):
+        mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"), **kwargs)
+        managers.append(mgr)
+        return mgr
+    managers = []
+    yield create
+    for mgr in managers:
+        mgr.close()
+
+
+def test_expand_converts_only_changed_columns():
+    df = pd.DataFrame({"a": range(6), "b": ["x", "y"] * 3, "c": np.arange(6, dtype="int32")})
+    stored, plan, report = compaction.compact(df)
+    assert report["columns"] == {"a": ["int64", "int32"], "b": ["object", "category"]}
+    frame = compaction.expand(stored, report["columns"])
+    assert frame.dtypes.to_dict() == df.dtypes.to_dict()
+    pd.testing.assert_frame_equal(frame, df)
+    # столбец, уже сменивший тип в коде, и отсутствующие столбцы не трогаются
+    columns = stored[["c"]]
+    assert compaction.expand(columns, report["columns"]) is columns
+    changed = stored.assign(a=stored["a"].astype("float64"))
+    assert compaction.expand(changed, report["columns"])["a"].dtype == "float64"
+
+
+def test_expand_is_noop_without_compaction(manager, tmp_path):
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"a": range(10), "b": ["x", "y"] * 5}).to_csv(csv_path, index=False)
+    mgr = manager()
+    mgr.init_session_from_csv(SESSION, str(csv_path))
+    df = mgr.load_current_df(SESSION)
+    assert mgr.expand(SESSION, df) is df
+
+
+def test_user_types_are_kept(manager, tmp_path):
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"a": range(10), "b": ["x", "y"] * 5}).to_csv(csv_path, index=False)
+    mgr = manager(compact=True)
+    mgr.init_session_from_csv(SESSION, str(csv_path))
+    df = mgr.expand(SESSION, mgr.load_current_df(SESSION))
+    assert df["a"].dtype == "int64" and df["b"].dtype == object
+    # типы, выбранные кодом пользователя, не расширяются обратно
+    df = df.assign(a=df["a"].astype("int32"), b=df["b"].astype("category"), f=df["a"].astype("float32"))
+    mgr.push_result(SESSION, df, code="...")
+    frame = mgr.expand(SESSION, mgr.load_current_df(SESSION))
+    assert frame["a"].dtype == "int32"
+    assert isinstance(frame["b"].dtype, pd.CategoricalDtype)
+    assert frame["f"].dtype == "float32"
+
+
+def test_code_runs_on_original_types(manager, tmp_path):
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"a": [40000, 1, 2]}).to_csv(csv_path, index=False)
+    mgr = manager(compact=True)
+    mgr.init_session_from_csv(SESSION, str(csv_path))
+    stored = mgr.load_current_df(SESSION)
+    assert stored["a"].dtype == "int32"
+    df = mgr.expand(SESSION, stored)
+    # в int32 произведение переполнилось бы
+    assert int((df["a"] * 100000)[0]) == 4000000000
+
+
+def test_arrow_strings_read_from_parquet_are_expanded(manager, tmp_path):
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"b": ["x", "y"] * 5}).to_csv(csv_path, index=False)
+    mgr = manager(compact=True, compact_strings="arrow")
+    mgr.init_session_from_csv(SESSION, str(csv_path))
+    mgr.frame_cache.clear()
+    stored = mgr.load_current_df(SESSION)
+    assert isinstance(stored["b"].dtype, pd.StringDtype)
+    assert mgr.expand(SESSION, stored)["b"].dtype == object
@@ -0,0 +1,70 @@
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from functions.df_code_analys import normalize_and_execute_code, is_read_only
+
+# Выполнение кода модели: python -m pytest tests/test_df_code_analys.py
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({"Age": [1.0, np.nan, 3.0], "Fare": [10, 20, 30]})
+
+
+def execute(code: str, frame: pd.DataFrame, report: dict = None):
+    with warnings.catch_warnings():
+        # цепочечное присваивание в pandas 2 дает FutureWarning, но работает
+        warnings.simplefilter("ignore")
+        return normalize_and_execute_code(code, frame, report, optimize=False)
+
+
+def test_inplace_fillna_of_column(df):
+    report = {}
+    result = execute("df['Age'].fillna(df['Age'].mean(), inplace=True)", df, report)
+    assert report["path"] == "copy"
+    assert result["Age"].tolist() == [1.0, 2.0, 3.0]
+    # состояние, с которого запускали код, не меняется
+    assert df["Age"].isna().sum() == 1
+
+
+def test_chained_assignment(df):
+    result = execute("df['Fare'][1] = 0", df)
+    assert result["Fare"].tolist() == [10, 0, 30]
+    assert df["Fare"].tolist() == [10, 20, 30]
+
+
+def test_write_through_values(df):
+    result = execute("values = df['Fare'].values\nvalues[0] = 99", df)
+    assert isinstance(result, pd.DataFrame)
+    assert result["Fare"].tolist() == [99, 20, 30]
+    assert df["Fare"].tolist() == [10, 20, 30]
+
+
+def test_read_only_code_gets_shared_frame(df):
+    report = {}
+    assert execute("df['Fare'].sum()", df, report) == 60
+    assert report["path"] == "readonly"
+
+
+@pytest.mark.parametrize("code", [
+    "import operator\noperator.setitem(df, 'x', 1)",
+    "getattr(df, 'insert')(0, 'x', 1)",
+    "df['Age'].fillna(0, inplace=True)",
+    "df.loc[0, 'Age'] = 5",
+    "v = df['Fare'].values\nv += 1",
+    "np.random.shuffle(df['Fare'].values)",
+])
+def test_writes_are_not_read_only(code):
+    assert not is_read_only(code)
+
+
+@pytest.mark.parametrize("code", [
+    "df['Fare'].sum()",
+    "df.groupby('Age')['Fare'].mean()",
+    "result = df[df['Fare'] > 10]['Age'].apply(lambda x: x * 2)",
+    "np.where(df['Fare'] > 10, 1, 0)",
+])
+def test_reads_are_read_only(code):
+    assert is_read_only(code)
+
@@ -0,0 +1,38 @@
+import threading
+import pandas as pd
+import pytest
+from functions.executor import SandboxExecutor, SandboxError, read_ipc, write_ipc
+
+# Песочница для кода модели: python -m pytest tests/test_executor.py
+
+
+@pytest.fixture(scope="module")
+def sandbox():
+    executor = SandboxExecutor(workers=1, timeout=60)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def mixed():
+    # числа среди строк: у такой колонки нет типа Arrow
+    return pd.DataFrame({"a": [1, 2, 3], "m": [1, "1", None]})
+
+
+def test_mixed_object_column_round_trip(tmp_path, mixed):
+    path = str(tmp_path / "frame.arrow")
+    write_ipc(mixed, path)
+    pd.testing.assert_frame_equal(read_ipc(path), mixed)
+
+
+def test_mixed_object_column_in_sandbox(sandbox, mixed):
+    assert sandbox.run("df['m'].map(type).map(lambda t: t.__name__).tolist()", mixed) == ["int", "str", "NoneType"]
+    result = sandbox.run("df['b'] = df['a'] * 2", mixed)
+    assert result["m"].tolist() == [1, "1", None]
+    assert result["b"].tolist() == [2, 4, 6]
+
+
+def test_unserializable_frame_raises_sandbox_error(sandbox):
+    df = pd.DataFrame({"lock": [threading.Lock()]})
+    with pytest.raises(SandboxError):
+        sandbox.submit("df", df)
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from functions.column_store import ColumnHasher, column_digest
+from functions.fingerprint import DigestMemo, fingerprint_parts, frame_fingerprint
+
+# Хэш всего содержимого состояния: python -m pytest tests/test_fingerprint.py
+
+
+def frame() -> pd.DataFrame:
+    return pd.DataFrame({"a": np.arange(1000), "b": np.linspace(0, 1, 1000), "s": [f"v{i}" for i in range(1000)],
+                         "c": pd.Categorical(["x", "y"] * 500)})
+
+
+def fingerprint(df: pd.DataFrame) -> str:
+    return frame_fingerprint(df, {name: column_digest(df[name]) for name in df.columns})
+
+
+def test_change_after_head_changes_fingerprint():
+    df = frame()
+    changed = df.copy()
+    changed.loc[900, "b"] = 2.0
+    assert fingerprint(df) != fingerprint(changed)
+    changed = df.copy()
+    changed.loc[900, "s"] = "other"
+    assert fingerprint(df) != fingerprint(changed)
+
+
+def test_names_dtypes_and_order_are_part_of_fingerprint():
+    df = frame()
+    assert fingerprint(df) == fingerprint(df.copy())
+    assert fingerprint(df) != fingerprint(df.rename(columns={"a": "z"}))
+    assert fingerprint(df) != fingerprint(df[["b", "a", "s", "c"]])
+    assert fingerprint(df) != fingerprint(df.astype({"a": "int32"}))
+
+
+def test_fingerprint_from_description_is_the_same():
+    df = frame()
+    digests = {name: column_digest(df[name]) for name in df.columns}
+    assert fingerprint_parts(len(df), list(zip(df.columns, df.dtypes)), digests) == fingerprint(df)
+
+
+def test_column_hashed_by_parts_is_the_same():
+    df = frame()
+    for name in df.columns:
+        hasher = ColumnHasher(df[name].dtype)
+        for start in range(0, len(df), 300):
+            hasher.update(df[name].iloc[start:start + 300])
+        assert hasher.hexdigest() == column_digest(df[name])
+
+
+def test_memo_skips_unchanged_columns():
+    memo = DigestMemo()
+    df = frame()
+    digests = memo.digests(df)
+    assert memo.misses == 4
+    # следующее состояние из кэша кадров: b новый, остальные столбцы в тех же буферах
+    next_df = df.copy(deep=False)
+    next_df["b"] = df["b"] * 2
+    digests_next = memo.digests(next_df)
+    assert memo.hits == 3 and memo.misses == 5
+    assert digests_next["a"] == digests["a"] and digests_next["b"] != digests["b"]
+    # тот же буфер в другом срезе - другой ключ
+    assert memo.get(df["a"].iloc[:10]) is None
+
+
+def test_object_cells_of_other_types_differ():
+    digests = {column_digest(pd.Series(values, dtype=object))
+               for values in ([1, "1"], ["1", 1], ["1", "1"], [1, 1], [[1], "x"], [["1"], "x"])}
+    assert len(digests) == 6
+    assert column_digest(pd.Series(["a", None])) != column_digest(pd.Series(["a", np.nan]))
@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+import redis
+from functions.frame_cache import FrameCache
+from functions.memory import MemoryManager
+
+# Кэш декодированных состояний в памяти: python -m pytest tests/test_frame_cache.py
+
+SESSION = "s"
+
+
+def frame(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({"a": range(rows)})
+
+
+def test_least_recently_used_is_evicted():
+    size = FrameCache.frame_size(frame(100))
+    cache = FrameCache(max_bytes=size * 2)
+    cache.put("1", frame(100))
+    cache.put("2", frame(100))
+    # чтение делает "1" недавним, вытесняется "2"
+    assert cache.get("1") is not None
+    cache.put("3", frame(100))
+    assert cache.get("2") is None
+    assert cache.get("1") is not None and cache.get("3") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == size * 2
+
+
+def test_frame_over_budget_is_not_cached():
+    cache = FrameCache(max_bytes=FrameCache.frame_size(frame(10)))
+    assert cache.put("1", frame(10))
+    # новая версия того же ключа больше бюджета: старая версия тоже удаляется
+    assert not cache.put("1", frame(1000))
+    assert cache.get("1") is None
+    assert cache.stats()["bytes"] == 0
+    assert not FrameCache(max_bytes=0).put("1", frame(10))
+
+
+def test_cached_frame_is_shared_shallowly():
+    cache = FrameCache()
+    cache.put("1", frame(3))
+    cached = cache.get("1")
+    cached["b"] = 1
+    del cached["a"]
+    assert list(cache.get("1").columns) == ["a"]
+    cache.invalidate("1")
+    assert cache.get("1") is None
+    assert cache.stats()["frames"] == 0
+
+
+def test_undo_reads_state_from_cache(tmp_path, monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    csv_path = tmp_path / "data.csv"
+    frame(10).to_csv(csv_path, index=False)
+    mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"))
+    try:
+        mgr.init_session_from_csv(SESSION, str(csv_path))
+        mgr.push_result(SESSION, mgr.load_current_df(SESSION).assign(b=1), code="df['b'] = 1")
+        mgr.undo(SESSION)
+        hits = mgr.frame_cache.stats()["hits"]
+        assert list(mgr.load_current_df(SESSION).columns) == ["a"]
+        assert mgr.frame_cache.stats()["hits"] == hits + 1
+    finally:
+        mgr.close()
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+import redis
+from functions import ingest
+from functions.memory import MemoryManager
+
+# Потоковая загрузка csv: python -m pytest tests/test_ingest.py
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+# блок читателя csv не меньше 1 МиБ, тип должен поменяться после первого блока
+ROWS = 200_000
+
+
+@pytest.fixture
+def drift_csv(tmp_path):
+    path = tmp_path / "drift.csv"
+    path.write_text("a,b,c\n" + "1,x,2\n" * ROWS + "1.5,y,z\n")
+    return path
+
+
+def test_type_drift_widens_column(tmp_path, drift_csv):
+    ingest.csv_to_parquet(str(drift_csv), str(tmp_path / "out.parquet"), 1024 ** 2)
+    streamed = pd.read_parquet(tmp_path / "out.parquet")
+    expected = pd.read_csv(drift_csv)
+    assert streamed.dtypes.to_dict() == {"a": np.dtype("float64"), "b": np.dtype(object), "c": np.dtype(object)}
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_type_drift_of_given_type_raises(tmp_path, drift_csv):
+    with pytest.raises(ValueError):
+        ingest.csv_to_parquet(str(drift_csv), str(tmp_path / "out.parquet"), 1024 ** 2, column_types={"c": pa.int64()})
+    assert not (tmp_path / "out.parquet").exists()
+
+
+@pytest.mark.parametrize("storage_mode", ["parquet", "columnar"])
+def test_streaming_ingest_is_compacted(tmp_path, monkeypatch, storage_mode):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    rng = np.random.default_rng(0)
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"i": rng.integers(0, 1000, ROWS), "g": rng.choice(["a", "b", "c"], ROWS),
+                  "u": [f"id{k}" for k in range(ROWS)], "n": pd.Series(rng.integers(0, 5, ROWS)).where(rng.random(ROWS) > .1)
+                  }).to_csv(csv_path, index=False)
+    loaded = {}
+    for streaming in (False, True):
+        mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / f"states_{streaming}"),
+                            storage_mode=storage_mode, compact=True, write_behind=False)
+        try:
+            session = f"s{streaming}"
+            meta = mgr.init_session_from_csv(session, str(csv_path), streaming=streaming, max_memory_bytes=1024 ** 2)
+            assert meta["compaction"]["columns"] == {"i": ["int64", "int32"], "g": ["object", "category"]}
+            mgr.frame_cache.clear()
+            stored = mgr.load_current_df(session)
+            assert stored["i"].dtype == "int32" and isinstance(stored["g"].dtype, pd.CategoricalDtype)
+            loaded[streaming] = stored
+            pd.testing.assert_frame_equal(mgr.expand(session, stored), pd.read_csv(csv_path))
+        finally:
+            mgr.close()
+    pd.testing.assert_frame_equal(loaded[True], loaded[False])
@@ -0,0 +1,42 @@
+import pytest
+import redis
+from functions.memory import MemoryManager
+
+# Кэш ответов LLM в redis: python -m pytest tests/test_llm_cache.py
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+PROMPT = "prompt"
+SIGNATURE = "state"
+
+
+@pytest.fixture
+def mgr(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    manager = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"))
+    yield manager
+    manager.close()
+
+
+def test_same_query_in_other_form_hits(mgr):
+    mgr.set_cache(PROMPT, SIGNATURE, "Mean of Age?", {"code": "df['Age'].mean()"})
+    payload = mgr.get_cache(PROMPT, SIGNATURE, "  mean of   AGE ")
+    assert payload["code"] == "df['Age'].mean()"
+    assert "created_at" in payload
+    assert mgr.llm_cache_stats["hits"] == 1 and mgr.llm_cache_stats["writes"] == 1
+
+
+def test_other_state_or_prompt_misses(mgr):
+    mgr.set_cache(PROMPT, SIGNATURE, "mean of age", {"code": "df['Age'].mean()"})
+    assert mgr.get_cache(PROMPT, "changed state", "mean of age") is None
+    assert mgr.get_cache("other prompt", SIGNATURE, "mean of age") is None
+    assert mgr.llm_cache_stats["misses"] == 2
+
+
+def test_failed_generation_is_cached_shortly(mgr):
+    mgr.set_negative_cache(PROMPT, SIGNATURE, "broken", error="SyntaxError")
+    assert mgr.get_cache(PROMPT, SIGNATURE, "broken")["error"] == "SyntaxError"
+    assert mgr.llm_cache_stats["negative_hits"] == 1
+    key = f"llmcache:{MemoryManager.cache_key(PROMPT, SIGNATURE, 'broken')}"
+    assert 0 < mgr.r.ttl(key) <= 60 * 5
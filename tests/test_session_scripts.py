@@ -0,0 +1,157 @@
+import json
+import pandas as pd
+import pytest
+import redis
+from redis.crc import key_slot
+from functions.memory import MemoryManager
+from functions.retention import Retention
+from functions.session_scripts import SessionScripts
+
+# Lua-скрипты графа версий на fakeredis: python -m pytest tests/test_session_scripts.py
+# Нужны пакеты fakeredis и lupa (выполняет Lua), без них тесты пропускаются.
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+SESSION = "s"
+KEYS = MemoryManager.session_keys(SESSION)
+PREFIX = MemoryManager.node_prefix(SESSION)
+PENDING = MemoryManager.pending_key(SESSION)
+
+
+def filename(step: int) -> str:
+    return f"/states/{SESSION}_state_{step}.parquet"
+
+
+@pytest.fixture
+def r():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def scripts(r):
+    return SessionScripts(r)
+
+
+def push(scripts: SessionScripts, step: int, **meta) -> int:
+    return scripts.push(KEYS, PREFIX, step, filename(step), dict({"note": f"step {step}"}, **meta))
+
+
+def steps(nodes: list) -> list:
+    return [node["step"] for node in nodes]
+
+
+def test_push_after_undo_starts_branch(r, scripts):
+    for step in range(3):
+        push(scripts, step)
+    assert scripts.checkout(KEYS, PREFIX, "parent")["step"] == 1
+    # новый шаг после отката - вторая ветка от шага 1, шаг 2 остается в графе
+    assert push(scripts, 3) == 1
+    assert steps(scripts.branch(KEYS, PREFIX)) == [0, 1, 3]
+    assert steps(scripts.branch(KEYS, PREFIX, 2)) == [0, 1, 2]
+    assert r.hget(PREFIX + "1", "last_child") == "3"
+    assert r.lrange(KEYS[0], 0, -1) == [filename(step) for step in range(4)]
+
+
+def test_redo_goes_to_last_child(scripts):
+    for step in range(2):
+        push(scripts, step)
+    scripts.checkout(KEYS, PREFIX, "parent")
+    push(scripts, 2)
+    # redo ведет в ветку, из которой пришли последней
+    scripts.checkout(KEYS, PREFIX, 1)
+    assert scripts.checkout(KEYS, PREFIX, "parent")["step"] == 0
+    assert scripts.checkout(KEYS, PREFIX, "child")["step"] == 1
+    scripts.checkout(KEYS, PREFIX, 2)
+    scripts.checkout(KEYS, PREFIX, "parent")
+    assert scripts.checkout(KEYS, PREFIX, "child")["step"] == 2
+    # у листа нет потомков, redo оставляет текущее состояние
+    assert scripts.checkout(KEYS, PREFIX, "child")["step"] == 2
+    assert scripts.checkout(KEYS, PREFIX, 7) is None
+    assert scripts.checkout(KEYS, PREFIX, "head")["step"] == 2
+
+
+def test_old_layout_is_converted(r, scripts):
+    # линейная история до графа версий: список файлов, индекс текущего и meta текущего состояния
+    r.rpush(KEYS[0], *[filename(step) for step in range(3)])
+    r.set(KEYS[3], 1)
+    r.hset(KEYS[4], mapping={"index": 1, "note": "old", "nrows": 5})
+    meta = scripts.checkout(KEYS, PREFIX, "head")
+    assert meta["step"] == 1 and meta["note"] == "old" and meta["filename"] == filename(1)
+    assert r.zrange(KEYS[2], 0, -1) == ["0", "1", "2"]
+    assert r.get(KEYS[1]) == "1"
+    assert not r.exists(KEYS[3]) and not r.exists(KEYS[4])
+    assert r.hget(PREFIX + "2", "parent") == "1"
+    assert r.hget(PREFIX + "0", "last_child") == "1"
+    assert scripts.checkout(KEYS, PREFIX, "child")["step"] == 2
+
+
+def test_drop_keeps_head_and_reparents_children(r, scripts):
+    for step in range(3):
+        push(scripts, step)
+    r.hset(PENDING, filename(1), "writer")
+    # текущее состояние не удаляется с keep_head
+    assert scripts.drop(KEYS, PENDING, PREFIX, 2, filename(2), keep_head=True) == -2
+    assert r.exists(PREFIX + "2")
+    assert scripts.drop(KEYS, PENDING, PREFIX, 1, filename(1), keep_head=True) == 1
+    assert not r.exists(PREFIX + "1") and not r.hexists(PENDING, filename(1))
+    assert r.hget(PREFIX + "2", "parent") == "0"
+    assert r.hget(PREFIX + "0", "last_child") == "2"
+    assert r.lrange(KEYS[0], 0, -1) == [filename(0), filename(2)]
+    assert scripts.drop(KEYS, PENDING, PREFIX, 1, filename(1)) == -1
+    # без keep_head текущим становится родитель удаленного
+    assert scripts.drop(KEYS, PENDING, PREFIX, 2, filename(2)) == 2
+    assert scripts.checkout(KEYS, PREFIX, "head")["step"] == 0
+
+
+def test_retention_squashes_changes_and_code(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"a": range(10), "b": range(10)}).to_csv(csv_path, index=False)
+    mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"))
+    try:
+        mgr.init_session_from_csv(SESSION, str(csv_path))
+        df = mgr.load_current_df(SESSION)
+        df = df.assign(x=1)
+        mgr.push_result(SESSION, df, code="df['x'] = 1")
+        mgr.push_result(SESSION, df.drop(columns=["b"]).assign(a=df["a"] * 2), code="df['a'] *= 2\ndel df['b']")
+        report = Retention(mgr, max_steps=2).prune(SESSION)
+        assert report["states"] == 1
+        nodes = {meta["step"]: meta for meta in mgr.tree(SESSION)}
+        assert sorted(nodes) == [0, 2]
+        checkpoint = nodes[2]
+        assert checkpoint["parent"] == 0
+        assert checkpoint["squashed"] == [1]
+        assert checkpoint["code"] == "df['x'] = 1\ndf['a'] *= 2\ndel df['b']"
+        assert checkpoint["changes"] == {"added": ["x"], "removed": ["b"], "modified": ["a"]}
+        assert json.loads(mgr.r.hget(PREFIX + "2", "changes")) == checkpoint["changes"]
+    finally:
+        mgr.close()
+
+
+def test_session_keys_share_cluster_slot(r, scripts):
+    for step in range(3):
+        push(scripts, step)
+    scripts.checkout(KEYS, PREFIX, "parent")
+    # узлы, которые скрипты строят из префикса, в том же слоте, что и объявленные ключи
+    assert {key_slot(key.encode()) for key in r.keys("*")} == {key_slot(KEYS[0].encode())}
+
+
+def test_old_keys_get_hash_tag(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    old = fakeredis.FakeRedis(server=server, decode_responses=True)
+    old.rpush(f"session:{SESSION}:states", filename(0), filename(1))
+    old.set(f"session:{SESSION}:head", 1)
+    old.zadd(f"session:{SESSION}:nodes", {"0": 0, "1": 1})
+    old.hset(f"session:{SESSION}:node:1", mapping={"step": 1, "parent": 0, "filename": filename(1)})
+    old.set(f"session:{SESSION}:seen", 5, ex=100)
+    mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"))
+    try:
+        assert not old.exists(f"session:{SESSION}:states")
+        assert old.lrange(KEYS[0], 0, -1) == [filename(0), filename(1)]
+        assert old.ttl(MemoryManager.session_key(SESSION, "seen")) > 0
+        assert mgr.scripts.checkout(KEYS, PREFIX, "head")["parent"] == 0
+        assert MemoryManager.session_id_of(KEYS[0]) == SESSION
+    finally:
+        mgr.close()
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+from functions import vectorize
+
+# Переписывание медленных конструкций pandas: python -m pytest tests/test_vectorize.py
+# Переписанный код должен давать на всем df тот же результат, что и исходный.
+
+ROWS = 1200
+rng = np.random.default_rng(0)
+
+
+def numbers(rows: int) -> pd.Series:
+    return pd.Series(rng.integers(0, 10, rows).astype(float))
+
+
+def frame_with_nan() -> pd.DataFrame:
+    # пропуски только после строк, на которых проверяется переписанный код
+    df = pd.DataFrame({"a": numbers(ROWS), "b": numbers(ROWS), "k": rng.choice(["x", "y", "z"], ROWS),
+                       "s": rng.choice(["Ab", " cd ", "EF"], ROWS).astype(object)})
+    late = np.arange(vectorize.VERIFY_ROWS + 100, ROWS, 50)
+    df.loc[late, "a"] = np.nan
+    df.loc[late + 1, "k"] = np.nan
+    df.loc[late + 2, "s"] = np.nan
+    return df
+
+
+def frame_with_objects() -> pd.DataFrame:
+    df = pd.DataFrame({"a": numbers(ROWS), "b": numbers(ROWS).astype(object), "k": rng.choice(["x", "y"], ROWS),
+                       "s": rng.choice(["Ab", " cd "], ROWS).astype(object)})
+    # число среди строк: метод строки на нем падает, .str дал бы NaN
+    df.loc[vectorize.VERIFY_ROWS + 10, "s"] = 5
+    return df
+
+
+def frame_with_ints() -> pd.DataFrame:
+    # в строках iterrows и apply(axis=1) целые числа становятся float, новый столбец из ячеек - float
+    return pd.DataFrame({"a": rng.integers(0, 10, ROWS), "b": numbers(ROWS), "k": rng.choice(["x", "y"], ROWS),
+                         "s": rng.choice(["Ab", "cd"], ROWS).astype(object)})
+
+
+def empty_frame() -> pd.DataFrame:
+    return pd.DataFrame({"a": pd.Series([], dtype=float), "b": pd.Series([], dtype=float),
+                         "k": pd.Series([], dtype=object), "s": pd.Series([], dtype=object)})
+
+
+FRAMES = {"nan": frame_with_nan, "object": frame_with_objects, "ints": frame_with_ints, "empty": empty_frame}
+
+CODES = {
+    "apply(axis=1)": "result = df.apply(lambda row: row['a'] * 2 + row['b'] if row['a'] > 3 else -row['b'], axis=1)",
+    "apply(lambda)": "result = df['a'].apply(lambda x: abs(x - 5) * 2)",
+    "map(lambda)": "result = df['s'].map(lambda x: x.lower())",
+    "len": "df['n'] = df['s'].apply(lambda x: len(x))",
+    "in": "result = df['k'].map(lambda x: x in ['x', 'z'])",
+    "iterrows": "for i, row in df.iterrows():\n    df.at[i, 'c'] = row['a'] + row['b'] * 2",
+    "iterrows of ints": "for i, row in df.iterrows():\n    df.at[i, 'c'] = row['a'] * 2",
+    "masked iterrows": "for i, row in df.iterrows():\n    if row['a'] > 100:\n        df.at[i, 'c'] = row['a']",
+    "bool iterrows": "for i, row in df.iterrows():\n    df.at[i, 'c'] = row['a'] > 3",
+    "for over index": "for i in df.index:\n    df.loc[i, 'c'] = df.loc[i, 'a'] / 2 if df.loc[i, 'a'] > 5 else 0",
+    "loop over groups": "for g in df['k'].unique():\n    df.loc[df['k'] == g, 'm'] = df.loc[df['k'] == g, 'a'].mean()",
+    "sum over groups": "for g in df['k'].unique():\n    df.loc[df['k'] == g, 'm'] = df.loc[df['k'] == g, 'a'].sum()",
+    "concat in loop": ("result = pd.DataFrame()\nfor g in ['x', 'y']:\n"
+                       "    result = pd.concat([result, df[df['k'] == g]])"),
+}
+
+
+def outcome(code: str, df: pd.DataFrame):
+    try:
+        result, changed, _ = vectorize._run(code, df.copy())
+    except Exception as e:
+        return type(e)
+    return result, changed
+
+
+def kinds(df: pd.DataFrame):
+    return lambda name: vectorize.column_kind(df[name]) if name in df.columns else None
+
+
+@pytest.mark.parametrize("frame", FRAMES)
+@pytest.mark.parametrize("rule", CODES)
+def test_rewrite_keeps_result(rule, frame):
+    df = FRAMES[frame]()
+    code = CODES[rule]
+    new_code, fired = vectorize.rewrite(code, df.columns, kinds(df))
+    expected, actual = outcome(code, df), outcome(new_code, df)
+    if isinstance(expected, type):
+        # исходный код падает: переписанный падает так же или не переписан
+        assert actual is expected or not fired
+        return
+    assert not isinstance(actual, type), new_code
+    assert vectorize._same(expected[0], actual[0]), new_code
+    assert vectorize._same(expected[1], actual[1]), new_code
+
+
+@pytest.mark.parametrize("rule", ["apply(axis=1)", "apply(lambda)", "iterrows", "iterrows of ints", "for over index",
+                                  "loop over groups", "sum over groups", "concat in loop"])
+def test_rule_fires_on_numbers(rule):
+    for df in (frame_with_nan(), frame_with_ints()):
+        _, fired = vectorize.rewrite(CODES[rule], df.columns, kinds(df))
+        assert fired
+
+
+def test_bool_writes_are_kept():
+    df = frame_with_ints()
+    assert vectorize.rewrite(CODES["bool iterrows"], df.columns, kinds(df))[1] == []
+
+
+def test_string_rules_need_string_columns():
+    for frame in (frame_with_nan(), frame_with_objects()):
+        for rule in ("map(lambda)", "len"):
+            assert vectorize.rewrite(CODES[rule], frame.columns, kinds(frame))[1] == []
+    clean = frame_with_ints()
+    assert vectorize.rewrite(CODES["map(lambda)"], clean.columns, kinds(clean))[1] == ["map(lambda)"]
+
+
+@pytest.mark.parametrize("frame", FRAMES)
+@pytest.mark.parametrize("rule", CODES)
+def test_optimize_keeps_result(rule, frame):
+    df = FRAMES[frame]()
+    code = CODES[rule]
+    expected = outcome(code, df)
+    actual = outcome(vectorize.optimize(code, df), df)
+    if isinstance(expected, type):
+        assert actual is expected
+        return
+    assert vectorize._same(expected[0], actual[0]) and vectorize._same(expected[1], actual[1])
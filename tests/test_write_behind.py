@@ -0,0 +1,104 @@
+import os
+import pandas as pd
+import pytest
+import redis
+from functions.memory import MemoryManager
+from functions.write_behind import StateLostError, StateWriter
+
+# Фоновая запись состояний и восстановление после ошибок: python -m pytest tests/test_write_behind.py
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+SESSION = "s"
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+    csv_path = tmp_path / "data.csv"
+    pd.DataFrame({"a": range(10), "b": range(10)}).to_csv(csv_path, index=False)
+
+    def create():
+        mgr = MemoryManager(redis_url="redis://fake", storage_dir=str(tmp_path / "states"), write_behind=True)
+        managers.append(mgr)
+        if not mgr.get_current_state_info(SESSION):
+            mgr.init_session_from_csv(SESSION, str(csv_path))
+        return mgr
+    managers = []
+    yield create
+    for mgr in managers:
+        mgr.close()
+
+
+def failing_writes(mgr: MemoryManager, monkeypatch) -> None:
+    def write_state(filename, df, digests=None, fmt=None):
+        raise OSError("disk is full")
+    monkeypatch.setattr(mgr, "_write_state", write_state)
+
+
+def test_failed_write_keeps_frame_until_retry(caplog):
+    calls = []
+    def persist(filename, df, args):
+        calls.append(filename)
+        if len(calls) == 1:
+            raise OSError("disk is full")
+    writer = StateWriter(persist)
+    try:
+        df = pd.DataFrame({"a": [1]})
+        writer.submit("state", df, ("s",))
+        with pytest.raises(RuntimeError):
+            writer.wait("state", timeout=5)
+        assert [record.levelname for record in caplog.records] == ["ERROR"]
+        assert "state" in caplog.records[0].getMessage() and caplog.records[0].exc_info
+        # кадр не записан, но остается доступным
+        assert writer.get("state") is df
+        assert writer.stats()["failed"] == 1
+        writer.retry("state")
+        assert writer.wait("state", timeout=5)
+        assert writer.get("state") is None
+        assert writer.stats() == {"pending": 0, "failed": 0, "written": 1}
+    finally:
+        writer.close()
+
+
+def test_state_is_loaded_before_it_is_written(manager, monkeypatch):
+    mgr = manager()
+    failing_writes(mgr, monkeypatch)
+    df = mgr.load_current_df(SESSION).assign(c=1)
+    meta = mgr.push_result(SESSION, df, code="df['c'] = 1")
+    with pytest.raises(RuntimeError):
+        mgr.flush(timeout=5)
+    assert meta["step"] == 1
+    assert list(mgr.load_current_df(SESSION).columns) == ["a", "b", "c"]
+
+
+def test_lost_state_is_dropped_on_undo(manager, monkeypatch):
+    mgr = manager()
+    failing_writes(mgr, monkeypatch)
+    mgr.push_result(SESSION, mgr.load_current_df(SESSION).assign(c=1), code="df['c'] = 1")
+    # повторная запись в потоке undo тоже падает: состояние удаляется, текущим становится родитель
+    with pytest.raises(StateLostError):
+        mgr.undo(SESSION)
+    assert mgr.get_current_state_info(SESSION)["step"] == 0
+    assert [meta["step"] for meta in mgr.tree(SESSION)] == [0]
+    assert list(mgr.load_current_df(SESSION).columns) == ["a", "b"]
+
+
+def test_recover_after_writer_crash(manager, monkeypatch):
+    crashed = manager()
+    failing_writes(crashed, monkeypatch)
+    lost = crashed.push_result(SESSION, crashed.load_current_df(SESSION).assign(c=1), code="df['c'] = 1")
+    with pytest.raises(RuntimeError):
+        crashed.flush(timeout=5)
+    # процесс упал: сердцебиения нет, отметка о незаписанном состоянии осталась
+    crashed.r.delete(f"writer:{crashed.owner}")
+    pending = MemoryManager.session_key(SESSION, "pending")
+    first = crashed.tree(SESSION)[0]["filename"]
+    crashed.r.hset(pending, first, "dead")
+    mgr = manager()
+    report = mgr.recover(SESSION)
+    assert report == {"kept": [first], "dropped": [lost["filename"]]}
+    assert not mgr.r.exists(pending)
+    assert mgr.get_current_state_info(SESSION)["step"] == 0
+    assert os.path.exists(first)